@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Benchmarks for MEtCO2, run on synthetic datasets.
+
+Run with `python -m benchmarks --help`.
+"""
@@ -0,0 +1,115 @@
+"""
+Times the correction of many runs sharing an acquisition protocol,
+one `transform` per run against a single `transform_group`, and
+checks that both give the same corrected data. Also checks that a
+single trace (PPG or respiration) given to either replaces only its
+own confound of a design fitted to both.
+"""
+import sys
+import time
+from argparse import (ArgumentParser, RawTextHelpFormatter)
+
+
+def get_parser():
+    """
+    Builds parser object.
+    """
+    parser = ArgumentParser(description='MEtCO2 group regression benchmark',
+                            formatter_class=RawTextHelpFormatter)
+    parser.add_argument('--runs', type=int, default=200,
+                        help='number of runs (default: 200).')
+    parser.add_argument('--voxels', type=int, default=4000,
+                        help='in-brain voxels per run (default: 4000).')
+    parser.add_argument('--vols', type=int, default=215,
+                        help='number of volumes (default: 215).')
+    parser.add_argument('--rtol', type=float, default=1e-4,
+                        help='allowed difference between the two, relative '
+                             'to the data\n(default: 1e-4).')
+    return parser
+
+
+def check_traces(n_vols, n_runs, n_voxels, rtol):
+    """
+    Corrects runs given only their PPG, or only their respiratory
+    trace, against the same runs given that trace's confound spliced
+    into the fitted ones. Returns the largest relative difference.
+    """
+    import numpy as np
+    from metco2.utils import PhysioCorrector
+    from metco2.utils.physio import traces_to_confounds
+    from metco2.utils.registry import (ATTA, Acquisition)
+    from .synthetic import (make_ppg, make_resp)
+
+    duration = ATTA.start + n_vols * ATTA.tr + 2
+    rng = np.random.default_rng(1)
+    data = [100 + rng.standard_normal((n_voxels, n_vols))
+            for _ in range(n_runs)]
+    ppg = [make_ppg(duration, seed=i) for i in range(n_runs + 1)]
+    resp = [make_resp(duration, seed=i) for i in range(n_runs + 1)]
+    corrector = PhysioCorrector(ATTA.tr).fit(n_vols, ppg=ppg[0],
+                                             resp=resp[0])
+    acq = Acquisition(ATTA.tr, n_vols, ATTA.start)
+    fitted = corrector.X_[:, corrector.is_confound_]
+
+    err = 0.
+    for column, kind, traces in ((0, 'ppg', ppg[1:]), (1, 'resp', resp[1:])):
+        expected = []
+        for d, trace in zip(data, traces):
+            confounds = fitted.copy()
+            confounds[:, column] = traces_to_confounds(
+                **{kind: trace, 'acq': acq})[:, 0]
+            expected.append(corrector.transform(d, confounds=confounds)[0])
+        single = [corrector.transform(d, **{kind: t})[0]
+                  for d, t in zip(data, traces)]
+        group = [r[0] for r in corrector.transform_group(data,
+                                                         **{kind: traces})]
+        scale = max(np.abs(d).max() for d in data)
+        kind_err = max(np.abs(r - e).max() / scale
+                       for r, e in zip(single + group, expected * 2))
+        print('{} only: {:.2e} relative'.format(kind, kind_err))
+        err = max(err, kind_err)
+    return err
+
+
+def main(argv=None):
+    """
+    Entry point.
+    """
+    import numpy as np
+    from metco2.utils import PhysioCorrector
+    from metco2.utils.registry import ATTA
+
+    opts = get_parser().parse_args(argv)
+    rng = np.random.default_rng(0)
+    onsets = [list(np.arange(30., opts.vols * ATTA.tr - 30, 60.))]
+    confounds = [rng.standard_normal((opts.vols, 2))
+                 for _ in range(opts.runs)]
+    data = [100 + rng.standard_normal((opts.voxels, opts.vols))
+            for _ in range(opts.runs)]
+
+    corrector = PhysioCorrector(ATTA.tr).fit(opts.vols, onsets, confounds[0])
+    start = time.perf_counter()
+    single = [corrector.transform(d, confounds=c)[0]
+              for d, c in zip(data, confounds)]
+    single_s = time.perf_counter() - start
+    start = time.perf_counter()
+    group = [r[0] for r in corrector.transform_group(data, confounds)]
+    group_s = time.perf_counter() - start
+
+    err = max(np.abs(s - g).max() for s, g in zip(single, group))
+    err /= max(np.abs(d).max() for d in data)
+    print('{} runs x {} voxels: per run {:.2f} s, group {:.2f} s '
+          '({:.1f}x)'.format(opts.runs, opts.voxels, single_s, group_s,
+                             single_s / group_s))
+    print('group vs per run: {:.2e} relative'.format(err))
+    if err > opts.rtol:
+        print('FAIL: group and per-run corrections differ.')
+        return 1
+    if check_traces(opts.vols, min(opts.runs, 4), 100, opts.rtol) > opts.rtol:
+        print('FAIL: a single trace does not replace only its confound.')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
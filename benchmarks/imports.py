@@ -0,0 +1,103 @@
+"""
+Checks that starting the `metco2` CLI stays cheap: importing it
+must not load any heavy dependency, and both the import and
+`metco2 --help` must fit a time budget.
+"""
+import sys
+import json
+import time
+import subprocess
+from argparse import (ArgumentParser, RawTextHelpFormatter)
+
+# dependencies only the processing stages may import
+HEAVY = ('numpy', 'scipy', 'nibabel', 'nipype', 'peakdet', 'duecredit')
+
+IMPORT_CODE = """
+import sys, json, time
+start = time.perf_counter()
+import metco2.cli.run
+seconds = time.perf_counter() - start
+print(json.dumps(dict(seconds=seconds,
+                      loaded=[m for m in {heavy!r} if m in sys.modules])))
+"""
+
+HELP_CMD = [sys.executable, '-c', 'from metco2.cli.run import main; main()',
+            '--help']
+
+
+def get_parser():
+    """
+    Builds parser object.
+    """
+    parser = ArgumentParser(description='MEtCO2 import-time benchmark',
+                            formatter_class=RawTextHelpFormatter)
+    parser.add_argument('--budget', type=float, default=0.2,
+                        help='allowed seconds to import the CLI '
+                             '(default: 0.2).')
+    parser.add_argument('--help-budget', type=float, default=0.5,
+                        help='allowed seconds for a whole `metco2 --help` '
+                             'process\n(default: 0.5).')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='repetitions; the fastest is kept (default: 5).')
+    return parser
+
+
+def time_import(repeat=5):
+    """
+    Imports the CLI in fresh interpreters.
+
+    Outputs
+    -------
+    seconds: float
+        fastest import time
+    loaded: list
+        heavy dependencies loaded by the import
+    """
+    best, loaded = float('inf'), []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c',
+                              IMPORT_CODE.format(heavy=HEAVY)],
+                             check=True, stdout=subprocess.PIPE,
+                             universal_newlines=True).stdout
+        result = json.loads(out)
+        best = min(best, result['seconds'])
+        loaded = result['loaded']
+    return best, loaded
+
+
+def time_help(repeat=5):
+    """
+    Returns the fastest wall time of a whole `metco2 --help` process.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(HELP_CMD, check=True, stdout=subprocess.DEVNULL)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(argv=None):
+    """
+    Entry point.
+    """
+    opts = get_parser().parse_args(argv)
+    import_s, loaded = time_import(opts.repeat)
+    help_s = time_help(opts.repeat)
+    print('import metco2.cli.run: {:.3f} s (budget {:.3f} s)'.format(
+        import_s, opts.budget))
+    print('metco2 --help:         {:.3f} s (budget {:.3f} s)'.format(
+        help_s, opts.help_budget))
+
+    failed = False
+    if loaded:
+        print('FAIL: importing the CLI loads {}.'.format(', '.join(loaded)))
+        failed = True
+    if import_s > opts.budget or help_s > opts.help_budget:
+        print('FAIL: CLI startup over budget.')
+        failed = True
+    return int(failed)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
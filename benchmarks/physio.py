@@ -0,0 +1,202 @@
+"""
+Checks the vectorized physio derivation (`--physio-method numpy`)
+against a plain loop over each recording: the same peaks from
+`find_extrema`, and the same iHR and RVT series from `i_hr_batch`
+and `rvt_batch` on traces of different lengths stacked together.
+Given real recordings (`--recordings`), it also compares the iHR and
+RVT series of both methods, when peakdet is installed.
+"""
+import os
+import sys
+from argparse import (ArgumentParser, RawTextHelpFormatter)
+
+
+def get_parser():
+    """
+    Builds parser object.
+    """
+    parser = ArgumentParser(description='MEtCO2 physio derivation check',
+                            formatter_class=RawTextHelpFormatter)
+    parser.add_argument('--traces', type=int, default=8,
+                        help='number of recordings of each type '
+                             '(default: 8).')
+    parser.add_argument('--rtol', type=float, default=1e-9,
+                        help='allowed relative difference of the series '
+                             '(default: 1e-9).')
+    parser.add_argument('--recordings', nargs='+', default=[],
+                        help='real ECG and Resp recordings to derive with '
+                             'both peakdet\nand numpy; skipped when peakdet '
+                             'is not installed.')
+    parser.add_argument('--tr', type=float, default=None,
+                        help='repetition time of the recordings\' run '
+                             '(default: ATTA\'s).')
+    parser.add_argument('--n_vols', '--n-vols', type=int, default=None,
+                        help='number of volumes of the run '
+                             '(default: ATTA\'s).')
+    parser.add_argument('--start', type=float, default=None,
+                        help='time of the first volume within the '
+                             'recordings\n(default: ATTA\'s).')
+    parser.add_argument('--min_corr', '--min-corr', type=float, default=0.9,
+                        help='smallest allowed correlation of the series of '
+                             'both methods\n(default: 0.9).')
+    return parser
+
+
+def ref_extrema(trace, distance, thresh):
+    """
+    Peaks of a single trace, one sample at a time: the maximum of
+    the `distance` samples on either side, above `thresh` of the
+    range, and not the continuation of a flat peak.
+    """
+    import numpy as np
+
+    lo, hi = np.nanmin(trace), np.nanmax(trace)
+    peaks = []
+    for i, value in enumerate(trace):
+        if not np.isfinite(value) or value < lo + thresh * (hi - lo):
+            continue
+        around = trace[max(i - distance, 0):i + distance + 1]
+        if value == np.nanmax(around):
+            peaks.append(i)
+    return [i for i in peaks
+            if not (i - 1 in peaks and trace[i] == trace[i - 1])]
+
+
+def ref_bin(times, values, acq):
+    """
+    Averages events into the volumes of `acq`, one volume at a
+    time, then fills empty volumes forward, then backward.
+    """
+    import numpy as np
+
+    binned = []
+    for vol in range(acq.n_vols):
+        inside = [v for t, v in zip(times, values)
+                  if int(np.floor((t - acq.start) / acq.tr)) == vol]
+        binned.append(np.mean(inside) if inside else np.nan)
+    for vol in range(1, acq.n_vols):
+        if np.isnan(binned[vol]):
+            binned[vol] = binned[vol - 1]
+    for vol in range(acq.n_vols - 2, -1, -1):
+        if np.isnan(binned[vol]):
+            binned[vol] = binned[vol + 1]
+    return np.array(binned)
+
+
+def ref_i_hr(trace, acq, samplerate, thresh, min_interval):
+    """
+    iHR of a single trace: 60 over each beat-to-beat interval,
+    at the time of the second beat.
+    """
+    peaks = ref_extrema(trace, max(int(min_interval * samplerate), 1),
+                        thresh)
+    times = [p / float(samplerate) for p in peaks]
+    return ref_bin(times[1:], [60. / (b - a)
+                               for a, b in zip(times[:-1], times[1:])], acq)
+
+
+def ref_rvt(trace, acq, samplerate, thresh, min_interval):
+    """
+    RVT of a single trace: the depth of each breath, from the last
+    trough before its peak, over the time since the previous peak.
+    """
+    distance = max(int(min_interval * samplerate), 1)
+    peaks = ref_extrema(trace, distance, thresh)
+    troughs = ref_extrema(-trace, distance, thresh)
+    times, values = [], []
+    for prev, peak in zip(peaks[:-1], peaks[1:]):
+        before = [t for t in troughs if t < peak]
+        if before:
+            times.append(peak / float(samplerate))
+            values.append((trace[peak] - trace[before[-1]]) /
+                          ((peak - prev) / float(samplerate)))
+    return ref_bin(times, values, acq)
+
+
+def compare_peakdet(recordings, acq, min_corr):
+    """
+    Derives each recording with peakdet and with the vectorized
+    implementation, and compares their series. Returns whether any
+    pair correlates less than `min_corr`, or None if peakdet (with
+    the PPG and RESP classes `metco2` uses) is not installed.
+    """
+    import numpy as np
+    from metco2.utils.physio import derive_ts
+
+    try:
+        import peakdet
+        peakdet.PPG, peakdet.RESP
+    except (ImportError, AttributeError):
+        print('peakdet is not installed: skipped comparing against it.')
+        return None
+    failed = False
+    for fname in recordings:
+        ref = derive_ts(fname, acq, method='peakdet')
+        series = derive_ts(fname, acq, method='numpy')
+        corr = np.corrcoef(ref, series)[0, 1]
+        diff = np.abs(series - ref).mean() / np.abs(ref).mean()
+        print('{}: peakdet vs numpy correlation {:.3f}, mean difference '
+              '{:.1%}'.format(os.path.basename(fname), corr, diff))
+        if not corr >= min_corr:
+            print('FAIL: {} differs from peakdet.'.format(fname))
+            failed = True
+    return failed
+
+
+def main(argv=None):
+    """
+    Entry point.
+    """
+    import numpy as np
+    from metco2.utils.physio import (SAMPLERATE, PPG_THRESH, RESP_THRESH,
+                                     MIN_BEAT, MIN_BREATH, stack_traces,
+                                     find_extrema, i_hr_batch, rvt_batch)
+    from metco2.utils.registry import (ATTA, Acquisition)
+    from .synthetic import (DURATION, make_ppg, make_resp)
+
+    opts = get_parser().parse_args(argv)
+    # recordings of different lengths, so the stacked traces are padded
+    lengths = [DURATION + 5 * i for i in range(opts.traces)]
+
+    def _harden(trace, i):
+        # a slow drift pushes some peaks below the threshold, and every
+        # other trace is quantized, as by an ADC, so peaks can be flat
+        t = np.arange(len(trace)) / float(SAMPLERATE)
+        trace = trace + np.sin(2 * np.pi * t / 150.)
+        return np.round(trace * 16) / 16 if i % 2 else trace
+
+    kinds = [
+        ('iHR', i_hr_batch, ref_i_hr, PPG_THRESH, MIN_BEAT,
+         [_harden(make_ppg(d, rate=1. + 0.05 * i, seed=i), i)
+          for i, d in enumerate(lengths)]),
+        ('RVT', rvt_batch, ref_rvt, RESP_THRESH, MIN_BREATH,
+         [_harden(make_resp(d, rate=0.2 + 0.01 * i, seed=i), i)
+          for i, d in enumerate(lengths)])]
+
+    failed = False
+    for name, batch, ref, thresh, min_interval, traces in kinds:
+        stacked = stack_traces(traces)
+        distance = max(int(min_interval * SAMPLERATE), 1)
+        rows, cols = find_extrema(stacked, distance, thresh)
+        n_wrong = sum(cols[rows == i].tolist() !=
+                      ref_extrema(trace, distance, thresh)
+                      for i, trace in enumerate(traces))
+        series = batch(stacked, ATTA)
+        err = max(np.abs(s - ref(trace, ATTA, SAMPLERATE, thresh,
+                                 min_interval)).max() / np.abs(s).max()
+                  for s, trace in zip(series, traces))
+        print('{}: {} peaks, {} of {} traces differ; series {:.2e} '
+              'relative'.format(name, len(rows), n_wrong, len(traces), err))
+        if n_wrong or not err <= opts.rtol:
+            print('FAIL: {} differs from the reference loop.'.format(name))
+            failed = True
+
+    if opts.recordings:
+        acq = Acquisition(opts.tr or ATTA.tr, opts.n_vols or ATTA.n_vols,
+                          ATTA.start if opts.start is None else opts.start)
+        failed = compare_peakdet(opts.recordings, acq, opts.min_corr) or failed
+    return int(failed)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,126 @@
+"""
+Replays a synthetic run through the online correction and checks
+that every volume is corrected within one TR, that incremental peak
+detection matches the batch detector, and that the final recursive
+least squares fit matches a batch fit of the same (causal) design.
+"""
+import sys
+import shutil
+import tempfile
+from argparse import (ArgumentParser, RawTextHelpFormatter)
+
+
+def get_parser():
+    """
+    Builds parser object.
+    """
+    parser = ArgumentParser(description='MEtCO2 real-time replay benchmark',
+                            formatter_class=RawTextHelpFormatter)
+    parser.add_argument('--shape', type=int, nargs=3, default=[64, 64, 32],
+                        help='spatial shape of the image '
+                             '(default: 64 64 32).')
+    parser.add_argument('--vols', type=int, default=215,
+                        help='number of volumes (default: 215).')
+    parser.add_argument('--chunk', type=float, default=0.1,
+                        help='seconds of physio pushed at a time when '
+                             'checking peak\ndetection (default: 0.1).')
+    parser.add_argument('--realtime', action='store_true',
+                        help='pace the replay at one volume per TR.')
+    parser.add_argument('--rtol', type=float, default=1e-4,
+                        help='allowed relative difference between the '
+                             'online and batch\ncoefficients '
+                             '(default: 1e-4).')
+    return parser
+
+
+def check_peaks(trace, distance, thresh, chunk):
+    """
+    Returns whether `OnlinePeaks`, fed `chunk` samples at a time,
+    finds the peaks of `physio.find_extrema` on the whole trace
+    (except within `distance` of its end, never decided online).
+    """
+    import numpy as np
+    from metco2.utils.physio import find_extrema
+    from metco2.utils.realtime import OnlinePeaks
+
+    online = OnlinePeaks(distance, thresh,
+                         bounds=(np.nanmin(trace), np.nanmax(trace)))
+    found = np.concatenate([online.push(trace[i:i + chunk])[0]
+                            for i in range(0, len(trace), chunk)])
+    batch = find_extrema(trace[np.newaxis], distance, thresh)[1]
+    return np.array_equal(found, batch[batch < len(trace) - distance])
+
+
+def main(argv=None):
+    """
+    Entry point.
+    """
+    import numpy as np
+    import nibabel as nib
+    from metco2.utils import physio
+    from metco2.utils.realtime import replay
+    from metco2.utils.scheduler import collect_jobs
+    from .synthetic import (make_dataset, SAMPLERATE)
+
+    opts = get_parser().parse_args(argv)
+    chunk = max(int(opts.chunk * SAMPLERATE), 1)
+    data_dir = tempfile.mkdtemp(prefix='metco2-realtime-')
+    try:
+        subjects = make_dataset(data_dir, 1, 1, 1, tuple(opts.shape),
+                                opts.vols)
+        job = collect_jobs(data_dir, subjects)[0]
+
+        peaks_ok = True
+        for physio_f in job.physio:
+            trace = physio.load_physio(physio_f)
+            if physio.physio_kind(physio_f) == 'ECG':
+                args = (int(physio.MIN_BEAT * SAMPLERATE), physio.PPG_THRESH)
+            else:
+                args = (int(physio.MIN_BREATH * SAMPLERATE),
+                        physio.RESP_THRESH)
+            for sign in (1, -1):
+                peaks_ok &= check_peaks(sign * trace, args[0], args[1],
+                                        chunk)
+
+        result = replay(job.images[0], job.physio, job.events,
+                        realtime=opts.realtime)
+        corrector = result.corrector
+        data = np.asanyarray(nib.load(job.images[0]).dataobj)
+        data = data.reshape(-1, data.shape[-1]).astype(float)
+        fit_err = None
+        # otherwise the fit is not unique, and RLS keeps its prior
+        if np.linalg.matrix_rank(corrector.X) == corrector.X.shape[1]:
+            batch = np.linalg.lstsq(corrector.X, data.T, rcond=None)[0].T
+            scale = np.abs(batch).max(axis=0)
+            fit_err = (np.abs(corrector.betas - batch).max(axis=0) /
+                       np.where(scale > 0, scale, 1)).max()
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    tr = corrector.acq.tr
+    print('volume latency: median {:.2f} ms, max {:.2f} ms '
+          '(TR {:.0f} ms)'.format(1e3 * np.median(result.latencies),
+                                  1e3 * result.latencies.max(), 1e3 * tr))
+    print('online peaks match batch: {}'.format(peaks_ok))
+    if fit_err is None:
+        print('online vs batch coefficients: not compared, the design is '
+              'rank deficient')
+    else:
+        print('online vs batch coefficients: {:.2e} relative'.format(
+            fit_err))
+
+    failed = False
+    if result.latencies.max() > tr:
+        print('FAIL: a volume took longer than one TR.')
+        failed = True
+    if not peaks_ok:
+        print('FAIL: online and batch peak detection differ.')
+        failed = True
+    if fit_err is not None and fit_err > opts.rtol:
+        print('FAIL: online fit differs from the batch fit.')
+        failed = True
+    return int(failed)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,77 @@
+"""
+Checks that `--resume` only skips runs whose outputs are still up
+to date: processes a synthetic dataset, then changes one run's
+physio recording, the physio derivation method and the physio
+start time in turn, and checks which runs are left to process.
+"""
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+from argparse import (ArgumentParser, RawTextHelpFormatter)
+
+RUN_CMD = [sys.executable, '-c', 'from metco2.cli.run import main; main()']
+
+
+def get_parser():
+    """
+    Builds parser object.
+    """
+    parser = ArgumentParser(description='MEtCO2 resume check',
+                            formatter_class=RawTextHelpFormatter)
+    parser.add_argument('--shape', type=int, nargs=3, default=[8, 8, 4],
+                        help='spatial shape of the images (default: 8 8 4).')
+    return parser
+
+
+def main(argv=None):
+    """
+    Entry point.
+    """
+    import numpy as np
+    from metco2.utils.scheduler import (collect_jobs, pending_jobs)
+    from .synthetic import (make_dataset, make_ppg)
+
+    opts = get_parser().parse_args(argv)
+    tmp_dir = tempfile.mkdtemp(prefix='metco2-resume-')
+    data_dir = os.path.join(tmp_dir, 'data')
+    out_dir = os.path.join(tmp_dir, 'out')
+    try:
+        subjects = make_dataset(data_dir, 2, 2, 1, tuple(opts.shape))
+        subprocess.run(RUN_CMD + [data_dir, out_dir, 'participant'],
+                       check=True, stdout=subprocess.DEVNULL)
+
+        def _pending(**kwargs):
+            jobs = collect_jobs(data_dir, subjects,
+                                physio_start=kwargs.pop('physio_start',
+                                                        8.0))
+            return [(j.subject, j.run)
+                    for j in pending_jobs(jobs, out_dir, **kwargs)]
+
+        cases = [('unchanged', _pending(), 0)]
+        job = collect_jobs(data_dir, subjects)[0]
+        ecg = [f for f in job.physio if 'ECG' in f][0]
+        np.savetxt(ecg, make_ppg(seed=1))
+        cases.append(('changed physio', _pending(), 1))
+        cases.append(('--physio-method numpy',
+                      _pending(physio_method='numpy'), 4))
+        cases.append(('--physio-start 4', _pending(physio_start=4.0), 4))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    failed = False
+    for name, pending, expected in cases:
+        print('{}: {} of 4 runs pending (expected {})'.format(
+            name, len(pending), expected))
+        failed |= len(pending) != expected
+    if cases[1][1] != [(job.subject, job.run)]:
+        print('FAIL: the changed run is not the one pending.')
+        failed = True
+    if failed:
+        print('FAIL: --resume would skip stale runs or redo complete ones.')
+    return int(failed)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,277 @@
+"""
+Times each stage of MEtCO2 on a synthetic dataset and compares
+the results against stored baselines.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import tracemalloc
+from argparse import (ArgumentParser, RawTextHelpFormatter)
+
+from .synthetic import (make_dataset, ECHO_TIMES)
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'baselines.json')
+
+
+def get_parser():
+    """
+    Builds parser object.
+    """
+    parser = ArgumentParser(description='MEtCO2 benchmarks',
+                            formatter_class=RawTextHelpFormatter)
+    g_data = parser.add_argument_group('Options for the synthetic dataset')
+    g_data.add_argument('--subjects', type=int, default=2,
+                        help='number of subjects (default: 2).')
+    g_data.add_argument('--runs', type=int, default=2,
+                        help='number of runs per subject (default: 2).')
+    g_data.add_argument('--echoes', type=int, default=1,
+                        help='number of echoes per run (default: 1).')
+    g_data.add_argument('--shape', type=int, nargs=3, default=[64, 64, 32],
+                        help='spatial shape of the images '
+                             '(default: 64 64 32).')
+    g_data.add_argument('--vols', type=int, default=215,
+                        help='number of volumes per run (default: 215).')
+
+    g_data.add_argument('--output-format', default='nii.gz',
+                        choices=['nii.gz', 'nii', 'fastgz', 'zarr'],
+                        help='format written by the write stage '
+                             '(default: nii.gz).')
+    g_data.add_argument('--physio-method', default='peakdet',
+                        choices=['peakdet', 'numpy'],
+                        help='derivation timed by the physio stage '
+                             '(default: peakdet).')
+
+    g_bench = parser.add_argument_group('Options for timing')
+    g_bench.add_argument('--repeat', type=int, default=3,
+                         help='repetitions per stage; the fastest is kept '
+                              '(default: 3).')
+    g_bench.add_argument('--baseline', default=BASELINE,
+                         help='baseline file (default: {}).'.format(
+                             os.path.relpath(BASELINE)))
+    g_bench.add_argument('--save-baseline', action='store_true',
+                         help='store these results as the new baseline.')
+    g_bench.add_argument('--tolerance', type=float, default=0.25,
+                         help='allowed slowdown relative to the baseline, '
+                              'as a fraction\n(default: 0.25).')
+    g_bench.add_argument('--output', default=None,
+                         help='also write the results to this JSON file.')
+    return parser
+
+
+def measure(func, repeat=3):
+    """
+    Times `func`, keeping the fastest of `repeat` calls, and
+    records its peak traced memory.
+
+    Inputs
+    ------
+    func: callable
+        the stage to time, called without arguments
+    repeat: int
+        (Optional) number of calls.
+
+    Outputs
+    -------
+    result: object
+        the return value of the last call
+    stats: dict
+        'seconds' (fastest wall time) and 'peak_mb' (peak memory)
+    """
+    best, peak = float('inf'), 0
+    for _ in range(repeat):
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return result, dict(seconds=best, peak_mb=peak / 1024. ** 2)
+
+
+def run_stages(data_dir, subjects, echo_times=None, repeat=3,
+               output_format='nii.gz', physio_method='peakdet'):
+    """
+    Times the input gathering, physio derivation, GLM and write-out
+    stages on a dataset.
+
+    Inputs
+    ------
+    data_dir: str
+        root folder of the dataset
+    subjects: list
+        participant identifiers
+    echo_times: list
+        (Optional) echo times, for multi-echo datasets.
+    repeat: int
+        (Optional) repetitions per stage.
+    output_format: str
+        (Optional) format written by the write stage.
+    physio_method: str
+        (Optional) derivation timed by the physio stage.
+
+    Outputs
+    -------
+    dict
+        per-stage timing and memory statistics
+    """
+    import numpy as np
+    import nibabel as nib
+    from metco2.utils.glm import (design_matrix, remove_confounds, get_tr,
+                                  optimal_combination, _save)
+    from metco2.utils.nifti import (output_name, disk_usage)
+    from metco2.utils.physio import convolve_batch
+    from metco2.utils.scheduler import collect_jobs
+    from metco2.workflows.model import _gen_stim_list
+
+    stages = {}
+    jobs, stages['gather_inputs'] = measure(
+        lambda: collect_jobs(data_dir, subjects), repeat)
+
+    physio = [p for job in jobs for p in job.physio]
+    acquisitions = [job.acquisition for job in jobs for _ in job.physio]
+    confounds, stages['physio'] = measure(
+        lambda: convolve_batch(physio, acquisitions=acquisitions,
+                               method=physio_method), repeat)
+    confounds = [np.transpose(confounds[i:i + 2])
+                 for i in range(0, len(confounds), 2)]
+
+    def _glm():
+        corrected = []
+        for job, conf in zip(jobs, confounds):
+            imgs = [nib.load(f) for f in job.images]
+            n_vols = imgs[0].shape[-1]
+            X, is_confound = design_matrix(_gen_stim_list(job.events), conf,
+                                           n_vols, get_tr(imgs[0]))
+            data = np.concatenate([np.asanyarray(i.dataobj).reshape(-1,
+                                                                    n_vols)
+                                   for i in imgs])
+            data = remove_confounds(data, X, is_confound)[0]
+            if echo_times is not None:
+                optcom = optimal_combination(
+                    data.reshape(len(imgs), -1, n_vols), echo_times)
+                data = np.concatenate([data, optcom])
+            corrected.append(data)
+        return corrected
+    corrected, stages['glm'] = measure(_glm, repeat)
+
+    out_dir = tempfile.mkdtemp()
+
+    def _write():
+        out_files = []
+        for j, (job, data) in enumerate(zip(jobs, corrected)):
+            img = nib.load(job.images[0])
+            n_out = data.shape[0] // np.prod(img.shape[:-1])
+            for i, echo in enumerate(np.split(data, n_out)):
+                out_files.append(_save(
+                    echo.reshape(img.shape), img,
+                    output_name(os.path.join(out_dir, '{}_{}.nii'.format(j,
+                                                                         i)),
+                                output_format), output_format))
+        return out_files
+    try:
+        out_files, stages['write'] = measure(_write, repeat)
+        stages['write']['mb_on_disk'] = sum(disk_usage(f) for f in
+                                            out_files) / 1024. ** 2
+    finally:
+        shutil.rmtree(out_dir)
+
+    n_bytes = sum(os.path.getsize(f) for job in jobs for f in job.images)
+    n_voxels = sum(d.size for d in corrected)
+    for name, stats in stages.items():
+        stats['runs_per_s'] = len(jobs) / stats['seconds']
+    stages['glm']['mvoxel_vols_per_s'] = (n_voxels / 1e6 /
+                                          stages['glm']['seconds'])
+    stages['gather_inputs']['mb_on_disk'] = n_bytes / 1024. ** 2
+    return stages
+
+
+def compare(results, baseline, tolerance=0.25):
+    """
+    Compares stage timings against a baseline.
+
+    Inputs
+    ------
+    results: dict
+        per-stage statistics, as returned by `run_stages`
+    baseline: dict
+        per-stage statistics of the baseline
+    tolerance: float
+        (Optional) allowed slowdown, as a fraction.
+
+    Outputs
+    -------
+    list
+        names of the stages that regressed
+    """
+    regressed = []
+    for name, stats in results.items():
+        if name not in baseline:
+            continue
+        limit = baseline[name]['seconds'] * (1 + tolerance)
+        if stats['seconds'] > limit:
+            regressed.append(name)
+    return regressed
+
+
+def main(argv=None):
+    """
+    Entry point.
+    """
+    opts = get_parser().parse_args(argv)
+    config = 'sub{}_run{}_echo{}_{}x{}x{}x{}'.format(
+        opts.subjects, opts.runs, opts.echoes, *(opts.shape + [opts.vols]))
+    if opts.output_format != 'nii.gz':
+        config += '_' + opts.output_format
+    if opts.physio_method != 'peakdet':
+        config += '_' + opts.physio_method
+
+    data_dir = os.path.join(tempfile.gettempdir(),
+                            'metco2-bench-{}'.format(os.getpid()))
+    try:
+        subjects = make_dataset(data_dir, opts.subjects, opts.runs,
+                                opts.echoes, tuple(opts.shape), opts.vols)
+        echo_times = ECHO_TIMES[:opts.echoes] if opts.echoes > 1 else None
+        results = run_stages(data_dir, subjects, echo_times, opts.repeat,
+                             opts.output_format, opts.physio_method)
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    print('{:<15}{:>12}{:>12}{:>12}'.format('stage', 'seconds', 'peak MB',
+                                            'runs/s'))
+    for name, stats in results.items():
+        print('{:<15}{seconds:>12.3f}{peak_mb:>12.1f}'
+              '{runs_per_s:>12.2f}'.format(name, **stats))
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump({config: results}, f, indent=2)
+
+    baselines = {}
+    if os.path.exists(opts.baseline):
+        with open(opts.baseline) as f:
+            baselines = json.load(f)
+
+    if opts.save_baseline:
+        baselines[config] = results
+        with open(opts.baseline, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print('Saved baseline for {}.'.format(config))
+        return 0
+
+    if config not in baselines:
+        print('No baseline for {}; run with --save-baseline.'.format(config))
+        return 0
+    regressed = compare(results, baselines[config], opts.tolerance)
+    if regressed:
+        print('REGRESSION: {} slower than baseline by more than '
+              '{:.0%}.'.format(', '.join(regressed), opts.tolerance))
+        return 1
+    print('All stages within {:.0%} of baseline.'.format(opts.tolerance))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,83 @@
+"""
+Checks that the vectorized physio derivation (`--physio-method
+numpy`) streams recordings: the peak memory of parsing a recording
+into its sidecar and deriving its series must not grow with the
+length of the recording.
+"""
+import os
+import sys
+import shutil
+import tempfile
+from argparse import (ArgumentParser, RawTextHelpFormatter)
+
+
+def get_parser():
+    """
+    Builds parser object.
+    """
+    parser = ArgumentParser(description='MEtCO2 physio streaming check',
+                            formatter_class=RawTextHelpFormatter)
+    parser.add_argument('--minutes', type=float, nargs=2, default=[30, 240],
+                        help='lengths of the short and long recordings, in '
+                             'minutes\n(default: 30 240).')
+    parser.add_argument('--growth', type=float, default=1.25,
+                        help='allowed ratio of the peak memory of the long '
+                             'recording\nto that of the short one '
+                             '(default: 1.25).')
+    return parser
+
+
+def peak_mb(func, *args):
+    """
+    Peak memory allocated while running `func`, in MB.
+    """
+    import tracemalloc
+
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1] / 1024. ** 2
+    finally:
+        tracemalloc.stop()
+
+
+def main(argv=None):
+    """
+    Entry point.
+    """
+    import numpy as np
+    from metco2.utils.physio import (SAMPLERATE, derive_batch)
+    from .synthetic import (make_ppg, make_resp)
+
+    opts = get_parser().parse_args(argv)
+    tmp_dir = tempfile.mkdtemp(prefix='metco2-stream-')
+    results = []
+    try:
+        for minutes in opts.minutes:
+            files = []
+            for kind, make in (('ECG', make_ppg), ('Resp', make_resp)):
+                fname = os.path.join(tmp_dir, '{}min_{}.1D'.format(
+                    int(minutes), kind))
+                np.savetxt(fname, make(minutes * 60.))
+                files.append(fname)
+            # first call parses the text into sidecars, later ones map them
+            parse = peak_mb(derive_batch, files)
+            derive = peak_mb(derive_batch, files)
+            dense = 2 * minutes * 60. * SAMPLERATE * 8 / 1024. ** 2
+            results.append((parse, derive))
+            print('{:g} min: parse {:.1f} MB, derive {:.1f} MB peak '
+                  '({:.1f} MB as dense arrays)'.format(minutes, parse, derive,
+                                                       dense))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    (short_parse, short_derive), (long_parse, long_derive) = results
+    if (long_parse > opts.growth * short_parse or
+            long_derive > opts.growth * short_derive):
+        print('FAIL: peak memory grows with the length of the recording.')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
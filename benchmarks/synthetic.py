@@ -0,0 +1,211 @@
+"""
+Generators for synthetic physio recordings, 4D images and PLS
+datamats, laid out like the ATTA dataset that `metco2` expects.
+"""
+import os
+import numpy as np
+import nibabel as nib
+
+SAMPLERATE = 40
+TR = 2.0
+# covers the 8.0 - 438.0 s scan window used by `metco2.utils.physio`
+DURATION = 440.
+ECHO_TIMES = (14., 30., 46.)
+
+
+def make_ppg(duration=DURATION, samplerate=SAMPLERATE, rate=1.1, seed=0):
+    """
+    Generates a PPG-like trace: a pulse train whose rate drifts
+    slowly around `rate` Hz, plus baseline wander and noise.
+
+    Inputs
+    ------
+    duration: float
+        (Optional) length of the trace, in seconds.
+    samplerate: int
+        (Optional) sampling frequency, in Hz.
+    rate: float
+        (Optional) mean heart rate, in Hz.
+    seed: int
+        (Optional) seed of the random number generator.
+
+    Outputs
+    -------
+    array-like
+        the sampled trace
+    """
+    rng = np.random.RandomState(seed)
+    t = np.arange(0, duration, 1. / samplerate)
+    inst_rate = rate * (1 + 0.1 * np.sin(2 * np.pi * t / 60.))
+    phase = 2 * np.pi * np.cumsum(inst_rate) / samplerate
+    pulse = np.maximum(np.sin(phase), 0) ** 3
+    wander = 0.2 * np.sin(2 * np.pi * 0.05 * t)
+    return pulse + wander + 0.03 * rng.randn(len(t))
+
+
+def make_resp(duration=DURATION, samplerate=SAMPLERATE, rate=0.25, seed=0):
+    """
+    Generates a respiratory belt trace: a slow oscillation around
+    `rate` Hz with a drifting depth, plus noise.
+
+    Inputs
+    ------
+    duration: float
+        (Optional) length of the trace, in seconds.
+    samplerate: int
+        (Optional) sampling frequency, in Hz.
+    rate: float
+        (Optional) mean breathing rate, in Hz.
+    seed: int
+        (Optional) seed of the random number generator.
+
+    Outputs
+    -------
+    array-like
+        the sampled trace
+    """
+    rng = np.random.RandomState(seed)
+    t = np.arange(0, duration, 1. / samplerate)
+    depth = 1 + 0.3 * np.sin(2 * np.pi * t / 90.)
+    inst_rate = rate * (1 + 0.15 * np.sin(2 * np.pi * t / 45.))
+    phase = 2 * np.pi * np.cumsum(inst_rate) / samplerate
+    return depth * np.sin(phase) + 0.05 * rng.randn(len(t))
+
+
+def make_image(out_file, shape=(64, 64, 32), n_vols=215, tr=TR, te=None,
+               seed=0):
+    """
+    Writes a 4D image of slowly drifting noise around a brain-like
+    ellipsoid, decaying with echo time `te` when given.
+
+    Inputs
+    ------
+    out_file: file
+        name of the 4D NIfTI image
+    shape: tuple
+        (Optional) spatial shape of the image.
+    n_vols: int
+        (Optional) number of volumes.
+    tr: float
+        (Optional) repetition time, in seconds.
+    te: float
+        (Optional) echo time, in ms.
+    seed: int
+        (Optional) seed of the random number generator.
+
+    Outputs
+    -------
+    out_file: file
+        the 4D NIfTI image
+    """
+    rng = np.random.RandomState(seed)
+    grid = np.meshgrid(*[np.linspace(-1, 1, n) for n in shape],
+                       indexing='ij')
+    brain = sum(g ** 2 for g in grid) < 0.8
+    mean = np.where(brain, 1000., 20.).astype(np.float32)
+    if te is not None:
+        mean *= np.exp(-te / 40.)
+
+    drift = np.linspace(0, 1, n_vols, dtype=np.float32)
+    data = (mean[..., np.newaxis] * (1 + 0.01 * drift) +
+            rng.standard_normal(shape + (n_vols,)).astype(np.float32) * 10)
+
+    img = nib.Nifti1Image(data, np.diag([3., 3., 3., 1.]))
+    img.header.set_xyzt_units('mm', 'sec')
+    img.header.set_zooms((3., 3., 3., tr))
+    img.to_filename(out_file)
+    return out_file
+
+
+def make_dmat(out_file, images, n_conds=2, n_vols=215, block=5, seed=0):
+    """
+    Writes a PLS datamat text file with one session per image
+    and `n_conds` conditions, with onsets in volumes.
+
+    Inputs
+    ------
+    out_file: file
+        name of the datamat text file
+    images: list
+        image names, one per run
+    n_conds: int
+        (Optional) number of conditions.
+    n_vols: int
+        (Optional) number of volumes per run.
+    block: int
+        (Optional) number of volumes per block.
+    seed: int
+        (Optional) seed of the random number generator.
+
+    Outputs
+    -------
+    out_file: file
+        the datamat text file
+    """
+    rng = np.random.RandomState(seed)
+    lines = ['prefix\tsynthetic']
+    for image in images:
+        lines.append('data_files\t{}'.format(image))
+        onsets = rng.permutation(np.arange(0, n_vols - block, 2 * block))
+        for cond in np.array_split(onsets, n_conds):
+            lines.append('\t'.join(['block_onsets'] +
+                                   [str(o) for o in sorted(cond)]))
+        lines.append('block_length\t' + '\t'.join([str(block)] * n_conds))
+    with open(out_file, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return out_file
+
+
+def make_dataset(data_dir, n_subjects=2, n_runs=2, n_echoes=1,
+                 shape=(64, 64, 32), n_vols=215, seed=0):
+    """
+    Builds a synthetic dataset in the layout read by `gather_inputs`.
+
+    Inputs
+    ------
+    data_dir: str
+        root folder of the dataset
+    n_subjects: int
+        (Optional) number of subjects.
+    n_runs: int
+        (Optional) number of runs per subject.
+    n_echoes: int
+        (Optional) number of echoes per run.
+    shape: tuple
+        (Optional) spatial shape of the images.
+    n_vols: int
+        (Optional) number of volumes per run.
+    seed: int
+        (Optional) seed of the random number generators.
+
+    Outputs
+    -------
+    list
+        the subject identifiers
+    """
+    subjects = []
+    for s in range(n_subjects):
+        subj = 'sub-{:02d}'.format(s + 1)
+        subj_dir = os.path.join(data_dir, subj)
+        os.makedirs(subj_dir, exist_ok=True)
+        subjects.append(subj)
+
+        runs = []
+        for r in range(n_runs):
+            run = 'run{}'.format(r + 1)
+            stem = os.path.join(subj_dir, '{}_{}'.format(subj, run))
+            tes = ECHO_TIMES[:n_echoes] if n_echoes > 1 else [None]
+            for e, te in enumerate(tes):
+                echo = '_echo-{}'.format(e + 1) if te is not None else ''
+                make_image('{}{}.nii.gz'.format(stem, echo), shape, n_vols,
+                           te=te, seed=seed + r)
+            np.savetxt(os.path.join(subj_dir, '{}_ECG_{}.1D'.format(subj,
+                                                                   run)),
+                       make_ppg(seed=seed + r), fmt='%.5f')
+            np.savetxt(os.path.join(subj_dir, '{}_Resp_{}.1D'.format(subj,
+                                                                    run)),
+                       make_resp(seed=seed + r), fmt='%.5f')
+            runs.append('{}_{}.nii'.format(subj, run))
+        make_dmat(os.path.join(subj_dir, '{}_dmat.txt'.format(subj)), runs,
+                  n_vols=n_vols, seed=seed + s)
+    return subjects
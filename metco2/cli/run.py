@@ -1,10 +1,19 @@
 import os
-import numpy as np
+import sys
+from functools import partial
 from argparse import (ArgumentParser, RawTextHelpFormatter)
 
-from ..workflows import init_metco2_wf
-from ..utils.physio import convolve_ts
-from ..utils.misc import (create_subj_list, gather_inputs)
+from ..utils.misc import create_subj_list
+from ..utils.cache import RegressorCache
+from ..utils.index import DatasetIndex
+from ..utils.report import RunReport
+from ..utils.qc import (preflight, write_summary, merge_summaries)
+from ..utils.registry import STIM_MODEL
+from ..utils.scheduler import (collect_jobs, pending_jobs, confound_job,
+                               run_job, run_jobs, prefetch_images)
+from ..utils.shm import SharedStore
+from ..utils.shard import (parse_shard, shard_jobs, shard_prefix,
+                           merge_reports, launch_local_array)
 
 
 def get_parser():
@@ -15,8 +24,11 @@ def get_parser():
 
     verstr = 'metco2 v{}'.format(__version__)
 
+    # no abbreviated options: --local-array must be stripped exactly from
+    # the arguments passed on to the shards, or they would relaunch
     parser = ArgumentParser(description='MEtCO2',
-                            formatter_class=RawTextHelpFormatter)
+                            formatter_class=RawTextHelpFormatter,
+                            allow_abbrev=False)
 
     # Arguments as specified by BIDS-Apps-- for eventual MEtCO2 BIDS App
     parser.add_argument('data_dir', action='store',
@@ -33,9 +45,143 @@ def get_parser():
     g_data.add_argument('--participant_label', '--participant-label',
                         action='store', nargs='+',
                         help='one or more participant identifiers.')
+    g_data.add_argument('--index_file', '--index-file', action='store',
+                        default=None,
+                        help='persist the dataset index to this file and '
+                             'reuse it\nwhile the dataset folders are '
+                             'unchanged.')
+
+    g_model = parser.add_argument_group('Options for the regression model')
+    g_model.add_argument('--stim_model', '--stim-model', action='store',
+                         default=STIM_MODEL,
+                         help='AFNI response model of the task regressors '
+                              '(default: {}).'.format(STIM_MODEL))
+    g_model.add_argument('--physio_start', '--physio-start', action='store',
+                         type=float, default=8.0,
+                         help='time of the first volume within the physio '
+                              'recordings,\nin seconds (default: 8.0). '
+                              'TR and volume counts are\nread from the '
+                              'image headers.')
+    g_model.add_argument('--physio_method', '--physio-method', action='store',
+                         choices=['peakdet', 'numpy'], default='peakdet',
+                         help='derive iHR and RVT with peakdet, or with the '
+                              'vectorized\nNumPy implementation, which '
+                              'streams each recording in\nfixed windows '
+                              '(default: peakdet).')
+
+    g_me = parser.add_argument_group('Options for multi-echo data')
+    g_me.add_argument('--echo_times', '--echo-times', action='store',
+                      nargs='+', type=float, default=None,
+                      help='echo times of each run, in ascending echo order;\n'
+                           'if given, an optimally combined image is '
+                           'also written.')
+
+    g_model.add_argument('--mask', action='store', default=None,
+                         help='correct only the voxels within this 3D '
+                              'mask image, or\n"auto" for a mask of '
+                              'voxels above 20%% of the (98th\n'
+                              'percentile) mean signal of the first '
+                              'echo; outputs are\nzero outside the mask '
+                              '(default: all voxels).')
+
+    g_out = parser.add_argument_group('Options for outputs')
+    g_out.add_argument('--output_format', '--output-format', action='store',
+                       choices=['nii.gz', 'nii', 'fastgz', 'zarr'],
+                       default='nii.gz',
+                       help='format of the written images: gzipped NIfTI, '
+                            'uncompressed\nNIfTI, multithreaded fast gzip '
+                            'NIfTI or a zarr store\nchunked by slice '
+                            '(requires zarr) (default: nii.gz).')
+    g_out.add_argument('--save_fit', '--save-fit', action='store_true',
+                       help='also write the regression coefficients '
+                            '(cbucket) and fit\nstatistics of each echo to '
+                            '<output_dir>/<subject>/phys_fit.')
+
+    g_qc = parser.add_argument_group('Options for quality control')
+    g_qc.add_argument('--qc', action='store',
+                      choices=['reject', 'flag', 'off'], default='reject',
+                      help='check every run\'s physio, images and events '
+                           'before\nprocessing any: "reject" skips the runs '
+                           'failing a check,\n"flag" only reports them, '
+                           '"off" skips the checks\n(default: reject). '
+                           'Results are written to\n'
+                           '<output_dir>/reports/metco2_qc.json.')
+    g_qc.add_argument('--qc_only', '--qc-only', action='store_true',
+                      help='only run the checks and write their summary.')
+
+    g_perfm = parser.add_argument_group('Options to handle performance')
+    g_perfm.add_argument('--resume', action='store_true',
+                         help='skip runs whose manifest records a completed '
+                              'workflow with\nunchanged inputs and '
+                              'parameters.')
+    g_perfm.add_argument('--nprocs', '--n_procs', '--n-procs',
+                         action='store', type=int, default=None,
+                         help='maximum number of runs processed concurrently\n'
+                              '(default: number of CPUs).')
+    g_perfm.add_argument('--mem_gb', '--mem-gb', action='store', type=float,
+                         default=None,
+                         help='memory budget shared by all concurrent runs, '
+                              'in GB\n(default: no limit).')
+    g_perfm.add_argument('--chunk_mem_gb', '--chunk-mem-gb', action='store',
+                         type=float, default=None,
+                         help='correct each image out-of-core, in slabs '
+                              'fitting this\nmemory budget, in GB '
+                              '(default: load whole images).')
+    g_perfm.add_argument('--prefetch', action='store', type=int, default=0,
+                         help='decompress the images of up to this many '
+                              'queued runs\nahead of their turn, keeping '
+                              'uncompressed copies in\n'
+                              '<output_dir>/cache/nifti until the run ends '
+                              '(default: 0).')
+    g_perfm.add_argument('--cache_dir', '--cache-dir', action='store',
+                         default=None,
+                         help='directory caching derived physio confounds\n'
+                              '(default: <output_dir>/cache).')
+    g_perfm.add_argument('--cache_gb', '--cache-gb', action='store',
+                         type=float, default=1.,
+                         help='size budget of the confound cache, in GB; '
+                              'least recently\nused entries are evicted '
+                              'first (default: 1).')
+
+    g_array = parser.add_argument_group('Options for array jobs')
+    g_array.add_argument('--shard', action='store', default=None,
+                         help='process only shard "i/N" (i counting from 0) '
+                              'of the runs,\nbalanced by image size; "env" '
+                              'reads i and N from the\nSlurm job-array '
+                              'environment variables.')
+    g_array.add_argument('--merge_shards', '--merge-shards',
+                         action='store_true',
+                         help='merge the reports of all shards of the latest '
+                              'array and list\nincomplete runs and missing '
+                              'shards, instead of processing.')
+    g_array.add_argument('--local_array', '--local-array', action='store',
+                         type=int, default=None,
+                         help='emulate a job array of this many shards with '
+                              'local\nsubprocesses, then merge them.')
+
+    g_report = parser.add_argument_group('Options for run reports')
+    g_report.add_argument('--profile', action='store_true',
+                          help='profile every stage with cProfile and dump '
+                               'the slowest one\nnext to the run report.')
     return parser
 
 
+def _strip_option(argv, option):
+    """
+    Removes `option` and its value from a list of arguments.
+    """
+    names = [option, option.replace('_', '-')]
+    stripped, skip = [], False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in names:
+            skip = True
+        elif not any(arg.startswith(n + '=') for n in names):
+            stripped.append(arg)
+    return stripped
+
+
 def main():
     """
     Entry point.
@@ -43,44 +189,151 @@ def main():
     from ..info import __version__
     opts = get_parser().parse_args()
 
+    if opts.local_array:
+        argv = _strip_option(_strip_option(sys.argv[1:], '--local_array'),
+                             '--shard')
+        codes = launch_local_array(argv + ['--shard', 'env'],
+                                   opts.local_array)
+        opts.merge_shards = True
+
     output_dir = os.path.abspath(opts.output_dir)
     os.makedirs(output_dir, exist_ok=True)
     data_dir = os.path.abspath(opts.data_dir)
+    if opts.mask not in (None, 'auto'):
+        opts.mask = os.path.abspath(opts.mask)
 
-    subjects = create_subj_list(opts.data_dir,
-                                selected=opts.participant_label)
+    index = DatasetIndex(data_dir, index_file=opts.index_file)
+    subjects = create_subj_list(data_dir, selected=opts.participant_label,
+                                index=index)
 
     init_msg = """
     Running MEtCO2 version {version}:
       * BIDS dataset path: {data_dir}.
       * Output path: {output_dir}
       * Participant list: {participant_list}.
+      * Concurrent runs: {n_procs}.
     """.format
 
     print(init_msg(version=__version__,
                    data_dir=data_dir,
                    output_dir=output_dir,
-                   participant_list=subjects))
-
-    for subj in subjects:
-        images, physio, events = gather_inputs(data_dir, subj)
-        for i, image in enumerate(images):
-            run = image.split('.')[0].split('_')[1]  # some non-BIDS ugliness
-
-            hr, resp = [convolve_ts(p) for p in physio[i]]
-            confounds_fname = os.path.join(data_dir, subj,
-                                           '{}_confounds_{}.txt'.format(subj,
-                                                                        run))
-            np.savetxt(confounds_fname, np.transpose([hr, resp]), fmt='%10.5f')
-
-            workflow = init_metco2_wf(images[i], events[i], confounds_fname,
-                                      subj, output_dir)
-            # for debugging:
-            # workflow.config['execution'] = {'remove_unnecessary_outputs': False,
-            #                                 'keep_inputs': True,
-            #                                 'try_hard_link_datasink': False}
-            workflow.write_graph(graph2use='flat')
-            workflow.run('MultiProc', plugin_args={'n_procs': 6})
+                   participant_list=subjects,
+                   n_procs=opts.nprocs or os.cpu_count()))
+
+    if opts.merge_shards:
+        jobs = collect_jobs(data_dir, subjects, index=index,
+                            physio_start=opts.physio_start)
+        _, missing = merge_reports(os.path.join(output_dir, 'reports'),
+                                   count=opts.local_array)
+        merge_summaries(os.path.join(output_dir, 'reports'),
+                        count=opts.local_array)
+        for shard in missing:
+            print('Missing report of shard {}.'.format(shard))
+        incomplete = pending_jobs(jobs, output_dir, opts.echo_times,
+                                  opts.output_format, opts.save_fit,
+                                  opts.stim_model, opts.mask,
+                                  opts.physio_method)
+        for job in incomplete:
+            print('Incomplete: {} {}'.format(job.subject, job.run))
+        print('Merged shards: {} of {} runs complete.'.format(
+            len(jobs) - len(incomplete), len(jobs)))
+        if incomplete or missing or (opts.local_array and any(codes)):
+            raise RuntimeError('{} of {} runs incomplete, {} shard reports '
+                               'missing.'.format(len(incomplete), len(jobs),
+                                                 len(missing)))
+        return
+
+    report = RunReport(profile=opts.profile)
+    report_prefix, qc_prefix = 'metco2_report', 'metco2_qc'
+    rejected, jobs, nifti_cache = [], [], None
+    try:
+        jobs = collect_jobs(data_dir, subjects,
+                            chunk_mem_gb=opts.chunk_mem_gb, report=report,
+                            index=index, physio_start=opts.physio_start)
+        if opts.shard is not None:
+            shard, n_shards = parse_shard(opts.shard)
+            jobs = shard_jobs(jobs, shard, n_shards)
+            report_prefix = shard_prefix(shard, n_shards, report_prefix)
+            qc_prefix = shard_prefix(shard, n_shards, qc_prefix)
+            print('Shard {} of {}: {} runs.'.format(shard, n_shards,
+                                                    len(jobs)))
+        if opts.resume:
+            n_jobs = len(jobs)
+            jobs = pending_jobs(jobs, output_dir, opts.echo_times,
+                                opts.output_format, opts.save_fit,
+                                opts.stim_model, opts.mask,
+                                opts.physio_method)
+            print('Resuming: {} of {} runs already complete.'.format(
+                n_jobs - len(jobs), n_jobs))
+        if opts.qc != 'off' or opts.qc_only:
+            # cheap checks of every run, before any is processed
+            with report.stage('qc'):
+                results = preflight(jobs, n_procs=opts.nprocs,
+                                    echo_times=opts.echo_times)
+            write_summary(results, os.path.join(output_dir, 'reports',
+                                                qc_prefix + '.json'))
+            for job, result in zip(jobs, results):
+                for check in result.checks:
+                    if check.status != 'pass':
+                        print('QC {}: {} {} {}: {} {}'.format(
+                            check.status.upper(), job.subject, job.run,
+                            check.name, check.item, check.message))
+            rejected = [job for job, result in zip(jobs, results)
+                        if result.status == 'fail']
+            print('QC: {} of {} runs failed.'.format(len(rejected),
+                                                     len(jobs)))
+            if opts.qc_only:
+                if rejected:
+                    raise RuntimeError('{} of {} runs failed QC.'.format(
+                        len(rejected), len(jobs)))
+                return
+            if opts.qc == 'reject':
+                jobs = [job for job in jobs if job not in rejected]
+            else:
+                rejected = []
+        cache = RegressorCache(opts.cache_dir or
+                               os.path.join(output_dir, 'cache'),
+                               max_bytes=int(opts.cache_gb * 1024 ** 3))
+        prefetch = None
+        if opts.prefetch > 0:
+            nifti_cache = os.path.join(output_dir, 'cache', 'nifti')
+            prefetch = partial(prefetch_images, cache_dir=nifti_cache)
+        # design matrices are built once, while deriving confounds, and
+        # memory-mapped by the workflows from shared memory
+        with SharedStore(os.path.join(output_dir, report_prefix)) as shared:
+            failed = run_jobs(
+                jobs, partial(run_job, output_dir=output_dir,
+                              chunk_mem_gb=opts.chunk_mem_gb,
+                              echo_times=opts.echo_times,
+                              profile=opts.profile,
+                              output_format=opts.output_format,
+                              save_fit=opts.save_fit,
+                              stim_model=opts.stim_model,
+                              shared_dir=shared.root, mask=opts.mask,
+                              cache_dir=nifti_cache),
+                n_procs=opts.nprocs, mem_gb=opts.mem_gb,
+                callback=lambda job, r: report.merge(r),
+                prefetch=prefetch, prefetch_depth=opts.prefetch,
+                prepare=partial(confound_job, cache=cache,
+                                output_dir=output_dir,
+                                physio_method=opts.physio_method,
+                                shared_dir=shared.root,
+                                stim_model=opts.stim_model))
+    finally:
+        # the confounds files and physio sidecars are written into the
+        # subject folders, also by QC alone: persist the index as it
+        # now stands for the next run
+        index.save()
+        if nifti_cache is not None:
+            from ..utils.nifti import remove_copies
+            # copies still being prefetched when their run started
+            for job in jobs:
+                remove_copies(job.images, nifti_cache)
+        report.write(os.path.join(output_dir, 'reports'), report_prefix)
+    if failed or rejected:
+        raise RuntimeError('{} of {} runs failed, {} more rejected by '
+                           'QC.'.format(len(failed), len(jobs),
+                                        len(rejected)))
 
 
 if __name__ == "__main__":
@@ -16,6 +16,7 @@ Copyright:  2015-2016  DueCredit developers
 License:    BSD-2
 """
 
+import os
 from builtins import str
 from builtins import object
 __version__ = '0.0.5'
@@ -44,17 +45,23 @@ def _donothing_func(*args, **kwargs):
     pass
 
 
-try:
-    from duecredit import due, BibTeX, Doi, Url
-    if 'due' in locals() and not hasattr(due, 'cite'):
-        raise RuntimeError(
-            "Imported due lacks .cite. DueCredit is now disabled")
-except Exception as e:
-    if type(e).__name__ != 'ImportError':
-        import logging
-        logging.getLogger("duecredit").error(
-            "Failed to import duecredit due to %s" % str(e))
-    # Initiate due stub
+# duecredit only collects citations when DUECREDIT_ENABLE is set, so
+# don't pay for importing it otherwise
+if os.environ.get('DUECREDIT_ENABLE', '').lower() in ('1', 'yes', 'true'):
+    try:
+        from duecredit import due, BibTeX, Doi, Url
+        if 'due' in locals() and not hasattr(due, 'cite'):
+            raise RuntimeError(
+                "Imported due lacks .cite. DueCredit is now disabled")
+    except Exception as e:
+        if not isinstance(e, ImportError):
+            import logging
+            logging.getLogger("duecredit").error(
+                "Failed to import duecredit due to %s" % str(e))
+        # Initiate due stub
+        due = InactiveDueCreditCollector()
+        BibTeX = Doi = Url = _donothing_func
+else:
     due = InactiveDueCreditCollector()
     BibTeX = Doi = Url = _donothing_func
 
@@ -24,6 +24,7 @@ DOWNLOAD_URL = (
 
 REQUIRES = [
     'numpy',
+    'nibabel',
     'nipype',
     'scipy'
 ]
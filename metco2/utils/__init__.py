@@ -1,17 +1,36 @@
 # -*- coding: utf-8 -*-
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 sw=4 et:
-# pylint: disable=unused-import
+"""
+Submodules are imported on first attribute access, so that importing
+`metco2.utils` (e.g. from the CLI) does not load numpy or peakdet.
+"""
+from importlib import import_module
 
-from .misc import (
-    create_subj_list,
-    gather_inputs
-)
+_EXPORTS = {
+    'create_subj_list': 'misc',
+    'gather_inputs': 'misc',
+    'convolve_ts': 'physio',
+    'convolve_batch': 'physio',
+    'PhysioCorrector': 'correct',
+    'parse_dmat': 'file_manip',
+    'run_onsets': 'file_manip',
+    'write_stim_times': 'file_manip',
+    'sort_and_write': 'file_manip',
+    'split_dmat_txt': 'file_manip',
+}
 
-from .physio import convolve_ts
+__all__ = sorted(_EXPORTS)
 
-from .file_manip import (
-    sort_and_write,
-    split_dmat_txt
 
-)
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError('module {!r} has no attribute '
+                             '{!r}'.format(__name__, name))
+    value = getattr(import_module('.' + _EXPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
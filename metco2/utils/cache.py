@@ -0,0 +1,117 @@
+import os
+import json
+import hashlib
+
+# default on-disk budget for cached regressors, in bytes
+MAX_BYTES = 1024 ** 3
+# eviction frees space down to this fraction of the budget, so that
+# a full cache is only scanned once per that many bytes written
+LOW_WATER = 0.9
+
+
+class RegressorCache(object):
+    """
+    Content-addressed, on-disk cache of derived confound regressors.
+
+    Entries are keyed by a hash of the raw physio file contents and
+    every parameter used to derive them, and are stored as `.npy`
+    files. Once the cache exceeds `max_bytes`, the least recently
+    used entries are evicted. Its size is tracked as entries are
+    written, so the directory is only scanned to evict.
+
+    Parameters
+    ----------
+    cache_dir: str
+        Directory holding the cached regressors.
+    max_bytes: int
+        (Optional) size budget for the cache, in bytes.
+        Defaults to 1 GB.
+    """
+    def __init__(self, cache_dir, max_bytes=MAX_BYTES):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # running size of the entries, scanned from disk on first put
+        # and whenever it exceeds the budget; entries written by other
+        # processes are only counted at those scans
+        self._total = None
+
+    def key(self, physio_f, **params):
+        """
+        Hashes the contents of `physio_f` together with `params`.
+        """
+        digest = hashlib.sha256()
+        with open(physio_f, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        digest.update(json.dumps(params, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        Returns the cached regressor for `key`, or None on a miss.
+        """
+        import numpy as np
+
+        fname = self._path(key)
+        try:
+            data = np.load(fname)
+        except (IOError, OSError, ValueError):
+            return None
+        try:
+            os.utime(fname)  # mark as recently used
+        except OSError:  # evicted by another worker since: still a hit
+            pass
+        return data
+
+    def put(self, key, data):
+        """
+        Stores `data` under `key`, evicting old entries if needed.
+        """
+        import numpy as np
+
+        fname = self._path(key)
+        if self._total is None:
+            self._total = self._scan()[0]
+        try:
+            self._total -= os.path.getsize(fname)  # replaced below
+        except OSError:
+            pass
+        tmp = '{}.{}.tmp'.format(fname, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.save(f, np.asarray(data))
+        os.replace(tmp, fname)  # atomic, so concurrent readers are safe
+        self._total += os.path.getsize(fname)
+        if self._total > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache
+        fits within `LOW_WATER` of `max_bytes`.
+        """
+        total, entries = self._scan()
+        for _, size, path in sorted(entries):
+            if total <= LOW_WATER * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        self._total = total
+
+    def _scan(self):
+        """
+        Lists the entries on disk, as (mtime, size, path) tuples,
+        with their total size.
+        """
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npy'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return sum(size for _, size, _ in entries), entries
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
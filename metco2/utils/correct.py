@@ -0,0 +1,273 @@
+import numpy as np
+from .glm import (POLORT, CHUNK_SIZE, design_matrix, regressor_labels,
+                  remove_confounds, remove_confounds_group)
+from .physio import (SAMPLERATE, traces_to_confounds)
+from .registry import (ATTA, STIM_MODEL, Acquisition)
+
+
+class PhysioCorrector(object):
+    """
+    Removes physiological confounds from BOLD data held in memory,
+    without reading or writing any file.
+
+    `fit` builds the design matrix of a run (polynomial baseline,
+    task regressors and physio confounds) and its pseudo-inverse;
+    `transform` fits it to every voxel and removes the confound
+    portion of the fit, as `glm.correct_echoes` does for images.
+    A fitted design can be applied to many runs: confounds given
+    to `transform` replace those of the fit, reusing its baseline
+    and task regressors. `transform_group` corrects many such runs
+    (e.g. every subject of a protocol) in one batch.
+
+    Parameters
+    ----------
+    tr: float
+        repetition time of the runs, in seconds
+    stim_model: str
+        (Optional) AFNI response model of the task regressors.
+        Defaults to 'BLOCK(10,1)'.
+    polort: int
+        (Optional) order of the polynomial baseline. Defaults to 1.
+    physio_start: float
+        (Optional) time of the first volume within the physio
+        traces, in seconds. Defaults to 8.0 seconds.
+    samplerate: int
+        (Optional) sampling frequency of the physio traces.
+        Defaults to 40Hz.
+    chunk_size: int
+        (Optional) number of voxels solved per batch.
+
+    Attributes
+    ----------
+    X_: array-like
+        the fitted design matrix, of shape (n_vols, n_regressors)
+    is_confound_: array-like
+        boolean mask over the columns of `X_` marking the confounds
+    labels_: list
+        labels of the columns of `X_`, as in 3dDeconvolve's cbucket
+    trace_columns_: dict
+        index among the confounds of the iHR ('ppg') and RVT ('resp')
+        confounds, which traces given to `transform` replace. Fitted
+        confounds are taken as iHR then RVT when there are two of them.
+    """
+    def __init__(self, tr, stim_model=STIM_MODEL, polort=POLORT,
+                 physio_start=ATTA.start, samplerate=SAMPLERATE,
+                 chunk_size=CHUNK_SIZE):
+        self.tr = float(tr)
+        self.stim_model = stim_model
+        self.polort = polort
+        self.physio_start = float(physio_start)
+        self.samplerate = samplerate
+        self.chunk_size = chunk_size
+
+    def fit(self, n_vols, events=None, confounds=None, ppg=None,
+            resp=None):
+        """
+        Builds the design matrix of a run.
+
+        Inputs
+        ------
+        n_vols: int
+            number of volumes of the runs
+        events: list
+            (Optional) onsets (in seconds) or AFNI timing files,
+            one per condition
+        confounds: array-like
+            (Optional) physio confounds, of shape
+            (n_vols, n_confounds); required unless traces are given
+        ppg: array-like
+            (Optional) PPG trace, to derive the iHR confound from
+        resp: array-like
+            (Optional) respiratory belt trace, to derive the RVT
+            confound from
+
+        Outputs
+        -------
+        PhysioCorrector
+            self
+        """
+        from ..workflows.model import _gen_stim_list
+
+        self.acquisition_ = Acquisition(self.tr, int(n_vols),
+                                        self.physio_start)
+        self.stim_tuples_ = _gen_stim_list(events or [], self.stim_model)
+        fitted = self._confounds(confounds, ppg, resp)
+        self.X_, self.is_confound_ = design_matrix(
+            self.stim_tuples_, fitted, self.acquisition_.n_vols, self.tr,
+            polort=self.polort)
+        if confounds is None:
+            kinds = [k for k, t in (('ppg', ppg), ('resp', resp))
+                     if t is not None]
+        else:  # as ordered by `traces_to_confounds` and confound files
+            kinds = ['ppg', 'resp'] if fitted.shape[1] == 2 else []
+        self.trace_columns_ = dict((k, i) for i, k in enumerate(kinds))
+        self.X_.setflags(write=False)
+        self._pinv = np.linalg.pinv(self.X_)
+        self.labels_ = regressor_labels(self.stim_tuples_, self.is_confound_,
+                                        self.polort)
+        return self
+
+    def transform(self, data, confounds=None, ppg=None, resp=None,
+                  fit_stats=False):
+        """
+        Removes the confounds from `data`.
+
+        Inputs
+        ------
+        data: array-like
+            voxel time series, of shape (..., n_vols), e.g. a 4D
+            image or (n_voxels, n_vols)
+        confounds: array-like
+            (Optional) confounds of this run, replacing those of
+            the fit.
+        ppg: array-like
+            (Optional) PPG trace of this run, replacing the fitted
+            iHR confound only.
+        resp: array-like
+            (Optional) respiratory belt trace of this run, replacing
+            the fitted RVT confound only.
+        fit_stats: bool
+            (Optional) also return the statistics in
+            `glm.STAT_NAMES`.
+
+        Outputs
+        -------
+        corrected: array-like
+            confound-corrected data, with the shape of `data`
+        betas: array-like
+            regression coefficients, of shape (..., n_regressors)
+        stats: array-like
+            only if `fit_stats`: fit statistics, of shape
+            (..., len(STAT_NAMES))
+        """
+        if not hasattr(self, 'X_'):
+            raise RuntimeError('PhysioCorrector is not fitted; call fit '
+                               'first.')
+        data = np.asanyarray(data)
+        n_vols = self.acquisition_.n_vols
+        if data.shape[-1] != n_vols:
+            raise ValueError('Data has {} volumes, the design {}.'.format(
+                data.shape[-1], n_vols))
+
+        X, pinv = self.X_, self._pinv
+        if confounds is not None or ppg is not None or resp is not None:
+            X = self.X_.copy()
+            X[:, self.is_confound_] = self._run_confounds(confounds, ppg,
+                                                          resp)
+            pinv = np.linalg.pinv(X)
+
+        result = remove_confounds(data.reshape(-1, n_vols), X,
+                                  self.is_confound_, self.chunk_size,
+                                  fit_stats=fit_stats, pinv=pinv)
+        voxels = data.shape[:-1]
+        return ((result[0].reshape(data.shape),) +
+                tuple(r.reshape(voxels + r.shape[-1:]) for r in result[1:]))
+
+    def transform_group(self, data, confounds=None, ppg=None, resp=None,
+                        fit_stats=False):
+        """
+        Removes the confounds from many runs sharing the fitted
+        baseline and task regressors, each with its own confounds,
+        see `glm.remove_confounds_group`. The shared regressors are
+        projected out of all runs at once, so this is much cheaper
+        than calling `transform` on each run.
+
+        Inputs
+        ------
+        data: list
+            voxel time series of each run, of shape (..., n_vols)
+        confounds: list
+            (Optional) confounds of each run.
+        ppg: list
+            (Optional) PPG trace of each run, to derive the iHR
+            confound from; the other confounds are the fitted ones.
+        resp: list
+            (Optional) respiratory belt trace of each run, to
+            derive the RVT confound from; the other confounds are
+            the fitted ones.
+        fit_stats: bool
+            (Optional) also return the statistics in
+            `glm.STAT_NAMES`.
+
+        Outputs
+        -------
+        list
+            per run, the outputs of `transform`
+        """
+        if not hasattr(self, 'X_'):
+            raise RuntimeError('PhysioCorrector is not fitted; call fit '
+                               'first.')
+        data = [np.asanyarray(d) for d in data]
+        n_vols = self.acquisition_.n_vols
+        for d in data:
+            if d.shape[-1] != n_vols:
+                raise ValueError('Data has {} volumes, the design {}.'.format(
+                    d.shape[-1], n_vols))
+        given = [c for c in (confounds, ppg, resp) if c is not None]
+        if any(len(c) != len(data) for c in given):
+            raise ValueError('Expected confounds or traces for each of the '
+                             '{} runs.'.format(len(data)))
+
+        run_confounds = []
+        for i in range(len(data)):
+            if not given:
+                run_confounds.append(self.X_[:, self.is_confound_])
+                continue
+            run_confounds.append(self._run_confounds(
+                *(None if c is None else c[i]
+                  for c in (confounds, ppg, resp))))
+
+        results = remove_confounds_group([d.reshape(-1, n_vols)
+                                          for d in data],
+                                         self.X_[:, ~self.is_confound_],
+                                         run_confounds, self.chunk_size,
+                                         fit_stats=fit_stats)
+        return [((r[0].reshape(d.shape),) +
+                 tuple(x.reshape(d.shape[:-1] + x.shape[-1:])
+                       for x in r[1:]))
+                for d, r in zip(data, results)]
+
+    def fit_transform(self, data, events=None, confounds=None, ppg=None,
+                      resp=None, fit_stats=False):
+        """
+        Fits the design of a run and removes its confounds from
+        `data`, see `fit` and `transform`.
+        """
+        data = np.asanyarray(data)
+        return self.fit(data.shape[-1], events, confounds, ppg,
+                        resp).transform(data, fit_stats=fit_stats)
+
+    def _confounds(self, confounds, ppg, resp):
+        """
+        Returns the given confounds, or derives them from traces.
+        """
+        n_vols = self.acquisition_.n_vols
+        if confounds is not None:
+            return np.asarray(confounds, dtype=float).reshape(n_vols, -1)
+        if ppg is None and resp is None:
+            raise ValueError('Confounds or physio traces are required.')
+        return traces_to_confounds(ppg, resp, self.acquisition_,
+                                   self.samplerate)
+
+    def _run_confounds(self, confounds, ppg, resp):
+        """
+        Returns the confounds of a run: the given ones, or the fitted
+        ones with those derived from the given traces spliced in.
+        """
+        n_confounds = int(self.is_confound_.sum())
+        if confounds is not None:
+            confounds = self._confounds(confounds, None, None)
+            if confounds.shape[1] != n_confounds:
+                raise ValueError('Expected {} confounds, got {}.'.format(
+                    n_confounds, confounds.shape[1]))
+            return confounds
+        derived = self._confounds(None, ppg, resp)
+        run = self.X_[:, self.is_confound_].copy()
+        kinds = [k for k, t in (('ppg', ppg), ('resp', resp))
+                 if t is not None]
+        for kind, column in zip(kinds, derived.T):
+            if kind not in self.trace_columns_:
+                raise ValueError('The fitted design has no {} confound to '
+                                 'replace.'.format(kind))
+            run[:, self.trace_columns_[kind]] = column
+        return run
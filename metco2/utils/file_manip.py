@@ -1,5 +1,13 @@
 import os
-from operator import itemgetter
+import numpy as np
+from collections import namedtuple
+from .index import RUN_RE
+
+# every onset of a datamat, one record each, plus the number of
+# conditions per run (which may include conditions without onsets)
+EventTimings = namedtuple('EventTimings', ['records', 'n_conditions'])
+TIMING_DTYPE = np.dtype([('run', np.int32), ('condition', np.int32),
+                         ('onset', np.float64)])
 
 
 def split_dmat_txt(fname):
@@ -13,11 +21,10 @@ def split_dmat_txt(fname):
     with open(fname, 'r') as f:
         fparts.extend(f.read().split("data_files"))
 
+    match = ['run', 'block_onsets']
     for part in fparts[1:len(fparts)+1]:
-        runs_only.append(part.strip().split("\n"))
-        for sess in runs_only:
-            match = ['run', 'block_onsets']
-            sess[:] = [l for l in sess if any(list(m in l for m in match))]
+        sess = part.strip().split("\n")
+        runs_only.append([l for l in sess if any(m in l for m in match)])
 
     for sess in range(len(runs_only)):
         for s in range(len(runs_only[sess])):
@@ -32,20 +39,104 @@ def split_dmat_txt(fname):
     return runs_only
 
 
-def sort_and_write(TR_in_S, runs_only, subj):
+def sort_and_write(TR_in_S, runs_only, subj, out_dir=None):
     '''
     Sort runs by chronological order, convert onsets
     to seconds, and pull conditions to text files for AFNI.
+    Files are written to `out_dir` (by default, the folder `subj`
+    of the working directory) and returned as one list per run.
     '''
     TR = float(TR_in_S)
-    runs_only.sort(key=itemgetter(0))
+    runs_only.sort(key=_session_key)
+    out_dir = subj if out_dir is None else out_dir
+    timing_files = []
 
     for i, run in enumerate(runs_only):
+        timing_files.append([])
         for cond in range(1, len(runs_only[i])):
-            with open(os.path.join(subj,
-                                   "{}_run_{}_condition_{}.txt".format(subj,
-                                                                       i+1,
-                                                                       cond)), "a+") as f:
+            timing_files[i].append(os.path.join(
+                out_dir, "{}_run_{}_condition_{}.txt".format(subj, i+1, cond)))
+            with open(timing_files[i][-1], "a+") as f:
                 for onset in runs_only[i][cond]:
-                    if onset is not '':
+                    if onset != '':
                         f.write(''.join(str(int(onset)*TR)) + '\t')
+    return timing_files
+
+
+def parse_dmat(fname, TR_in_S):
+    '''
+    Parse a PLS datamat text file in a single pass into an
+    `EventTimings` of onsets in seconds. Runs are numbered
+    1, 2, ... in the order of the run numbers of their data
+    files (as images are, see `misc.gather_inputs`), and
+    conditions in the order of their `block_onsets` lines.
+    `TR_in_S` is the TR of every run, or a list of the TR of
+    each run in that order.
+    '''
+    with open(fname, 'r') as f:
+        fparts = f.read().split("data_files")[1:]
+
+    sessions = []
+    for part in fparts:
+        lines = [[field for field in l.split("\t") if field != 'block_onsets']
+                 for l in part.strip().split("\n")
+                 if 'run' in l or 'block_onsets' in l]
+        sessions.append(lines)
+    sessions.sort(key=_session_key)
+    if np.ndim(TR_in_S) and len(TR_in_S) != len(sessions):
+        raise ValueError('{} has {} sessions, got the TR of {} '
+                         'runs.'.format(fname, len(sessions), len(TR_in_S)))
+    TRs = np.broadcast_to(np.asarray(TR_in_S, dtype=float), len(sessions))
+
+    records, n_conditions = [], []
+    for run, (sess, TR) in enumerate(zip(sessions, TRs), 1):
+        n_conditions.append(len(sess) - 1)
+        for cond, onsets in enumerate(sess[1:], 1):
+            records.extend((run, cond, int(o) * TR) for o in onsets if o != '')
+    return EventTimings(np.array(records, dtype=TIMING_DTYPE),
+                        np.array(n_conditions, dtype=np.int32))
+
+
+def count_sessions(fname):
+    '''
+    Count the sessions (runs) of a PLS datamat text file.
+    '''
+    with open(fname, 'r') as f:
+        return f.read().count("data_files")
+
+
+def _session_key(session):
+    '''
+    Orders the sessions of a datamat by the run number of their
+    data files, then by name, so that run 10 comes after run 2.
+    '''
+    name = '\t'.join(session[0])
+    run = RUN_RE.search(name)
+    return (int(run.group(1)) if run else 0, name)
+
+
+def run_onsets(timings, run):
+    '''
+    Return the onsets of a run (numbered from 1) of an
+    `EventTimings` as one list of seconds per condition.
+    '''
+    records = timings.records[timings.records['run'] == run]
+    return [records['onset'][records['condition'] == cond].tolist()
+            for cond in range(1, timings.n_conditions[run - 1] + 1)]
+
+
+def write_stim_times(timings, subj, out_dir):
+    '''
+    Write the onsets of an `EventTimings` to one AFNI stimulus
+    timing file per run and condition, for external AFNI steps.
+    Files are overwritten, and returned as one list per run.
+    '''
+    timing_files = []
+    for run in range(1, len(timings.n_conditions) + 1):
+        timing_files.append([])
+        for cond, onsets in enumerate(run_onsets(timings, run), 1):
+            timing_files[-1].append(os.path.join(
+                out_dir, "{}_run_{}_condition_{}.txt".format(subj, run, cond)))
+            with open(timing_files[-1][-1], "w") as f:
+                f.write(''.join(str(o) + '\t' for o in onsets) or '*')
+    return timing_files
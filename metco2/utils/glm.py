@@ -0,0 +1,859 @@
+import os
+import re
+import time
+import shutil
+import tempfile
+import numpy as np
+import nibabel as nib
+from functools import lru_cache
+from . import nifti
+from .registry import STIM_MODEL
+from .pipeline import (read_ahead, BackgroundWriter)
+
+# NOTE: mirrors the 3dDeconvolve defaults used by the original workflow
+POLORT = 1
+CHUNK_SIZE = 20000
+
+# per-voxel fit statistics, in the order of the volumes of a stats image:
+# R^2 of the full model, residual standard deviation and the F statistic
+# of the confounds (against the model without them)
+STAT_NAMES = ['r2', 'resid_sd', 'confound_f']
+
+# the automatic mask keeps voxels whose mean signal exceeds this fraction
+# of the 98th percentile of the mean image of the first echo
+MASK_FRAC = 0.2
+
+
+def read_stim_times(stim_f):
+    """
+    Reads an AFNI-style stimulus timing file.
+
+    Inputs
+    ------
+    stim_f: file
+        A plain-text file of (tab or whitespace separated) onsets,
+        in seconds. AFNI's '*' placeholder is ignored.
+
+    Outputs
+    -------
+    array-like
+        onset times, in seconds
+    """
+    with open(stim_f, 'r') as f:
+        onsets = [float(o) for o in f.read().split() if o != '*']
+    return np.asarray(onsets)
+
+
+@lru_cache()
+def block_response(duration=10., peak=1., dt=0.1):
+    """
+    Generates AFNI's BLOCK(d,p) response: the gamma variate
+    t^4 exp(-t) / (4^4 exp(-4)) convolved with a boxcar of
+    duration `d`, scaled so that its maximum is `p`.
+
+    Inputs
+    ------
+    duration: float
+        (Optional) duration of the block, in seconds.
+        Defaults to 10.0 seconds.
+    peak: float
+        (Optional) amplitude of the response. Defaults to 1.0.
+    dt: float
+        (Optional) temporal resolution of the response, in seconds.
+
+    Outputs
+    -------
+    array-like
+        block response, sampled every `dt` seconds
+    """
+    t = np.arange(0, duration + 15., dt)
+    gamma = t ** 4 * np.exp(-t) / (4 ** 4 * np.exp(-4))
+    boxcar = np.ones(int(round(duration / dt)))
+    resp = np.convolve(gamma, boxcar)[:len(t)] * dt
+    resp = resp * (peak / resp.max())
+    resp.setflags(write=False)  # cached, so shared between callers
+    return resp
+
+
+def stim_regressor(onsets, n_vols, tr, model=STIM_MODEL, dt=0.1):
+    """
+    Builds a single task regressor sampled on the volume grid.
+
+    Inputs
+    ------
+    onsets: array-like
+        onset times, in seconds
+    n_vols: int
+        number of volumes in the MRI time series
+    tr: float
+        repetition time of the MRI time series, in seconds
+    model: str
+        (Optional) AFNI response model. Only BLOCK(d,p) is supported.
+    dt: float
+        (Optional) temporal resolution used for the convolution.
+
+    Outputs
+    -------
+    array-like
+        task regressor of length `n_vols`, read-only as it is
+        shared by all runs with the same onsets and acquisition
+    """
+    return _stim_regressor(tuple(float(o) for o in onsets), int(n_vols),
+                           float(tr), model, dt)
+
+
+@lru_cache(maxsize=1024)
+def _stim_regressor(onsets, n_vols, tr, model, dt):
+    match = re.match(r'BLOCK\(([\d.]+),([\d.]+)\)', model.replace(' ', ''))
+    if match is None:
+        raise ValueError('Unsupported response model: {}'.format(model))
+    duration, peak = [float(m) for m in match.groups()]
+
+    resp = block_response(duration, peak, dt)
+    n_fine = int(round(n_vols * tr / dt))
+    sticks = np.zeros(n_fine)
+    for onset in onsets:
+        idx = int(round(onset / dt))
+        if 0 <= idx < n_fine:
+            sticks[idx] += 1
+    fine = np.convolve(sticks, resp)[:n_fine]
+    regressor = fine[np.round(np.arange(n_vols) * tr / dt).astype(int)]
+    regressor.setflags(write=False)
+    return regressor
+
+
+@lru_cache()
+def polort_baseline(n_vols, polort=POLORT):
+    """
+    Builds the Legendre polynomial baseline used by 3dDeconvolve.
+
+    Inputs
+    ------
+    n_vols: int
+        number of volumes in the MRI time series
+    polort: int
+        (Optional) order of the polynomial baseline. Defaults to 1.
+
+    Outputs
+    -------
+    array-like
+        baseline regressors, of shape (n_vols, polort + 1)
+    """
+    x = np.linspace(-1, 1, n_vols)
+    baseline = np.polynomial.legendre.legvander(x, polort)
+    baseline.setflags(write=False)  # cached, so shared between callers
+    return baseline
+
+
+def design_matrix(stim_tuples, confounds, n_vols, tr, polort=POLORT):
+    """
+    Assembles the full design matrix from a polynomial baseline,
+    the task stimuli and the physiological confounds.
+
+    Inputs
+    ------
+    stim_tuples: list
+        a list of tuples of form (number, onsets, HRF), as generated
+        by `_gen_stim_list`; onsets are a list of seconds or the name
+        of an AFNI stimulus timing file
+    confounds: array-like or file
+        physiological confounds, of shape (n_vols, n_confounds)
+    n_vols: int
+        number of volumes in the MRI time series
+    tr: float
+        repetition time of the MRI time series, in seconds
+    polort: int
+        (Optional) order of the polynomial baseline. Defaults to 1.
+
+    Outputs
+    -------
+    X: array-like
+        design matrix, of shape (n_vols, n_regressors)
+    is_confound: array-like
+        boolean mask over the columns of `X` marking the confounds
+    """
+    if isinstance(confounds, str):
+        confounds = np.loadtxt(confounds)
+    confounds = np.asarray(confounds, dtype=float).reshape(n_vols, -1)
+
+    stims = [stim_regressor(read_stim_times(onsets)
+                            if isinstance(onsets, str) else onsets,
+                            n_vols, tr, model)
+             for (_, onsets, model) in sorted(stim_tuples,
+                                              key=lambda s: s[0])]
+    stims = np.column_stack(stims) if stims else np.empty((n_vols, 0))
+
+    X = np.column_stack([polort_baseline(n_vols, polort), stims, confounds])
+    is_confound = np.zeros(X.shape[1], dtype=bool)
+    is_confound[-confounds.shape[1]:] = True
+    return X, is_confound
+
+
+def regressor_labels(stim_tuples, is_confound, polort=POLORT):
+    """
+    Labels the columns of a design matrix built by `design_matrix`,
+    in the style of 3dDeconvolve's cbucket.
+    """
+    return (['Pol#{}'.format(i) for i in range(polort + 1)] +
+            ['Stim{}#0'.format(n) for n, _, _ in sorted(stim_tuples,
+                                                         key=lambda s: s[0])] +
+            ['Confound#{}'.format(i) for i in range(int(is_confound.sum()))])
+
+
+def get_tr(img):
+    """
+    Reads the repetition time, in seconds, from a NIfTI header.
+    """
+    tr = float(img.header.get_zooms()[3])
+    if img.header.get_xyzt_units()[1] == 'msec':
+        tr /= 1000.
+    return tr
+
+
+def remove_confounds(data, X, is_confound, chunk_size=CHUNK_SIZE,
+                     fit_stats=False, pinv=None):
+    """
+    Fits the design matrix to every voxel and subtracts the
+    confound portion of the fit, leaving baseline, task and
+    residual variance intact.
+
+    Inputs
+    ------
+    data: array-like
+        voxel time series, of shape (n_voxels, n_vols)
+    X: array-like
+        design matrix, of shape (n_vols, n_regressors)
+    is_confound: array-like
+        boolean mask over the columns of `X` marking the confounds
+    chunk_size: int
+        (Optional) number of voxels solved per batch.
+    fit_stats: bool
+        (Optional) also return the statistics in `STAT_NAMES`.
+    pinv: array-like
+        (Optional) pseudo-inverse of `X`, if already computed.
+
+    Outputs
+    -------
+    corrected: array-like
+        confound-corrected time series, of shape (n_voxels, n_vols)
+    betas: array-like
+        regression coefficients, of shape (n_voxels, n_regressors)
+    stats: array-like
+        only if `fit_stats`: fit statistics, of shape
+        (n_voxels, len(STAT_NAMES))
+    """
+    if pinv is None:
+        pinv = np.linalg.pinv(X)
+    conf = X[:, is_confound]
+    corrected = np.empty(data.shape, dtype=np.float32)
+    betas = np.empty((data.shape[0], X.shape[1]), dtype=np.float32)
+    if fit_stats:
+        stats = np.empty((data.shape[0], len(STAT_NAMES)), dtype=np.float32)
+        dof = max(X.shape[0] - np.linalg.matrix_rank(X), 1)
+        # the confounds, orthogonalized against the rest of the model:
+        # projecting onto them gives the fit they add
+        rest = X[:, ~is_confound]
+        q = np.linalg.qr(conf - rest @ (np.linalg.pinv(rest) @ conf))[0]
+
+    for start in range(0, data.shape[0], chunk_size):
+        stop = start + chunk_size
+        chunk = np.asarray(data[start:stop], dtype=np.float64)
+        b = chunk @ pinv.T
+        corrected[start:stop] = chunk - b[:, is_confound] @ conf.T
+        betas[start:stop] = b
+        if fit_stats:
+            ss_res = ((chunk - b @ X.T) ** 2).sum(axis=1)
+            ss_tot = ((chunk - chunk.mean(axis=1, keepdims=True)) ** 2
+                      ).sum(axis=1)
+            ss_conf = ((chunk @ q) ** 2).sum(axis=1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                stats[start:stop, 0] = np.where(ss_tot > 0,
+                                                1 - ss_res / ss_tot, 0)
+                stats[start:stop, 1] = np.sqrt(ss_res / dof)
+                stats[start:stop, 2] = np.where(
+                    ss_res > 0, (ss_conf / q.shape[1]) / (ss_res / dof), 0)
+    if fit_stats:
+        return corrected, betas, stats
+    return corrected, betas
+
+
+def remove_confounds_group(data, base, confounds, chunk_size=CHUNK_SIZE,
+                           fit_stats=False):
+    """
+    Removes physiological confounds from many runs sharing their
+    baseline and task regressors (same TR, volume count and
+    onsets), whose confounds alone differ.
+
+    By the Frisch-Waugh-Lovell theorem, the confound coefficients
+    of a run are those of its confounds fit to its data, both with
+    the shared regressors projected out (projecting the data is
+    redundant). The shared part is thus factored once and fit to
+    all runs' voxels, stacked, in a few large matrix products;
+    each run then only adds the small solve of its own few
+    orthogonalized confound columns.
+
+    Gives the same fit as `remove_confounds` on each run's full
+    design matrix, if that is of full rank.
+
+    Inputs
+    ------
+    data: list
+        voxel time series of each run, of shape (n_voxels, n_vols)
+    base: array-like
+        shared regressors, of shape (n_vols, n_base), i.e. the
+        columns of `design_matrix` that are not confounds
+    confounds: list
+        physiological confounds of each run, of shape
+        (n_vols, n_confounds)
+    chunk_size: int
+        (Optional) number of voxels, across runs, solved per batch.
+    fit_stats: bool
+        (Optional) also return the statistics in `STAT_NAMES`.
+
+    Outputs
+    -------
+    list
+        per run, as `remove_confounds`: (corrected, betas), followed
+        by stats if `fit_stats`; betas are ordered as the columns of
+        `design_matrix`, shared regressors first
+    """
+    if len(data) != len(confounds):
+        raise ValueError('Got {} runs but {} sets of confounds.'.format(
+            len(data), len(confounds)))
+    base = np.asarray(base, dtype=np.float64)
+    n_vols = base.shape[0]
+    base_pinv = np.linalg.pinv(base)
+    confounds = [np.asarray(c, dtype=np.float64).reshape(n_vols, -1)
+                 for c in confounds]
+    # each run's confounds, orthogonalized against the shared part
+    resid_conf = [c - base @ (base_pinv @ c) for c in confounds]
+    conf_pinv = [np.linalg.pinv(r) for r in resid_conf]
+    if fit_stats:
+        q = [np.linalg.qr(r)[0] for r in resid_conf]
+        dof = [max(n_vols - np.linalg.matrix_rank(np.column_stack([base, c])),
+                   1) for c in confounds]
+
+    results = []
+    for d, c in zip(data, confounds):
+        result = [np.empty(d.shape, dtype=np.float32),
+                  np.empty((d.shape[0], base.shape[1] + c.shape[1]),
+                           dtype=np.float32)]
+        if fit_stats:
+            result.append(np.empty((d.shape[0], len(STAT_NAMES)),
+                                   dtype=np.float32))
+        results.append(result)
+
+    for chunk, segments in _stacked_chunks(data, chunk_size):
+        chunk = np.asarray(chunk, dtype=np.float64)
+        b_base = chunk @ base_pinv.T
+        for (run, start, stop, lo, hi) in segments:
+            # the pseudo-inverse of the orthogonalized confounds
+            # annihilates the shared part: no need to project it out
+            b_conf = chunk[lo:hi] @ conf_pinv[run].T
+            corrected, betas = results[run][:2]
+            np.subtract(chunk[lo:hi], b_conf @ confounds[run].T,
+                        out=corrected[start:stop], casting='unsafe')
+            # the shared coefficients, less what the confounds explain
+            betas[start:stop, :base.shape[1]] = (
+                b_base[lo:hi] - b_conf @ (base_pinv @ confounds[run]).T)
+            betas[start:stop, base.shape[1]:] = b_conf
+            if fit_stats:
+                X = np.column_stack([base, confounds[run]])
+                ss_res = ((chunk[lo:hi] - betas[start:stop] @ X.T) ** 2
+                          ).sum(axis=1)
+                ss_tot = ((chunk[lo:hi] -
+                           chunk[lo:hi].mean(axis=1, keepdims=True)) ** 2
+                          ).sum(axis=1)
+                ss_conf = ((chunk[lo:hi] @ q[run]) ** 2).sum(axis=1)
+                stats, n_conf = results[run][2], q[run].shape[1]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    stats[start:stop, 0] = np.where(ss_tot > 0,
+                                                    1 - ss_res / ss_tot, 0)
+                    stats[start:stop, 1] = np.sqrt(ss_res / dof[run])
+                    stats[start:stop, 2] = np.where(
+                        ss_res > 0,
+                        (ss_conf / n_conf) / (ss_res / dof[run]), 0)
+    return [tuple(r) for r in results]
+
+
+def _stacked_chunks(data, chunk_size):
+    """
+    Yields the voxels of several arrays, `chunk_size` at a time.
+    Arrays smaller than a chunk are stacked whole, so that many
+    small ones are solved together; larger ones are split, without
+    copying.
+
+    Outputs
+    -------
+    chunk: array-like
+        voxel time series, of shape (<= chunk_size, n_vols)
+    segments: list
+        tuples of form (array, start, stop, lo, hi): rows `lo:hi` of
+        the chunk are rows `start:stop` of `data[array]`
+    """
+    pieces, segments, n = [], [], 0
+    for run, d in enumerate(data):
+        if n and n + d.shape[0] > chunk_size:
+            yield _stack(pieces), segments
+            pieces, segments, n = [], [], 0
+        if d.shape[0] >= chunk_size:
+            for start in range(0, d.shape[0], chunk_size):
+                stop = min(start + chunk_size, d.shape[0])
+                yield d[start:stop], [(run, start, stop, 0, stop - start)]
+        elif d.shape[0]:
+            pieces.append(d)
+            segments.append((run, 0, d.shape[0], n, n + d.shape[0]))
+            n += d.shape[0]
+    if pieces:
+        yield _stack(pieces), segments
+
+
+def _stack(pieces):
+    """
+    Stacks arrays along their first axis, copying only if several.
+    """
+    return pieces[0] if len(pieces) == 1 else np.concatenate(pieces)
+
+
+def optimal_combination(data, echo_times):
+    """
+    Combines echoes with T2*-weighted averaging, estimating T2* per
+    voxel from a log-linear fit to the mean signal of each echo.
+
+    Inputs
+    ------
+    data: array-like
+        echo time series, of shape (n_echoes, n_voxels, n_vols)
+    echo_times: list
+        echo times, in consistent units (e.g. ms)
+
+    Outputs
+    -------
+    array-like
+        combined time series, of shape (n_voxels, n_vols)
+    """
+    check_echo_times(echo_times, len(data))
+    tes = np.asarray(echo_times, dtype=float)[:, np.newaxis]
+    log_s = np.log(np.maximum(data.mean(axis=-1), np.finfo(float).tiny))
+    te_c = tes - tes.mean()
+    slope = (te_c * (log_s - log_s.mean(axis=0))).sum(0) / (te_c ** 2).sum()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t2s = np.where(slope < 0, -1. / slope, np.inf)
+
+    weights = tes * np.exp(-tes / t2s)
+    weights /= weights.sum(axis=0)
+    return np.einsum('ev,evt->vt', weights, data).astype(np.float32)
+
+
+def check_echo_times(echo_times, n_echoes):
+    """
+    Raises a ValueError unless `echo_times` gives one echo time per
+    echo of a multi-echo run, as the optimal combination needs.
+    """
+    if len(echo_times) != n_echoes:
+        raise ValueError('{} echo times given for {} echoes.'.format(
+            len(echo_times), n_echoes))
+    if n_echoes < 2:
+        raise ValueError('Optimal combination needs at least two echoes.')
+
+
+def correct_image(in_file, stim_tuples, confounds, out_file, **kwargs):
+    """
+    Removes physiological confounds from a single 4D image, see
+    `correct_echoes` for the optional arguments.
+    """
+    return correct_echoes([in_file], stim_tuples, confounds, [out_file],
+                          **kwargs)[0]
+
+
+def correct_echoes(in_files, stim_tuples, confounds, out_files,
+                   echo_times=None, optcom_file=None, polort=POLORT,
+                   chunk_size=CHUNK_SIZE, mem_gb=None, cache_dir=None,
+                   output_format='nii.gz', cbucket_files=None,
+                   stats_files=None, timings=None, design=None, mask=None):
+    """
+    Removes physiological confounds from every echo of a run,
+    writing only the corrected images to disk. The design matrix
+    and its pseudo-inverse are built once and applied to all
+    echoes together.
+
+    Inputs
+    ------
+    in_files: list
+        4D NIfTI images, one per echo, sharing a grid
+    stim_tuples: list
+        a list of tuples of form (number, onsets, HRF)
+    confounds: array-like or file
+        physiological confounds, of shape (n_vols, n_confounds)
+    out_files: list
+        names of the corrected 4D images, one per echo
+    echo_times: list
+        (Optional) echo times, required for `optcom_file`.
+    optcom_file: file
+        (Optional) name of the optimally combined corrected image.
+    polort: int
+        (Optional) order of the polynomial baseline. Defaults to 1.
+    chunk_size: int
+        (Optional) number of voxels solved per batch.
+    mem_gb: float
+        (Optional) memory budget, in GB. If given, the images are
+        corrected out-of-core, see `correct_echoes_chunked`.
+    cache_dir: str
+        (Optional) directory for uncompressed copies of the inputs.
+        Copies are made when `mem_gb` is given; otherwise existing
+        copies are used instead of decompressing the inputs.
+    output_format: str
+        (Optional) format of all outputs, one of `nifti.FORMATS`.
+        Defaults to 'nii.gz'.
+    cbucket_files: list
+        (Optional) names of the regression coefficients of each echo,
+        one volume per regressor, as in 3dDeconvolve's cbucket.
+    stats_files: list
+        (Optional) names of the fit statistics of each echo, one
+        volume per statistic in `STAT_NAMES`; required with
+        `cbucket_files`.
+    timings: dict
+        (Optional) filled with 'write_s', the seconds spent writing
+        outputs, summed over writer threads.
+    design: tuple
+        (Optional) prebuilt (X, is_confound) of the run, e.g. shared
+        by the main process (see `shm.attach_design`), used instead
+        of rebuilding it from `stim_tuples` and `confounds`.
+    mask: str
+        (Optional) 'auto' or a 3D mask image. Only voxels within the
+        mask are fit, packed into a compact array; outputs are zero
+        outside it. Defaults to fitting every voxel.
+
+    Outputs
+    -------
+    list
+        the corrected 4D images, followed by `optcom_file` if
+        requested
+    """
+    if optcom_file is not None:
+        if echo_times is None:
+            raise ValueError('Echo times are required for optimal '
+                             'combination.')
+        check_echo_times(echo_times, len(in_files))
+    if (cbucket_files is None) != (stats_files is None):
+        raise ValueError('Coefficients and fit statistics are written '
+                         'together.')
+    if mem_gb is not None:
+        return correct_echoes_chunked(in_files, stim_tuples, confounds,
+                                      out_files, mem_gb,
+                                      echo_times=echo_times,
+                                      optcom_file=optcom_file,
+                                      polort=polort, cache_dir=cache_dir,
+                                      output_format=output_format,
+                                      cbucket_files=cbucket_files,
+                                      stats_files=stats_files,
+                                      timings=timings, design=design,
+                                      mask=mask)
+
+    # use uncompressed copies if they were prefetched, see `run_jobs`
+    imgs = [nib.load((nifti.cached_copy(f, cache_dir) or f)
+                     if cache_dir else f) for f in in_files]
+    _check_grids(imgs)
+    shape, n_vols = imgs[0].shape, imgs[0].shape[-1]
+    X, is_confound = _design(design, stim_tuples, confounds, n_vols,
+                             get_tr(imgs[0]), polort)
+    # the design is shared by every echo: solve it once
+    pinv = np.linalg.pinv(X)
+    if mask not in (None, 'auto'):
+        mask = load_mask(mask, shape[:-1]).reshape(-1)
+    fit = cbucket_files is not None
+    labels = regressor_labels(stim_tuples, is_confound, polort)
+    write_s = []
+
+    def _read(img):
+        return np.asanyarray(img.dataobj).reshape(-1, n_vols)
+
+    def _write(data, ref_img, out_file, volumes=None):
+        start = time.perf_counter()
+        nifti.save(data, ref_img, out_file, output_format)
+        if volumes is not None:
+            nifti.write_sidecar(out_file, volumes=volumes)
+        write_s.append(time.perf_counter() - start)
+
+    # voxels are fit independently, so each echo is corrected as soon
+    # as it is read, while the next one is decompressed and the
+    # previous one is written
+    outputs, corrected = list(out_files), []
+    with BackgroundWriter() as writer:
+        for i, (img, data) in enumerate(zip(imgs, read_ahead(_read, imgs))):
+            if mask is not None:
+                if isinstance(mask, str):  # 'auto', from the first echo
+                    mask = auto_mask(data.mean(axis=-1))
+                data = data[mask]
+            result = remove_confounds(data, X, is_confound, chunk_size,
+                                      fit_stats=fit, pinv=pinv)
+            del data
+            writer.submit(_write, _unpack(result[0], mask).reshape(shape),
+                          img, out_files[i])
+            if fit:
+                writer.submit(_write, _unpack(result[1], mask).reshape(
+                    shape[:-1] + (-1,)), img, cbucket_files[i], labels)
+                writer.submit(_write, _unpack(result[2], mask).reshape(
+                    shape[:-1] + (-1,)), img, stats_files[i], STAT_NAMES)
+            if optcom_file is not None:
+                corrected.append(result[0])
+        if optcom_file is not None:
+            writer.submit(_write, _unpack(optimal_combination(
+                np.stack(corrected), echo_times), mask).reshape(shape),
+                imgs[0], optcom_file)
+            outputs.append(optcom_file)
+    if timings is not None:
+        timings['write_s'] = sum(write_s)
+    return outputs
+
+
+def correct_echoes_chunked(in_files, stim_tuples, confounds, out_files,
+                           mem_gb, echo_times=None, optcom_file=None,
+                           polort=POLORT, cache_dir=None,
+                           output_format='nii.gz', cbucket_files=None,
+                           stats_files=None, timings=None, design=None,
+                           mask=None):
+    """
+    Removes physiological confounds from every echo of a run one
+    slab of slices at a time. The inputs are memory-mapped from
+    uncompressed copies and the outputs are written incrementally,
+    so peak memory is bounded by `mem_gb` rather than by the size
+    of the images.
+
+    Inputs
+    ------
+    in_files: list
+        4D NIfTI images, one per echo, sharing a grid
+    stim_tuples: list
+        a list of tuples of form (number, onsets, HRF)
+    confounds: array-like or file
+        physiological confounds, of shape (n_vols, n_confounds)
+    out_files: list
+        names of the corrected 4D images, one per echo
+    mem_gb: float
+        memory budget for the voxel data, in GB
+    echo_times: list
+        (Optional) echo times, required for `optcom_file`.
+    optcom_file: file
+        (Optional) name of the optimally combined corrected image.
+    polort: int
+        (Optional) order of the polynomial baseline. Defaults to 1.
+    cache_dir: str
+        (Optional) directory for uncompressed copies of `in_files`.
+        Defaults to a temporary directory, removed afterwards.
+    output_format: str
+        (Optional) format of all outputs, one of `nifti.FORMATS`.
+    cbucket_files: list
+        (Optional) names of the regression coefficients of each echo.
+    stats_files: list
+        (Optional) names of the fit statistics of each echo.
+    timings: dict
+        (Optional) filled with 'write_s', the seconds spent writing
+        outputs.
+    design: tuple
+        (Optional) prebuilt (X, is_confound) of the run.
+    mask: str
+        (Optional) 'auto' or a 3D mask image, see `correct_echoes`.
+
+    Outputs
+    -------
+    list
+        the corrected 4D images, followed by `optcom_file` if
+        requested
+    """
+    outputs = list(out_files)
+    if optcom_file is not None:
+        outputs.append(optcom_file)
+    fit = cbucket_files is not None
+    write_s = []
+
+    tmp_dir = tempfile.mkdtemp(
+        dir=os.path.dirname(os.path.abspath(outputs[0])))
+    try:
+        imgs = [nifti.load(f, cache_dir or tmp_dir) for f in in_files]
+        _check_grids(imgs)
+        shape, n_vols = imgs[0].shape, imgs[0].shape[-1]
+        X, is_confound = _design(design, stim_tuples, confounds, n_vols,
+                                 get_tr(imgs[0]), polort)
+        # the design is shared by every slab: solve it once
+        pinv = np.linalg.pinv(X)
+        if mask == 'auto':
+            # one pass over the first echo for its mean image
+            mean = np.empty(shape[:-1])
+            step = max(int(CHUNK_SIZE // np.prod(shape[:-2])), 1)
+            for z in range(0, shape[-2], step):
+                mean[..., z:z + step] = np.asarray(
+                    imgs[0].dataobj[..., z:z + step, :]).mean(axis=-1)
+            mask = auto_mask(mean)
+        elif mask is not None:
+            mask = load_mask(mask, shape[:-1])
+
+        # (name, shape, volume labels) of every output, in the order
+        # their slabs are computed below
+        specs = [(f, shape, None) for f in outputs]
+        if fit:
+            labels = regressor_labels(stim_tuples, is_confound, polort)
+            for cbucket_file, stats_file in zip(cbucket_files, stats_files):
+                specs += [(cbucket_file, shape[:-1] + (len(labels),), labels),
+                          (stats_file, shape[:-1] + (len(STAT_NAMES),),
+                           STAT_NAMES)]
+
+        targets, out_data = [], []
+        for i, (out_file, out_shape, _) in enumerate(specs):
+            target = out_file
+            if output_format == 'zarr':
+                out_data.append(nifti.create_zarr(out_file, imgs[0],
+                                                  out_shape))
+            else:
+                if output_format != 'nii':
+                    target = os.path.join(tmp_dir, 'out_{}.nii'.format(i))
+                out_data.append(nifti.create_nifti(target, imgs[0].header,
+                                                   out_shape))
+            targets.append(target)
+
+        # per voxel and echo: input (plus the slab read ahead), float64
+        # working copy and output, plus coefficients and statistics
+        vox_bytes = n_vols * (2 * imgs[0].get_data_dtype().itemsize + 8 + 4)
+        slice_bytes = vox_bytes * int(np.prod(shape[:-2])) * len(outputs)
+        if fit:
+            slice_bytes += (4 * (X.shape[1] + len(STAT_NAMES)) *
+                            int(np.prod(shape[:-2])) * len(imgs))
+        n_slices = max(int(mem_gb * 1024 ** 3 // slice_bytes), 1)
+
+        def _read(z):
+            return [np.asarray(img.dataobj[..., z:z + n_slices, :])
+                    for img in imgs]
+
+        for z, slabs in zip(range(0, shape[-2], n_slices),
+                            read_ahead(_read, range(0, shape[-2],
+                                                    n_slices))):
+            slab_shape = slabs[0].shape
+            slab_mask = (None if mask is None else
+                         mask[..., z:z + n_slices].reshape(-1))
+            slabs = [s.reshape(-1, n_vols) for s in slabs]
+            if slab_mask is not None:
+                slabs = [s[slab_mask] for s in slabs]
+            result = remove_confounds(np.concatenate(slabs), X, is_confound,
+                                      fit_stats=fit, pinv=pinv)
+            del slabs
+            corrected = list(result[0].reshape((len(imgs), -1, n_vols)))
+            if optcom_file is not None:
+                corrected.append(optimal_combination(np.stack(corrected),
+                                                     echo_times))
+            if fit:
+                for betas, stats in zip(
+                        result[1].reshape((len(imgs), -1, X.shape[1])),
+                        result[2].reshape((len(imgs), -1, len(STAT_NAMES)))):
+                    corrected += [betas, stats]
+            corrected = [_unpack(c, slab_mask) for c in corrected]
+
+            start = time.perf_counter()
+            for data, slab in zip(out_data, corrected):
+                data[..., z:z + n_slices, :] = slab.reshape(
+                    slab_shape[:-1] + (-1,))
+            write_s.append(time.perf_counter() - start)
+
+        def _finish(data, target, out_file, volumes):
+            start = time.perf_counter()
+            if output_format != 'zarr':
+                data.flush()
+            if output_format == 'fastgz':
+                nifti.compress(target, out_file, level=1,
+                               n_threads=os.cpu_count() or 1)
+            elif target != out_file:
+                nifti.compress(target, out_file)
+            if volumes is not None:
+                nifti.write_sidecar(out_file, volumes=volumes)
+            write_s.append(time.perf_counter() - start)
+
+        # compress all outputs concurrently
+        with BackgroundWriter(n_threads=len(specs)) as writer:
+            for data, target, (out_file, _, volumes) in zip(out_data,
+                                                            targets, specs):
+                writer.submit(_finish, data, target, out_file, volumes)
+        del out_data
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    if timings is not None:
+        timings['write_s'] = sum(write_s)
+    return outputs
+
+
+def _design(design, stim_tuples, confounds, n_vols, tr, polort=POLORT):
+    """
+    Returns the prebuilt `design` if it fits the images, otherwise
+    builds the design matrix.
+    """
+    if design is not None:
+        X, is_confound = design
+        if X.shape[0] == n_vols and X.shape[1] == len(is_confound):
+            return X, is_confound
+        print('WARNING: shared design matrix does not match the images; '
+              'rebuilding it.')
+    return design_matrix(stim_tuples, confounds, n_vols, tr, polort=polort)
+
+
+def auto_mask(mean, frac=MASK_FRAC):
+    """
+    Computes a brain mask from a mean image, keeping voxels above
+    `frac` of its 98th percentile, which ignores the brightest
+    outliers.
+
+    Inputs
+    ------
+    mean: array-like
+        mean signal of every voxel, of any shape
+    frac: float
+        (Optional) fraction of the 98th percentile. Defaults to 0.2.
+
+    Outputs
+    -------
+    array-like
+        boolean mask, with the shape of `mean`
+    """
+    mean = np.asarray(mean, dtype=float)
+    finite = np.isfinite(mean)
+    if not finite.any():
+        return finite
+    return finite & (mean > frac * np.percentile(mean[finite], 98))
+
+
+def load_mask(mask_f, shape):
+    """
+    Loads a 3D mask image as a boolean array, checking that it
+    matches the grid of the images.
+    """
+    mask = np.asanyarray(nib.load(mask_f).dataobj)
+    mask = mask.reshape(mask.shape[:3])  # e.g. (x, y, z, 1) images
+    if mask.shape != tuple(shape):
+        raise ValueError('Mask {} has shape {}, the images {}.'.format(
+            mask_f, mask.shape, tuple(shape)))
+    return mask > 0
+
+
+def _unpack(packed, mask):
+    """
+    Scatters the rows of `packed`, one per voxel within `mask`, back
+    into an array over all voxels, zero outside the mask.
+    """
+    if mask is None:
+        return packed
+    out = np.zeros((mask.size,) + packed.shape[1:], dtype=packed.dtype)
+    out[mask.reshape(-1)] = packed
+    return out
+
+
+def _check_grids(imgs):
+    """
+    Ensures all echoes of a run share a single grid.
+    """
+    if any(img.shape != imgs[0].shape for img in imgs[1:]):
+        raise ValueError('All echoes of a run must share the same shape, '
+                         'got {}'.format([img.shape for img in imgs]))
+
+
+def _save(data, ref_img, out_file, output_format='nii.gz'):
+    """
+    Saves `data` as a float32 image on the grid of `ref_img`.
+    """
+    return nifti.save(data, ref_img, out_file, output_format)
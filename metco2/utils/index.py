@@ -0,0 +1,182 @@
+import os
+import re
+import json
+from collections import namedtuple
+
+# a single file of the dataset and the entities parsed from its name
+DataFile = namedtuple('DataFile', ['subject', 'run', 'echo', 'modality',
+                                   'path'])
+
+RUN_RE = re.compile(r'_run[-_]?(\d+)')
+ECHO_RE = re.compile(r'_(?:echo-?|e)(\d+)(?=[_.])')
+INDEX_VERSION = 1
+
+
+def parse_entities(subject, fname):
+    """
+    Parses the BIDS-ish entities of a file in a subject folder.
+
+    Inputs
+    ------
+    subject: str
+        participant identifier
+    fname: str
+        file name, without its folder
+
+    Outputs
+    -------
+    DataFile
+        the parsed entities, or None for files `metco2` doesn't read
+    """
+    if fname.endswith('.nii.gz'):
+        modality = 'bold'
+    elif fname.endswith('.1D') and 'ECG' in fname:
+        modality = 'ECG'
+    elif fname.endswith('.1D') and 'Resp' in fname:
+        modality = 'Resp'
+    elif fname.endswith('dmat.txt'):
+        modality = 'dmat'
+    else:
+        return None
+
+    run = RUN_RE.search(fname)
+    echo = ECHO_RE.search(fname)
+    return DataFile(subject,
+                    int(run.group(1)) if run else None,
+                    int(echo.group(1)) if echo else None,
+                    modality, fname)
+
+
+class DatasetIndex(object):
+    """
+    In-memory table of the files of a dataset, built from a single
+    pass over its folders, so that input discovery is a lookup.
+
+    Parameters
+    ----------
+    data_dir: str
+        the root folder of the dataset
+    index_file: str
+        (Optional) JSON file persisting the index between runs. It is
+        reused only while the modification times of the dataset
+        folders are unchanged.
+    """
+    def __init__(self, data_dir, index_file=None):
+        self.data_dir = os.path.abspath(data_dir)
+        self.index_file = index_file
+        self.files = []
+        self._mtimes = {}
+        self._root_mtime = None
+        self._by_subject = None
+        if not self._load():
+            self._scan()
+            self.save()
+
+    def subjects(self):
+        """
+        Returns the sorted participant identifiers.
+        """
+        return sorted(self._mtimes)
+
+    def query(self, subject=None, modality=None, run=None):
+        """
+        Returns the files matching all given entities, sorted
+        by run, echo and name, with absolute paths.
+        """
+        if subject is not None:
+            if self._by_subject is None:
+                self._by_subject = {}
+                for f in self.files:
+                    self._by_subject.setdefault(f.subject, []).append(f)
+            files = self._by_subject.get(subject, [])
+        else:
+            files = self.files
+        found = [f for f in files
+                 if (modality is None or f.modality == modality) and
+                 (run is None or f.run == run)]
+        found.sort(key=lambda f: (f.run or 0, f.echo or 0, f.path))
+        return [f._replace(path=os.path.join(self.data_dir, f.subject,
+                                             f.path))
+                for f in found]
+
+    def _scan(self):
+        """
+        Lists every subject folder once, parsing file entities.
+        Modification times are taken before listing, so a file added
+        meanwhile invalidates them rather than going unseen.
+        """
+        self.files, self._mtimes, self._by_subject = [], {}, None
+        self._root_mtime = os.stat(self.data_dir).st_mtime
+        for entry in os.scandir(self.data_dir):
+            if entry.name.startswith('sub-') and entry.is_dir():
+                self._mtimes[entry.name], files = self._list(entry.name)
+                self.files.extend(files)
+
+    def _list(self, subject):
+        """
+        Lists a single subject folder: its modification time and its
+        parsed files.
+        """
+        path = os.path.join(self.data_dir, subject)
+        mtime = os.stat(path).st_mtime
+        files = [parse_entities(subject, f.name) for f in os.scandir(path)]
+        return mtime, [f for f in files if f is not None]
+
+    def _load(self):
+        """
+        Loads the persisted index if it is still current.
+        """
+        if self.index_file is None or not os.path.exists(self.index_file):
+            return False
+        try:
+            with open(self.index_file) as f:
+                saved = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False
+        if (saved.get('version') != INDEX_VERSION or
+                saved.get('data_dir') != self.data_dir or
+                saved.get('root_mtime') != os.stat(self.data_dir).st_mtime):
+            return False
+        for subject, mtime in saved['mtimes'].items():
+            try:
+                if os.stat(os.path.join(self.data_dir,
+                                        subject)).st_mtime != mtime:
+                    return False
+            except OSError:
+                return False
+        self._mtimes = saved['mtimes']
+        self._root_mtime = saved['root_mtime']
+        self.files = [DataFile(*f) for f in saved['files']]
+        return True
+
+    def save(self):
+        """
+        Persists the index, if an index file was given. `metco2`
+        writes derived files (confounds, physio sidecars) into subject
+        folders, so folders changed since they were listed are listed
+        again first: call this after writing them to keep the persisted
+        index valid for the next run, without hiding any input added
+        meanwhile.
+        """
+        if self.index_file is None:
+            return
+        if os.stat(self.data_dir).st_mtime != self._root_mtime:
+            self._scan()  # subject folders added or removed
+        else:
+            changed = set(subject for subject, mtime in self._mtimes.items()
+                          if os.stat(os.path.join(
+                              self.data_dir, subject)).st_mtime != mtime)
+            if changed:
+                self.files = [f for f in self.files
+                              if f.subject not in changed]
+                for subject in changed:
+                    self._mtimes[subject], files = self._list(subject)
+                    self.files.extend(files)
+                self._by_subject = None
+        saved = dict(version=INDEX_VERSION, data_dir=self.data_dir,
+                     root_mtime=self._root_mtime,
+                     mtimes=self._mtimes, files=self.files)
+        tmp = '{}.{}.tmp'.format(self.index_file, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(saved, f)
+        os.replace(tmp, self.index_file)
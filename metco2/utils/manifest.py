@@ -0,0 +1,97 @@
+import os
+import json
+import hashlib
+
+MANIFEST_DIR = 'manifests'
+
+
+def fingerprint(files=(), data=None):
+    """
+    Hashes the path, size and modification time of each file, plus
+    any JSON-serializable `data`. Image contents are not read, so
+    fingerprinting a whole cohort stays cheap.
+
+    Inputs
+    ------
+    files: list
+        files to fingerprint
+    data: object
+        (Optional) JSON-serializable values to include, e.g. onsets
+
+    Outputs
+    -------
+    str
+        hex digest of the fingerprint
+    """
+    digest = hashlib.sha256()
+    for fname in files:
+        stat = os.stat(fname)
+        digest.update('{}:{}:{}\n'.format(os.path.abspath(fname),
+                                          stat.st_size,
+                                          stat.st_mtime_ns).encode())
+    if data is not None:
+        digest.update(json.dumps(data, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def manifest_path(output_dir, job):
+    """
+    Returns the manifest file of a (subject, run) job.
+    """
+    return os.path.join(output_dir, MANIFEST_DIR,
+                        '{}_{}.json'.format(job.subject, job.run))
+
+
+def read_manifest(output_dir, job):
+    """
+    Returns the manifest of `job`, or an empty one.
+    """
+    try:
+        with open(manifest_path(output_dir, job)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return dict(subject=job.subject, run=job.run, steps={})
+
+
+def record_step(output_dir, job, step, inputs, params, outputs):
+    """
+    Records a completed step of `job` in its manifest.
+
+    Inputs
+    ------
+    output_dir: str
+        the output directory
+    job: Job
+        the (subject, run) the step belongs to
+    step: str
+        name of the step, e.g. 'confounds' or 'workflow'
+    inputs: str
+        fingerprint of the step's inputs, see `fingerprint`
+    params: dict
+        JSON-serializable parameters of the step
+    outputs: list
+        files written by the step
+    """
+    manifest = read_manifest(output_dir, job)
+    manifest['steps'][step] = dict(inputs=inputs, params=params,
+                                   outputs=[os.path.abspath(o)
+                                            for o in outputs])
+    fname = manifest_path(output_dir, job)
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    tmp = '{}.{}.tmp'.format(fname, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp, fname)
+
+
+def step_complete(output_dir, job, step, inputs, params):
+    """
+    Checks whether `step` of `job` already completed with the same
+    inputs and parameters, and all of its outputs still exist.
+    """
+    record = read_manifest(output_dir, job)['steps'].get(step)
+    if record is None:
+        return False
+    return (record['inputs'] == inputs and
+            record['params'] == json.loads(json.dumps(params)) and
+            all(os.path.exists(o) for o in record['outputs']))
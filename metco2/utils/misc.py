@@ -1,7 +1,7 @@
 import os
-import glob
+import re
 from itertools import groupby
-from ..utils.file_manip import (split_dmat_txt, sort_and_write)
+from ..utils.index import DatasetIndex
 
 
 def group_phys(phys_files):
@@ -28,12 +28,32 @@ def group_timings(timing_files):
     return phys_files
 
 
-def create_subj_list(data_dir, selected=None):
+def group_echoes(data_files):
+    """
+    Groups the echoes of each run, ordered by echo number.
+    Single-echo runs become groups of one.
+    """
+    echo_re = re.compile(r'_(?:echo-?|e)(\d+)(?=[_.])')
+
+    def _group_echoes(x):
+        return echo_re.sub('', os.path.basename(x))
+
+    def _echo(x):
+        match = echo_re.search(os.path.basename(x))
+        return int(match.group(1)) if match else 0
+
+    data_files = [sorted(v, key=_echo)
+                  for k, v in groupby(sorted(data_files, key=_group_echoes),
+                                      key=_group_echoes)]
+    return data_files
+
+
+def create_subj_list(data_dir, selected=None, index=None):
     """
     # ['sub-1611058', 'sub-1611103', 'sub-1621107']
     """
-    subject_list = glob.glob(os.path.join(data_dir, 'sub-*'))
-    subject_list = [os.path.basename(s) for s in subject_list]
+    index = index or DatasetIndex(data_dir)
+    subject_list = index.subjects()
     if selected is not None:
         if all([s in subject_list for s in selected]):
             subject_list = selected
@@ -43,19 +63,68 @@ def create_subj_list(data_dir, selected=None):
     return subject_list
 
 
-def gather_inputs(data_dir, subj):
+def gather_inputs(data_dir, subj, index=None):
     """
+    Looks up the images (grouped by run, then echo) and physio
+    files ([ECG, Resp] per run) of a subject, and parses its event
+    timings (a list of onsets, in seconds, per condition and run)
+    with the TR of each run read from its image header. Timings are
+    None without a datamat session per run, see `gather_events`.
     """
+    from .registry import acquisition
 
-    data_files = sorted(glob.glob(os.path.join(data_dir, subj, '*.nii.gz')))
-    phys_files = glob.glob(os.path.join(data_dir, subj, '*.1D'))
-    phys_files = group_phys(phys_files)
+    index = index or DatasetIndex(data_dir)
+    data_files, phys_files = find_inputs(data_dir, subj, index)
+    trs = [acquisition(echoes[0]).tr for echoes in data_files]
+    timings = gather_events(data_dir, subj, trs, index)[0]
+    return data_files, phys_files, timings
 
-    # some non-BIDS ugliness... works only for ATTA
-    dmat = (glob.glob(os.path.join(data_dir, subj, '*dmat.txt')))[0]
-    run_timings = split_dmat_txt(dmat)
-    sort_and_write(2, run_timings, subj)
-    timing_files = glob.glob(os.path.join(data_dir, subj, '*condition*.txt'))
-    timings = group_timings(timing_files)
 
-    return data_files, phys_files, timings
+def find_inputs(data_dir, subj, index=None):
+    """
+    Looks up the images (grouped by run, then echo) and physio
+    files ([ECG, Resp] per run) of a subject.
+    """
+    index = index or DatasetIndex(data_dir)
+    images = index.query(subj, 'bold')
+    data_files = group_echoes([f.path for f in images])
+    run_of = dict((f.path, f.run) for f in images)
+    data_files.sort(key=lambda echoes: run_of[echoes[0]] or 0)
+
+    phys_files = []
+    for echoes in data_files:
+        run = run_of[echoes[0]]
+        phys_files.append([f.path for kind in ('ECG', 'Resp')
+                           for f in index.query(subj, kind, run=run)])
+    return data_files, phys_files
+
+
+def gather_events(data_dir, subj, trs, index=None):
+    """
+    Parses the event timings of a subject from its datamat: a list
+    of onsets, in seconds, per condition and run, given the TR of
+    each run (see `find_inputs` for the order of runs).
+
+    Sessions are matched to runs in order, so every run's timings
+    are None unless the datamat has exactly one session per run;
+    `qc.check_sessions` reports the mismatch.
+
+    Outputs
+    -------
+    timings: list
+        the onsets of each run, or None
+    n_sessions: int
+        number of sessions in the datamat, 0 without one
+    """
+    from .file_manip import (parse_dmat, run_onsets, count_sessions)
+
+    index = index or DatasetIndex(data_dir)
+    # some non-BIDS ugliness... works only for ATTA
+    dmats = index.query(subj, 'dmat')
+    n_sessions = count_sessions(dmats[0].path) if dmats else 0
+    if n_sessions != len(trs):
+        return [None] * len(trs), n_sessions
+    run_timings = parse_dmat(dmats[0].path, trs)
+    timings = [run_onsets(run_timings, run)
+               for run in range(1, len(run_timings.n_conditions) + 1)]
+    return timings, n_sessions
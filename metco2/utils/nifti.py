@@ -0,0 +1,265 @@
+import os
+import json
+import gzip
+import shutil
+import hashlib
+import numpy as np
+import nibabel as nib
+from .pipeline import read_ahead
+
+# single-file NIfTI-1: 348 byte header plus the 4 byte extension flag
+VOX_OFFSET = 352
+
+# output formats and their file extensions: single-threaded gzip (as
+# written by nibabel), uncompressed, fast multithreaded gzip and a
+# chunked zarr store (one chunk per slice) for parallel reads
+FORMATS = {'nii.gz': '.nii.gz', 'nii': '.nii', 'fastgz': '.nii.gz',
+           'zarr': '.zarr'}
+
+# uncompressed bytes per independently compressed gzip member
+GZIP_BLOCK = 1 << 22
+
+
+def uncompressed_copy(in_file, cache_dir):
+    """
+    Returns an uncompressed copy of a NIfTI image that nibabel can
+    memory-map, decompressing `.nii.gz` files into `cache_dir` once.
+    Copies are named after the full path, size and modification
+    time of their source, so same-named inputs from different
+    folders, or a changed input, never share a copy. Remove them
+    with `remove_copies` once used.
+
+    Inputs
+    ------
+    in_file: file
+        NIfTI image, compressed or not
+    cache_dir: str
+        directory holding the uncompressed copies
+
+    Outputs
+    -------
+    file
+        uncompressed NIfTI image
+    """
+    out_file = cached_copy(in_file, cache_dir)
+    if out_file is not None:
+        return out_file
+
+    os.makedirs(cache_dir, exist_ok=True)
+    out_file = _copy_name(in_file, cache_dir)
+    tmp = '{}.{}.tmp'.format(out_file, os.getpid())
+    with gzip.open(in_file, 'rb') as src, open(tmp, 'wb') as dst:
+        shutil.copyfileobj(src, dst, 1 << 24)
+    os.replace(tmp, out_file)
+    return out_file
+
+
+def cached_copy(in_file, cache_dir):
+    """
+    Returns the up-to-date uncompressed copy of `in_file` in
+    `cache_dir` (or `in_file` itself if it isn't compressed), or
+    None if there is none yet.
+    """
+    if not in_file.endswith('.gz'):
+        return in_file
+    out_file = _copy_name(in_file, cache_dir)
+    return out_file if os.path.exists(out_file) else None
+
+
+def remove_copies(in_files, cache_dir):
+    """
+    Removes the uncompressed copies of `in_files` from `cache_dir`,
+    if any.
+    """
+    for in_file in in_files:
+        if not in_file.endswith('.gz'):
+            continue
+        try:
+            os.remove(_copy_name(in_file, cache_dir))
+        except OSError:
+            pass
+
+
+def _copy_name(in_file, cache_dir):
+    """
+    Name of the uncompressed copy of `in_file` within `cache_dir`.
+    """
+    stat = os.stat(in_file)
+    key = '{}:{}:{}'.format(os.path.abspath(in_file), stat.st_size,
+                            stat.st_mtime_ns)
+    return os.path.join(cache_dir, '{}_{}'.format(
+        hashlib.sha1(key.encode()).hexdigest()[:16],
+        os.path.basename(in_file)[:-3]))
+
+
+def create_nifti(out_file, header, shape, dtype=np.float32):
+    """
+    Creates an uncompressed NIfTI image on disk and returns a
+    writable memory map of its (Fortran-ordered) data block, so
+    the image can be filled in incrementally.
+
+    Inputs
+    ------
+    out_file: file
+        uncompressed NIfTI image to create
+    header: Nifti1Header
+        header to copy geometry and timing from
+    shape: tuple
+        shape of the image
+    dtype: dtype
+        (Optional) on-disk data type. Defaults to float32.
+
+    Outputs
+    -------
+    array-like
+        writable memory map of the image data
+    """
+    hdr = header.copy()
+    del hdr.extensions[:]
+    hdr.set_data_shape(shape)
+    hdr.set_data_dtype(dtype)
+    hdr.set_slope_inter(1, 0)
+    hdr.set_data_offset(VOX_OFFSET)
+
+    n_bytes = int(np.prod(shape, dtype=np.int64)) * np.dtype(dtype).itemsize
+    with open(out_file, 'wb') as f:
+        hdr.write_to(f)
+        f.truncate(VOX_OFFSET + n_bytes)
+    return np.memmap(out_file, dtype=hdr.get_data_dtype(), mode='r+',
+                     offset=VOX_OFFSET, shape=shape, order='F')
+
+
+def compress(in_file, out_file, level=9, n_threads=1):
+    """
+    Gzip-compresses `in_file` into `out_file`, then removes `in_file`.
+    With several threads, blocks are compressed in parallel as
+    separate gzip members, which any gzip reader concatenates.
+
+    Inputs
+    ------
+    in_file: file
+        file to compress
+    out_file: file
+        compressed file to write
+    level: int
+        (Optional) compression level, from 1 (fastest) to 9.
+    n_threads: int
+        (Optional) number of compressing threads.
+    """
+    with open(in_file, 'rb') as src, open(out_file, 'wb') as dst:
+        blocks = iter(lambda: src.read(GZIP_BLOCK), b'')
+        for member in read_ahead(
+                lambda block: gzip.compress(block, level, mtime=0),
+                blocks, depth=n_threads, n_threads=n_threads):
+            dst.write(member)
+    os.remove(in_file)
+    return out_file
+
+
+def output_name(fname, output_format='nii.gz'):
+    """
+    Replaces the NIfTI extension of `fname` by that of `output_format`.
+    """
+    for ext in ('.nii.gz', '.nii'):
+        if fname.endswith(ext):
+            fname = fname[:-len(ext)]
+            break
+    return fname + FORMATS[output_format]
+
+
+def sidecar(fname):
+    """
+    Returns the JSON sidecar of an output file.
+    """
+    for ext in sorted(FORMATS.values(), key=len, reverse=True):
+        if fname.endswith(ext):
+            return fname[:-len(ext)] + '.json'
+    return fname + '.json'
+
+
+def create_zarr(out_file, ref_img, shape, dtype=np.float32):
+    """
+    Creates a zarr array with one chunk per slice (and all volumes),
+    storing the affine of `ref_img`, and returns it so it can be
+    filled in incrementally.
+    """
+    try:
+        import zarr
+    except ImportError:
+        raise RuntimeError('The zarr output format requires the zarr '
+                           'package: pip install zarr')
+    shutil.rmtree(out_file, ignore_errors=True)
+    arr = zarr.open_array(out_file, mode='w', shape=shape,
+                          chunks=shape[:2] + (1,) + shape[3:], dtype=dtype)
+    arr.attrs['affine'] = np.asarray(ref_img.affine).tolist()
+    arr.attrs['zooms'] = [float(z) for z in ref_img.header.get_zooms()]
+    return arr
+
+
+def save(data, ref_img, out_file, output_format='nii.gz', n_threads=None):
+    """
+    Saves `data` as a float32 image on the grid of `ref_img`.
+
+    Inputs
+    ------
+    data: array-like
+        image data
+    ref_img: Nifti1Image
+        image to copy the geometry and timing from
+    out_file: file
+        name of the output, see `output_name`
+    output_format: str
+        (Optional) one of `FORMATS`. Defaults to 'nii.gz'.
+    n_threads: int
+        (Optional) compressing threads for 'fastgz'. Defaults to
+        the number of CPUs.
+
+    Outputs
+    -------
+    file
+        `out_file`
+    """
+    if output_format == 'zarr':
+        create_zarr(out_file, ref_img, data.shape)[...] = data
+        return out_file
+
+    out_img = nib.Nifti1Image(data, ref_img.affine, ref_img.header)
+    out_img.set_data_dtype(np.float32)
+    if output_format == 'fastgz':
+        tmp = '{}.{}.nii'.format(out_file, os.getpid())
+        out_img.to_filename(tmp)
+        return compress(tmp, out_file, level=1,
+                        n_threads=n_threads or os.cpu_count() or 1)
+    out_img.to_filename(out_file)
+    return out_file
+
+
+def write_sidecar(out_file, **fields):
+    """
+    Writes the JSON sidecar of `out_file`, e.g. its volume labels.
+    """
+    fname = sidecar(out_file)
+    with open(fname, 'w') as f:
+        json.dump(fields, f, indent=2)
+    return fname
+
+
+def disk_usage(fname):
+    """
+    Returns the size of a file, or of all files under a folder
+    (e.g. a zarr store), in bytes.
+    """
+    if not os.path.isdir(fname):
+        return os.path.getsize(fname)
+    return sum(os.path.getsize(os.path.join(root, f))
+               for root, _, files in os.walk(fname) for f in files)
+
+
+def load(in_file, cache_dir=None):
+    """
+    Loads a NIfTI image without reading its data, memory-mapping
+    an uncompressed copy when `cache_dir` is given.
+    """
+    if cache_dir is not None:
+        in_file = uncompressed_copy(in_file, cache_dir)
+    return nib.load(in_file, mmap=True)
@@ -1,12 +1,42 @@
-import peakdet
+import os
+import shutil
+import warnings
 import numpy as np
+from itertools import islice
 from math import (pi, sqrt)
-from scipy.signal import convolve
+from functools import lru_cache
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor)
+from .registry import (ATTA, window)
 
-# NOTE: the argument values are specific to the ATTA scan sequence
+# NOTE: the argument values are specific to the ATTA scan sequence; runs
+# pass their own acquisition (see `registry.acquisition`) instead
+SAMPLERATE = 40
+TR = ATTA.tr
+START, END = window(ATTA)
+# lowest peak height, as a fraction of the trace's range: 0.2 is the
+# threshold `rvt` has always passed to peakdet; the numpy method uses a
+# higher one for PPG, whose dicrotic notch can rise well above a fifth
+# of the range. Neither is calibrated: check them against peakdet on
+# real recordings with `python -m benchmarks.physio --recordings`
+RESP_THRESH = 0.2
+PPG_THRESH = 0.4
 
+# minimum time between beats and between breaths, in seconds: the
+# fastest plausible rates, 200 beats per minute as in the QC bounds
+# (`qc.HEART_RATE`), and 60 breaths per minute, above `qc.BREATH_RATE`
+MIN_BEAT = 0.3
+MIN_BREATH = 1.0
 
-def convolve_ts(physio_f):
+# how the low-frequency series are derived: with peakdet, or with the
+# vectorized implementation below, which handles many traces at once
+METHODS = ('peakdet', 'numpy')
+
+# samples per window when streaming a recording to the peak detector or
+# parsing it into its sidecar, so memory stays flat whatever its length
+WINDOW = 2 ** 16
+
+
+def convolve_ts(physio_f, acq=None, method='peakdet'):
     """
     Calculates and convolves the low-frequency physio timeseries
     (either instantaneous heart-rate [iHR] or respiratory-volume-
@@ -16,26 +46,223 @@ def convolve_ts(physio_f):
     ------
     physio_f: file
         A plain-text file containing the sampled physio time series.
+    acq: Acquisition
+        (Optional) acquisition of the run. Defaults to ATTA's.
+    method: str
+        (Optional) 'peakdet' or 'numpy'. Defaults to 'peakdet'.
 
     Outputs
     -------
     array-like
         The sampled, low-frequency physiology confound convolved
-        with the correct response function.
-    """
-    if 'ECG' in physio_f:
-        timeseries = i_hr(physio_f)
-        response_func = crf()
-    elif 'Resp' in physio_f:
-        timeseries = rvt(physio_f)
-        response_func = rrf()
+        with the correct response function. Raises a ValueError
+        if the type of recording is not understood.
+    """
+    from scipy.signal import convolve
+
+    kind = _check_kind(physio_f)
+    acq = acq or ATTA
+    return convolve(derive_ts(physio_f, acq, method),
+                    RESPONSE_FUNCS[kind](acq.tr), mode='same')
+
+
+def physio_kind(physio_f):
+    """
+    Identifies the type of physio recording from its file name.
+
+    Inputs
+    ------
+    physio_f: file
+        A plain-text file containing the sampled physio time series.
+
+    Outputs
+    -------
+    str
+        'ECG' or 'Resp', or None if the format is not understood
+    """
+    for kind in ('ECG', 'Resp'):
+        if kind in physio_f:
+            return kind
+
+
+def _check_kind(physio_f):
+    """
+    Returns the type of a physio recording, raising a ValueError
+    naming the file if it is not understood.
+    """
+    kind = physio_kind(physio_f)
+    if kind is None:
+        raise ValueError('Physio format not understood: '
+                         '{}'.format(physio_f))
+    return kind
+
+
+def physio_params(physio_f, acq=None, method='peakdet'):
+    """
+    Collects every parameter that determines the confound
+    derived from `physio_f`, e.g. for use as a cache key.
+
+    Inputs
+    ------
+    physio_f: file
+        A plain-text file containing the sampled physio time series.
+    acq: Acquisition
+        (Optional) acquisition of the run. Defaults to ATTA's.
+    method: str
+        (Optional) 'peakdet' or 'numpy'. Defaults to 'peakdet'.
+
+    Outputs
+    -------
+    dict
+        derivation and response function parameters
+    """
+    kind = _check_kind(physio_f)
+    acq = acq or ATTA
+    start, end = window(acq)
+    params = dict(kind=kind, samplerate=SAMPLERATE, tr=acq.tr, start=start,
+                  end=end, kernel=RESPONSE_FUNCS[kind].__name__)
+    if kind == 'Resp':
+        params['thresh'] = RESP_THRESH
+    if method == 'numpy':
+        params.update(method=method, min_interval=MIN_BEAT
+                      if kind == 'ECG' else MIN_BREATH)
+        if kind == 'ECG':
+            params['thresh'] = PPG_THRESH
+    return params
+
+
+def derive_ts(physio_f, acq=None, method='peakdet'):
+    """
+    Calculates the low-frequency physio timeseries (iHR or RVT),
+    before convolution with its response function.
+
+    Inputs
+    ------
+    physio_f: file
+        A plain-text file containing the sampled physio time series.
+    acq: Acquisition
+        (Optional) acquisition of the run, whose volumes the series
+        is binned to. Defaults to ATTA's.
+    method: str
+        (Optional) 'peakdet', or 'numpy' for the vectorized
+        implementation. Defaults to 'peakdet'.
+
+    Outputs
+    -------
+    array-like
+        The sampled, low-frequency physiology timeseries.
+    """
+    if method == 'numpy':
+        return derive_batch([physio_f], [acq or ATTA])[0]
+    kind = physio_kind(physio_f)
+    acq = acq or ATTA
+    start, end = window(acq)
+    if kind == 'ECG':
+        return i_hr(physio_f, tr=acq.tr, start=start, end=end)
+    elif kind == 'Resp':
+        return rvt(physio_f, tr=acq.tr, start=start, end=end)
+    raise ValueError('Physio format not understood: {}'.format(physio_f))
+
+
+def convolve_batch(physio_files, n_jobs=None, backend='process',
+                   cache=None, acquisitions=None, method='peakdet'):
+    """
+    Calculates and convolves the low-frequency physio timeseries
+    for many files at once. Peak detection runs on a worker pool;
+    series sharing a type and length are then stacked and convolved
+    with their (cached) response function in a single call.
+
+    Inputs
+    ------
+    physio_files: list
+        Plain-text files containing sampled physio time series.
+    n_jobs: int
+        (Optional) number of workers used for peak detection.
+        Defaults to the number of CPUs.
+    backend: str
+        (Optional) 'process' or 'thread'. Peak detection holds
+        the GIL, so processes are the default.
+    cache: RegressorCache
+        (Optional) cache of previously derived confounds.
+    acquisitions: list
+        (Optional) the `Acquisition` of the run of each file.
+        Defaults to ATTA's.
+    method: str
+        (Optional) 'peakdet', or 'numpy' to derive all series in a
+        few vectorized calls instead of on a worker pool.
+        Defaults to 'peakdet'.
+
+    Outputs
+    -------
+    list
+        The convolved physiology confounds, in the order of
+        `physio_files`.
+    """
+    physio_files = list(physio_files)
+    acquisitions = list(acquisitions or [ATTA] * len(physio_files))
+    convolved = [None] * len(physio_files)
+    keys = [None] * len(physio_files)
+    if cache is not None:
+        for i, physio_f in enumerate(physio_files):
+            keys[i] = cache.key(physio_f, **physio_params(
+                physio_f, acquisitions[i], method))
+            convolved[i] = cache.get(keys[i])
+    todo = [i for i, ts in enumerate(convolved) if ts is None]
+    if not todo:
+        return convolved
+
+    if method == 'numpy':
+        series = dict(zip(todo, derive_batch(
+            [physio_files[i] for i in todo],
+            [acquisitions[i] for i in todo])))
     else:
-        print('WARNING: Physio format not understood! \n'
-              'No confound timeseries will be generated.')
-        return
-    return convolve(timeseries, response_func, mode='same')
+        executor = {'process': ProcessPoolExecutor,
+                    'thread': ThreadPoolExecutor}[backend]
+        with executor(max_workers=n_jobs) as pool:
+            series = dict(zip(todo, pool.map(
+                derive_ts, [physio_files[i] for i in todo],
+                [acquisitions[i] for i in todo])))
+
+    groups = {}
+    for i, ts in series.items():
+        kind = physio_kind(physio_files[i])
+        groups.setdefault((kind, len(ts), acquisitions[i].tr), []).append(i)
+
+    for (kind, _, tr), idx in groups.items():
+        stacked = np.vstack([series[i] for i in idx])
+        for i, ts in zip(idx, convolve_rows(stacked,
+                                            RESPONSE_FUNCS[kind](tr))):
+            convolved[i] = ts
+            if cache is not None:
+                cache.put(keys[i], ts)
+    return convolved
+
 
+def convolve_rows(timeseries, response_func):
+    """
+    Convolves every row of `timeseries` with `response_func`,
+    choosing between direct and FFT convolution by size.
+
+    Inputs
+    ------
+    timeseries: array-like
+        2D array of physio time series, one per row.
+    response_func: array-like
+        1D response function.
 
+    Outputs
+    -------
+    array-like
+        The convolved time series, with the shape of `timeseries`.
+    """
+    from scipy.signal import (convolve, choose_conv_method)
+
+    kernel = np.asarray(response_func)[np.newaxis, :]
+    method = choose_conv_method(timeseries, kernel, mode='same')
+    return convolve(timeseries, kernel, mode='same', method=method)
+
+
+@lru_cache()
 def crf(tr=2.0):
     """
     Calculate the cardiac response function using the definition
@@ -60,10 +287,11 @@ def crf(tr=2.0):
     t = np.arange(0, 32, tr)
     crf = _crf(t)
     crf = crf / max(abs(crf))
+    crf.setflags(write=False)  # cached, so shared between callers
     return crf
 
 
-def i_hr(physio_f, samplerate=40, tr=2.0):
+def i_hr(physio_f, samplerate=SAMPLERATE, tr=TR, start=START, end=END):
     """
     Calculates the instantaneous heart rate (iHR)
     from a raw PPG time series.
@@ -79,18 +307,24 @@ def i_hr(physio_f, samplerate=40, tr=2.0):
         (Optional) sampling frequency of the MRI time series,
         for binning the instantaneous heart rate time series.
         Defaults to 2.0 seconds.
+    start, end: float
+        (Optional) times of the first volume and of the end of the
+        last one within the recording, in seconds. Default to ATTA's
+        8.0 and 438.0 seconds.
 
     Outputs
     -------
     array-like
         instantaneous heart rate (iHR) time series
     """
-    datafile = physio_f
-    ppg = peakdet.PPG(datafile, samplerate)
+    import peakdet
+
+    ppg = _peakdet_load(peakdet.PPG, physio_f, samplerate)
     ppg.get_peaks()
-    return ppg.iHR(step=2, start=8.0, end=438.0, TR=tr)
+    return ppg.iHR(step=2, start=start, end=end, TR=tr)
 
 
+@lru_cache()
 def rrf(tr=2.0):
     """
     Calculate the respiratory response function using the definition
@@ -115,10 +349,11 @@ def rrf(tr=2.0):
     t = np.arange(0, 50, tr)
     rrf = _rrf(t)
     rrf = rrf / max(abs(rrf))
+    rrf.setflags(write=False)  # cached, so shared between callers
     return rrf
 
 
-def rvt(physio_f, samplerate=40, tr=2.0):
+def rvt(physio_f, samplerate=SAMPLERATE, tr=TR, start=START, end=END):
     """
     Calculates the respiratory-volume-per-time (RVT)
      from a raw pneumatic belt time series.
@@ -134,13 +369,509 @@ def rvt(physio_f, samplerate=40, tr=2.0):
         (Optional) sampling frequency of the MRI time series,
         for binning the instantaneous heart rate time series.
         Defaults to 2.0 seconds.
+    start, end: float
+        (Optional) times of the first volume and of the end of the
+        last one within the recording, in seconds. Default to ATTA's
+        8.0 and 438.0 seconds.
 
     Outputs
     -------
     array-like
         respiratory-volume-per-time (RVT) time series
     """
-    datafile = physio_f
-    resp = peakdet.RESP(datafile, samplerate)
-    resp.get_peaks(thresh=0.2)
-    return resp.RVT(start=8.0, end=438.0, TR=tr)
+    import peakdet
+
+    resp = _peakdet_load(peakdet.RESP, physio_f, samplerate)
+    resp.get_peaks(thresh=RESP_THRESH)
+    return resp.RVT(start=start, end=end, TR=tr)
+
+
+def _peakdet_load(modality, physio_f, samplerate):
+    """
+    Loads a recording into a peakdet `modality` (PPG or RESP) from
+    its parsed sidecar, see `load_physio`, falling back to the text
+    file for peakdet versions that only read files.
+    """
+    try:
+        return modality(np.asarray(load_physio(physio_f)), samplerate)
+    except (TypeError, ValueError):
+        return modality(physio_f, samplerate)
+
+
+def load_physio(physio_f, mmap=True):
+    """
+    Loads a plain-text physio recording. The text is parsed once,
+    `WINDOW` lines at a time, into a `.npy` sidecar next to the file
+    (refreshed whenever the text file is newer), which later loads
+    memory-map instead.
+
+    Inputs
+    ------
+    physio_f: file
+        A plain-text file containing the sampled physio time series.
+    mmap: bool
+        (Optional) memory-map the sidecar rather than reading it.
+        Defaults to True.
+
+    Outputs
+    -------
+    array-like
+        the sampled physio time series
+    """
+    sidecar = physio_f + '.npy'
+    try:
+        if os.path.getmtime(sidecar) >= os.path.getmtime(physio_f):
+            return np.load(sidecar, mmap_mode='r' if mmap else None)
+    except (IOError, OSError, ValueError):
+        pass
+
+    tmp = '{}.{}.tmp'.format(sidecar, os.getpid())
+    try:
+        _write_sidecar(physio_f, tmp)
+        os.replace(tmp, sidecar)
+    except (IOError, OSError):
+        # read-only dataset: fall back to parsing the text every time
+        return np.loadtxt(physio_f, ndmin=1)
+    return np.load(sidecar, mmap_mode='r' if mmap else None)
+
+
+def _write_sidecar(physio_f, out_file, window=WINDOW):
+    """
+    Parses a plain-text recording into the `.npy` file `out_file`,
+    `window` lines at a time: the parsed samples are appended to a
+    raw file, then copied behind the `.npy` header once their count
+    is known.
+    """
+    raw = out_file + '.raw'
+    n_rows, n_cols = 0, 1
+    try:
+        with open(physio_f) as f, open(raw, 'wb') as out:
+            while True:
+                lines = list(islice(f, window))
+                if not lines:
+                    break
+                with warnings.catch_warnings():
+                    # a chunk may hold only comments or blank lines
+                    warnings.simplefilter('ignore', UserWarning)
+                    data = np.loadtxt(lines, ndmin=2)
+                del lines  # before reading the next chunk
+                if data.size:
+                    n_rows, n_cols = n_rows + len(data), data.shape[1]
+                    out.write(np.ascontiguousarray(data,
+                                                   dtype=np.float64).data)
+        shape = (n_rows,) if n_cols == 1 else (n_rows, n_cols)
+        with open(out_file, 'wb') as out, open(raw, 'rb') as f:
+            np.lib.format.write_array_header_1_0(out, dict(
+                descr=np.lib.format.dtype_to_descr(np.dtype(np.float64)),
+                fortran_order=False, shape=shape))
+            shutil.copyfileobj(f, out)
+    finally:
+        if os.path.exists(raw):
+            os.remove(raw)
+
+
+def stack_traces(traces):
+    """
+    Stacks 1D traces of different lengths into one 2D array,
+    padding the shorter ones with NaN.
+    """
+    stacked = np.full((len(traces), max(len(t) for t in traces)), np.nan)
+    for row, trace in zip(stacked, traces):
+        row[:len(trace)] = trace
+    return stacked
+
+
+def find_extrema(traces, distance, thresh, bounds=None):
+    """
+    Finds the peaks of many traces at once: samples that are the
+    maximum of the `distance` samples on either side, and that lie
+    above `thresh` of the range of their trace.
+
+    Inputs
+    ------
+    traces: array-like
+        2D array of traces, one per row, NaN-padded
+    distance: int
+        minimum number of samples between peaks
+    thresh: float
+        minimum peak height, as a fraction of the trace range
+    bounds: tuple
+        (Optional) (minimum, maximum) of each trace, as columns, if
+        `traces` holds only part of them. Defaults to their range
+        within `traces`.
+
+    Outputs
+    -------
+    rows, cols: array-like
+        trace and sample index of every peak, sorted by both
+    """
+    filled = np.where(np.isnan(traces), -np.inf, traces)
+    padded = np.pad(filled, ((0, 0), (distance, distance)),
+                    constant_values=-np.inf)
+    local_max = _running_max(padded, 2 * distance + 1)
+    if bounds is None:
+        lo = np.nanmin(traces, axis=1, keepdims=True)
+        hi = np.nanmax(traces, axis=1, keepdims=True)
+    else:
+        lo, hi = bounds
+    is_peak = ((filled == local_max) & np.isfinite(filled) &
+               (filled >= lo + thresh * (hi - lo)))
+    # keep only the first sample of a flat peak
+    is_peak[:, 1:] &= ~(is_peak[:, :-1] & (filled[:, 1:] == filled[:, :-1]))
+    return np.nonzero(is_peak)
+
+
+def iter_windows(data, window=WINDOW, overlap=0):
+    """
+    Yields consecutive fixed-size windows of `data`, each extended
+    by `overlap` samples on both sides. Windows of a memory-mapped
+    array are views, so only the current window is ever paged in.
+
+    Inputs
+    ------
+    data: array-like
+        1D physio time series
+    window: int
+        (Optional) number of samples per window.
+    overlap: int
+        (Optional) number of extra samples on either side.
+
+    Outputs
+    -------
+    generator
+        (offset, start, segment) tuples, where `offset` is the index
+        of the window's first (non-overlap) sample and `start` that of
+        the first sample of `segment`
+    """
+    for offset in range(0, len(data), window):
+        start = max(offset - overlap, 0)
+        yield offset, start, data[start:offset + window + overlap]
+
+
+def stream_extrema(traces, distance, thresh, troughs=False, window=WINDOW):
+    """
+    Finds the peaks of many traces of any length, exactly as
+    `find_extrema` on the whole traces, while holding one window of
+    each in memory at a time. Windows overlap by `distance` samples,
+    plus the one before that the flat-peak rule looks at, so peaks
+    at their edges are judged on the same samples; each keeps only
+    the peaks among its own samples.
+
+    Inputs
+    ------
+    traces: list
+        1D traces, e.g. memory-mapped sidecars (see `load_physio`),
+        or a 2D array of traces, one per row, NaN-padded
+    distance: int
+        minimum number of samples between peaks
+    thresh: float
+        minimum peak height, as a fraction of the trace range
+    troughs: bool
+        (Optional) find the troughs instead.
+    window: int
+        (Optional) number of samples per window.
+
+    Outputs
+    -------
+    rows, cols: array-like
+        trace and sample index of every peak, sorted by both
+    """
+    sign = -1. if troughs else 1.
+    # the threshold is relative to the range of the whole trace
+    ranges = np.array([_trace_range(trace, window) for trace in traces],
+                      dtype=float).reshape(-1, 2)
+    lo, hi = ranges[:, :1], ranges[:, 1:]
+    bounds = (-hi, -lo) if troughs else (lo, hi)
+    overlap = distance + 1
+
+    rows, cols = [], []
+    for offset in range(0, max((len(t) for t in traces), default=0),
+                        window):
+        start = max(offset - overlap, 0)
+        segment = stack_traces([
+            np.asarray(trace[start:offset + window + overlap], dtype=float)
+            for trace in traces])
+        found_rows, found_cols = find_extrema(sign * segment, distance,
+                                              thresh, bounds)
+        found_cols = found_cols + start
+        own = (found_cols >= offset) & (found_cols < offset + window)
+        rows.append(found_rows[own])
+        cols.append(found_cols[own])
+    if not rows:
+        return np.array([], dtype=np.intp), np.array([], dtype=np.intp)
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    order = np.lexsort((cols, rows))
+    return rows[order], cols[order]
+
+
+def _trace_range(trace, window=WINDOW):
+    """
+    Minimum and maximum of a trace, ignoring NaN, read one window
+    at a time.
+    """
+    lo, hi = np.inf, -np.inf
+    for _, _, segment in iter_windows(trace, window):
+        segment = np.asarray(segment, dtype=float)
+        segment = segment[~np.isnan(segment)]
+        if segment.size:
+            lo, hi = min(lo, segment.min()), max(hi, segment.max())
+    return lo, hi
+
+
+def _take(traces, rows, cols):
+    """
+    Samples of `traces` at (`rows`, `cols`), reading only those.
+    """
+    values = np.empty(len(rows))
+    for row in np.unique(rows):
+        at = rows == row
+        values[at] = traces[row][cols[at]]
+    return values
+
+
+def _running_max(data, width):
+    """
+    Maximum of every `width` consecutive samples along the rows of
+    `data`, built from maxima over doubling spans, so it costs
+    log2(`width`) passes rather than `width`.
+    """
+    span = 1
+    while 2 * span <= width:
+        data = np.maximum(data[:, :-span], data[:, span:])
+        span *= 2
+    rest = width - span
+    if rest:
+        data = np.maximum(data[:, :-rest], data[:, rest:])
+    return data
+
+
+def bin_to_volumes(rows, times, values, n_traces, acq):
+    """
+    Averages events (e.g. beats) into the volumes of `acq`, filling
+    volumes without events from their nearest preceding (or, at the
+    start, following) volume.
+
+    Inputs
+    ------
+    rows: array-like
+        trace index of every event
+    times: array-like
+        time of every event within its recording, in seconds
+    values: array-like
+        value of every event
+    n_traces: int
+        number of traces
+    acq: Acquisition
+        acquisition whose volumes the events are binned to
+
+    Outputs
+    -------
+    array-like
+        binned series, of shape (n_traces, n_vols)
+    """
+    start, _ = window(acq)
+    n_bins = acq.n_vols
+    bins = np.floor((times - start) / acq.tr).astype(int)
+    valid = (bins >= 0) & (bins < n_bins)
+    idx = rows[valid] * n_bins + bins[valid]
+    sums = np.bincount(idx, values[valid], minlength=n_traces * n_bins)
+    counts = np.bincount(idx, minlength=n_traces * n_bins)
+    with np.errstate(invalid='ignore'):
+        binned = (sums / counts).reshape(n_traces, n_bins)
+
+    # forward, then backward fill empty volumes
+    has = ~np.isnan(binned)
+    cols = np.arange(n_bins)
+    fwd = np.maximum.accumulate(np.where(has, cols, 0), axis=1)
+    binned = np.where(has, binned,
+                      np.take_along_axis(binned, fwd, axis=1))
+    has = ~np.isnan(binned)
+    bwd = np.minimum.accumulate(np.where(has, cols, n_bins - 1)[:, ::-1],
+                                axis=1)[:, ::-1]
+    return np.take_along_axis(binned, bwd, axis=1)
+
+
+def covered_volumes(n_samples, acq, samplerate=SAMPLERATE):
+    """
+    Number of leading volumes of `acq` that the confound derived
+    from a recording of `n_samples` samples covers: those ending
+    within the recording. `bin_to_volumes` fills any later ones
+    from the last covered volume, so they carry no signal.
+    """
+    ends = acq.start + acq.tr * np.arange(1, acq.n_vols + 1)
+    return int((np.ceil(ends * samplerate) <= n_samples).sum())
+
+
+def i_hr_batch(traces, acq=None, samplerate=SAMPLERATE, thresh=PPG_THRESH,
+               min_interval=MIN_BEAT, window=WINDOW):
+    """
+    Calculates the instantaneous heart rate (iHR) of many PPG traces
+    at once, from beat-to-beat intervals binned to the volumes.
+
+    Inputs
+    ------
+    traces: array-like
+        2D array of PPG traces, one per row, NaN-padded, or a list
+        of 1D traces of any length, e.g. memory-mapped sidecars
+    acq: Acquisition
+        (Optional) acquisition of the runs. Defaults to ATTA's.
+    samplerate: int
+        (Optional) sampling frequency of the traces. Defaults to 40Hz.
+    thresh: float
+        (Optional) minimum beat height, as a fraction of the range.
+    min_interval: float
+        (Optional) minimum time between beats, in seconds.
+    window: int
+        (Optional) samples per window of peak detection, see
+        `stream_extrema`.
+
+    Outputs
+    -------
+    array-like
+        iHR time series, in beats per minute, of shape
+        (n_traces, n_vols)
+    """
+    traces = _as_traces(traces)
+    rows, cols = stream_extrema(traces,
+                                max(int(min_interval * samplerate), 1),
+                                thresh, window=window)
+    times = cols / float(samplerate)
+    same = rows[1:] == rows[:-1]
+    return bin_to_volumes(rows[1:][same], times[1:][same],
+                          60. / np.diff(times)[same], len(traces),
+                          acq or ATTA)
+
+
+def rvt_batch(traces, acq=None, samplerate=SAMPLERATE, thresh=RESP_THRESH,
+              min_interval=MIN_BREATH, window=WINDOW):
+    """
+    Calculates the respiratory-volume-per-time (RVT) of many belt
+    traces at once: the depth of each breath (peak minus preceding
+    trough) over its period, binned to the volumes.
+
+    Inputs
+    ------
+    traces: array-like
+        2D array of RESP traces, one per row, NaN-padded, or a list
+        of 1D traces of any length, e.g. memory-mapped sidecars
+    acq: Acquisition
+        (Optional) acquisition of the runs. Defaults to ATTA's.
+    samplerate: int
+        (Optional) sampling frequency of the traces. Defaults to 40Hz.
+    thresh: float
+        (Optional) minimum peak height (and trough depth), as a
+        fraction of the range.
+    min_interval: float
+        (Optional) minimum time between breaths, in seconds.
+    window: int
+        (Optional) samples per window of peak detection, see
+        `stream_extrema`.
+
+    Outputs
+    -------
+    array-like
+        RVT time series, of shape (n_traces, n_vols)
+    """
+    traces = _as_traces(traces)
+    n_samples = max(len(trace) for trace in traces)
+    distance = max(int(min_interval * samplerate), 1)
+    p_rows, p_cols = stream_extrema(traces, distance, thresh, window=window)
+    t_rows, t_cols = stream_extrema(traces, distance, thresh, troughs=True,
+                                    window=window)
+
+    # the last trough before each peak, within the same trace
+    prev = np.searchsorted(t_rows * n_samples + t_cols,
+                           p_rows * n_samples + p_cols) - 1
+    has_trough = prev >= 0
+    prev = np.maximum(prev, 0)
+    has_trough &= t_rows[prev] == p_rows
+    depth = (_take(traces, p_rows, p_cols) -
+             _take(traces, t_rows[prev], t_cols[prev]))
+
+    times = p_cols / float(samplerate)
+    keep = (p_rows[1:] == p_rows[:-1]) & has_trough[1:]
+    return bin_to_volumes(p_rows[1:][keep], times[1:][keep],
+                          depth[1:][keep] / np.diff(times)[keep],
+                          len(traces), acq or ATTA)
+
+
+def _as_traces(traces):
+    """
+    Wraps a single 1D trace as a list of one, leaving a 2D array or
+    a list of traces as they are.
+    """
+    if isinstance(traces, np.ndarray) and traces.ndim == 1:
+        return [traces]
+    return traces
+
+
+def derive_batch(physio_files, acquisitions=None):
+    """
+    Derives the low-frequency series of many files with the
+    vectorized implementation, one call per type of recording
+    and acquisition. Recordings are streamed from their memory-
+    mapped sidecars a window at a time, see `stream_extrema`.
+
+    Inputs
+    ------
+    physio_files: list
+        Plain-text files containing sampled physio time series.
+    acquisitions: list
+        (Optional) the `Acquisition` of the run of each file.
+        Defaults to ATTA's.
+
+    Outputs
+    -------
+    list
+        the low-frequency series, in the order of `physio_files`
+    """
+    acquisitions = list(acquisitions or [ATTA] * len(physio_files))
+    groups = {}
+    for i, (physio_f, acq) in enumerate(zip(physio_files, acquisitions)):
+        groups.setdefault((_check_kind(physio_f), acq), []).append(i)
+
+    series = [None] * len(physio_files)
+    batch = {'ECG': i_hr_batch, 'Resp': rvt_batch}
+    for (kind, acq), idx in groups.items():
+        traces = [load_physio(physio_files[i]) for i in idx]
+        for i, ts in zip(idx, batch[kind](traces, acq)):
+            series[i] = ts
+    return series
+
+
+def traces_to_confounds(ppg=None, resp=None, acq=None, samplerate=SAMPLERATE):
+    """
+    Derives the convolved iHR and RVT confounds of a run from
+    traces held in memory, with the vectorized implementation.
+
+    Inputs
+    ------
+    ppg: array-like
+        (Optional) PPG trace of the run.
+    resp: array-like
+        (Optional) respiratory belt trace of the run.
+    acq: Acquisition
+        (Optional) acquisition of the run. Defaults to ATTA's.
+    samplerate: int
+        (Optional) sampling frequency of the traces. Defaults to 40Hz.
+
+    Outputs
+    -------
+    array-like
+        the confounds, of shape (n_vols, n_traces), iHR first
+    """
+    acq = acq or ATTA
+    confounds = []
+    for kind, trace, derive in (('ECG', ppg, i_hr_batch),
+                                ('Resp', resp, rvt_batch)):
+        if trace is not None:
+            series = derive(np.asarray(trace, dtype=float)[np.newaxis],
+                            acq, samplerate=samplerate)
+            confounds.append(convolve_rows(series,
+                                           RESPONSE_FUNCS[kind](acq.tr))[0])
+    if not confounds:
+        raise ValueError('At least one of ppg and resp is required.')
+    return np.column_stack(confounds)
+
+
+RESPONSE_FUNCS = {'ECG': crf, 'Resp': rrf}
@@ -0,0 +1,128 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def read_ahead(func, items, depth=1, n_threads=1):
+    """
+    Yields `func(item)` for every item, in order, computing up to
+    `depth` results ahead in background threads, so that reading
+    (e.g. decompressing) the next item overlaps with processing the
+    current one. At most `depth` + 1 results are held at a time.
+
+    Inputs
+    ------
+    func: callable
+        called with each item, e.g. to read it from disk
+    items: iterable
+        the items to process
+    depth: int
+        (Optional) number of results computed ahead. Defaults to 1.
+    n_threads: int
+        (Optional) number of threads computing results. Defaults to 1.
+    """
+    futures = deque()
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        for item in items:
+            futures.append(pool.submit(func, item))
+            if len(futures) > depth:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
+class BackgroundWriter(object):
+    """
+    Runs write-out tasks (e.g. saving and compressing images) on
+    background threads, blocking new submissions while `max_pending`
+    tasks are unfinished. Exceptions are raised on exit.
+
+    Parameters
+    ----------
+    n_threads: int
+        (Optional) number of concurrent writes. Defaults to 2.
+    max_pending: int
+        (Optional) maximum number of unfinished tasks, which bounds
+        the memory held by queued outputs. Defaults to `n_threads`.
+    """
+    def __init__(self, n_threads=2, max_pending=None):
+        self._pool = ThreadPoolExecutor(max_workers=n_threads)
+        self._slots = threading.BoundedSemaphore(max_pending or n_threads)
+        self._futures = []
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Schedules `func(*args, **kwargs)`, waiting for a free slot.
+        """
+        self._slots.acquire()
+        future = self._pool.submit(func, *args, **kwargs)
+        future.add_done_callback(lambda f: self._slots.release())
+        self._futures.append(future)
+        return future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._pool.shutdown(wait=True)
+        if exc_type is None:
+            for future in self._futures:
+                future.result()
+        return False
+
+
+class Prefetcher(object):
+    """
+    Prepares queued items (e.g. decompresses the images of upcoming
+    runs) on a background thread, in order, staying at most `depth`
+    items ahead of the consumer. Failures are only reported, since
+    the consumer still does the work itself when needed.
+
+    Parameters
+    ----------
+    items: list
+        the queued items, in their expected order of use
+    func: callable
+        called with each item to prepare it
+    depth: int
+        (Optional) maximum number of prepared, unused items.
+        Defaults to 1.
+    """
+    def __init__(self, items, func, depth=1):
+        self.func = func
+        self._queue = list(items)
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(depth)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def take(self, item):
+        """
+        Marks `item` as used, so the next one may be prepared.
+        """
+        with self._lock:
+            if item in self._queue:  # not prepared: it holds no slot
+                self._queue.remove(item)
+                return
+        self._slots.release()
+
+    def close(self):
+        """
+        Drops the remaining items and waits for the current one.
+        """
+        with self._lock:
+            self._queue = []
+        self._slots.release()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            self._slots.acquire()
+            with self._lock:
+                if not self._queue:
+                    return
+                item = self._queue.pop(0)
+            try:
+                self.func(item)
+            except Exception as e:
+                print('WARNING: prefetching failed: {}'.format(e))
@@ -0,0 +1,360 @@
+import os
+import json
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+# plausible rates of beats and breaths, per minute
+HEART_RATE = (30., 200.)
+BREATH_RATE = (4., 40.)
+# longest stretch of a trace that is flat or missing before it is
+# considered a dropout, in seconds
+MAX_DROPOUT = 2.
+# largest fraction of samples at either extreme of a trace before it
+# is considered clipped
+MAX_CLIPPED = 0.01
+
+# severity of a check, in increasing order; runs with any failed check
+# would crash or yield meaningless confounds, warnings only flag them
+STATUSES = ('pass', 'warn', 'fail')
+
+# the outcome of a single check, on `item` (a file, or the run itself)
+Check = namedtuple('Check', ['name', 'status', 'item', 'message'])
+# all the checks of a (subject, run) job, and the most severe status
+QCResult = namedtuple('QCResult', ['subject', 'run', 'status', 'checks'])
+
+
+def qc_job(job, samplerate=None, echo_times=None):
+    """
+    Checks the inputs of a single run without processing them:
+    its physio recordings (exactly one ECG and one Resp; type,
+    length against the scan window, dropouts, clipping and
+    plausible peak rates), its images
+    (grids, TRs and volume counts, against each other and the
+    physio recordings) and its event timings (one datamat session
+    per run, valid onsets).
+
+    Inputs
+    ------
+    job: Job
+        the (subject, run) to check, see `scheduler.collect_jobs`
+    samplerate: int
+        (Optional) sampling frequency of the physio recordings.
+        Defaults to `physio.SAMPLERATE`.
+    echo_times: list
+        (Optional) echo times of the optimal combination, to check
+        against the echoes of the run.
+
+    Outputs
+    -------
+    QCResult
+        the outcome of every check
+    """
+    from .physio import SAMPLERATE
+
+    samplerate = samplerate or SAMPLERATE
+    checks = check_recordings(job.physio)
+    for physio_f in job.physio:
+        checks.extend(_guard(check_physio, physio_f, physio_f,
+                             job.acquisition, samplerate))
+    checks.extend(_guard(check_images, job.images[0], job.images,
+                         job.acquisition, echo_times, job.physio,
+                         samplerate))
+    checks.extend(_guard(check_sessions, '', job.n_sessions, job.n_runs))
+    if job.events is not None:
+        checks.extend(_guard(check_events, '', job.events,
+                             job.acquisition))
+    status = max((c.status for c in checks), key=STATUSES.index,
+                 default='pass')
+    return QCResult(job.subject, job.run, status, checks)
+
+
+def check_recordings(physio):
+    """
+    Checks that a run has exactly one ECG and one Resp recording,
+    as its confounds are one iHR and one RVT series.
+
+    Outputs
+    -------
+    list
+        a list of `Check`
+    """
+    from .physio import physio_kind
+
+    kinds = [physio_kind(physio_f) for physio_f in physio]
+    checks = [Check('physio_recordings', 'fail', '',
+                    '{} {} recordings, expected 1'.format(kinds.count(kind),
+                                                          kind))
+              for kind in ('ECG', 'Resp') if kinds.count(kind) != 1]
+    return checks or [Check('physio_recordings', 'pass', '', '')]
+
+
+def check_physio(physio_f, acq, samplerate):
+    """
+    Checks a physio recording against the scan window of `acq`.
+
+    Outputs
+    -------
+    list
+        a list of `Check`
+    """
+    import numpy as np
+    from .physio import (MIN_BEAT, MIN_BREATH, PPG_THRESH, RESP_THRESH,
+                         physio_kind, load_physio, find_extrema)
+    from .registry import window
+
+    kind = physio_kind(physio_f)
+    if kind is None:
+        return [Check('physio_kind', 'fail', physio_f,
+                      'physio format not understood')]
+    trace = load_physio(physio_f)
+    start, end = window(acq)
+    n_needed = int(np.ceil(end * samplerate))
+    if len(trace) < n_needed:
+        return [Check('physio_length', 'fail', physio_f,
+                      '{:.1f} s recorded, the scan ends at {:.1f} s'.format(
+                          len(trace) / float(samplerate), end))]
+    checks = [Check('physio_length', 'pass', physio_f, '')]
+
+    trace = np.asarray(trace[int(start * samplerate):n_needed], dtype=float)
+    finite = np.isfinite(trace)
+    if not finite.any() or np.nanmax(trace) == np.nanmin(trace):
+        return checks + [Check('physio_signal', 'fail', physio_f,
+                               'flat or missing throughout the scan')]
+
+    # missing samples, or a sensor stuck at one value
+    flat = ~finite
+    flat[1:] |= np.diff(trace) == 0
+    dropout = _longest_run(flat) / float(samplerate)
+    checks.append(Check('physio_dropout',
+                        'warn' if dropout > MAX_DROPOUT else 'pass',
+                        physio_f,
+                        '{:.1f} s flat or missing'.format(dropout)))
+
+    lo, hi = np.nanmin(trace), np.nanmax(trace)
+    clipped = max((trace == lo).mean(), (trace == hi).mean())
+    checks.append(Check('physio_clipping',
+                        'warn' if clipped > MAX_CLIPPED else 'pass',
+                        physio_f,
+                        '{:.1%} of samples at an extreme'.format(clipped)))
+
+    min_interval, thresh, bounds = {
+        'ECG': (MIN_BEAT, PPG_THRESH, HEART_RATE),
+        'Resp': (MIN_BREATH, RESP_THRESH, BREATH_RATE)}[kind]
+    peaks = find_extrema(trace[np.newaxis],
+                         max(int(min_interval * samplerate), 1), thresh)[1]
+    rate = 60. * len(peaks) / (end - start)
+    checks.append(Check('physio_rate',
+                        'pass' if bounds[0] <= rate <= bounds[1] else 'warn',
+                        physio_f,
+                        '{:.1f} peaks per minute, expected {:g} to '
+                        '{:g}'.format(rate, *bounds)))
+    return checks
+
+
+def check_images(images, acq, echo_times=None, physio=(), samplerate=None):
+    """
+    Checks that the echoes of a run share their grid, volume count
+    and TR, that the confounds derived from the `physio` recordings
+    cover every volume, at the echoes' own TR and starting at
+    `acq.start`, and that the echoes match `echo_times` if given.
+    Only the image headers are read.
+
+    Outputs
+    -------
+    list
+        a list of `Check`
+    """
+    import nibabel as nib
+    from .glm import (check_echo_times, get_tr)
+    from .physio import (SAMPLERATE, load_physio, covered_volumes)
+    from .registry import Acquisition
+
+    checks = []
+    if echo_times is not None:
+        try:
+            check_echo_times(echo_times, len(images))
+        except ValueError as e:
+            checks.append(Check('echo_times', 'fail', images[0], str(e)))
+    imgs = [nib.load(image) for image in images]
+    shapes = [img.shape for img in imgs]
+    for image, shape in zip(images, shapes):
+        if len(shape) != 4:
+            checks.append(Check('image_shape', 'fail', image,
+                                'not a 4D image: {}'.format(shape)))
+    if any(len(shape) != 4 for shape in shapes):
+        return checks
+
+    if len(set(shape[:3] for shape in shapes)) > 1:
+        checks.append(Check('image_grid', 'fail', images[0],
+                            'echoes differ in grid: {}'.format(shapes)))
+    n_vols = [shape[3] for shape in shapes]
+    if len(set(n_vols)) > 1:
+        checks.append(Check('image_volumes', 'fail', images[0],
+                            'echoes differ in volume count: '
+                            '{}'.format(n_vols)))
+    trs = [get_tr(img) for img in imgs]
+    if not min(trs) > 0:
+        checks.append(Check('image_tr', 'fail', images[0],
+                            'invalid TR: {}'.format(trs)))
+    elif len(set(trs)) > 1:
+        checks.append(Check('image_tr', 'fail', images[0],
+                            'echoes differ in TR: {}'.format(trs)))
+    else:
+        n_samples = []
+        for physio_f in physio:
+            try:
+                n_samples.append(len(load_physio(physio_f)))
+            except (IOError, OSError, ValueError):
+                pass  # reported by `check_physio`
+        for image, n, tr in zip(images, n_vols, trs):
+            covered = min((covered_volumes(
+                s, Acquisition(tr, n, acq.start), samplerate or SAMPLERATE)
+                for s in n_samples), default=n)
+            if covered < n:
+                checks.append(Check('image_volumes', 'fail', image,
+                                    'the physio confounds cover {} of {} '
+                                    'volumes at TR {:g} s'.format(covered,
+                                                                  n, tr)))
+    return checks or [Check('images', 'pass', '', '')]
+
+
+def check_sessions(n_sessions, n_runs):
+    """
+    Checks that the datamat of a subject has one session per run,
+    as sessions are matched to runs in order.
+
+    Outputs
+    -------
+    list
+        a list of `Check`
+    """
+    if not n_sessions:
+        return [Check('event_sessions', 'fail', '', 'no datamat found')]
+    if n_sessions != n_runs:
+        return [Check('event_sessions', 'fail', '',
+                      '{} datamat sessions for {} runs'.format(n_sessions,
+                                                               n_runs))]
+    return [Check('event_sessions', 'pass', '', '')]
+
+
+def check_events(events, acq):
+    """
+    Checks that the event onsets of every condition are valid times
+    within the scan.
+
+    Outputs
+    -------
+    list
+        a list of `Check`
+    """
+    import numpy as np
+    from .glm import read_stim_times
+
+    duration = acq.n_vols * acq.tr
+    checks = []
+    for i, onsets in enumerate(events):
+        condition = 'condition {}'.format(i + 1)
+        onsets = np.asarray(read_stim_times(onsets)
+                            if isinstance(onsets, str) else onsets,
+                            dtype=float)
+        if not np.isfinite(onsets).all() or (onsets < 0).any():
+            checks.append(Check('event_onsets', 'fail', condition,
+                                'negative or invalid onsets'))
+        elif not len(onsets):
+            checks.append(Check('event_onsets', 'warn', condition,
+                                'no onsets'))
+        elif (onsets >= duration).any():
+            checks.append(Check('event_onsets', 'warn', condition,
+                                '{} onsets after the scan ends at {:.1f} '
+                                's'.format(int((onsets >= duration).sum()),
+                                           duration)))
+    return checks or [Check('events', 'pass', '', '')]
+
+
+def preflight(jobs, n_procs=None, samplerate=None, echo_times=None):
+    """
+    Checks the inputs of every run in parallel, see `qc_job`.
+
+    Inputs
+    ------
+    jobs: list
+        a list of `Job`
+    n_procs: int
+        (Optional) number of workers. Defaults to the number of CPUs.
+    samplerate: int
+        (Optional) sampling frequency of the physio recordings.
+    echo_times: list
+        (Optional) echo times of the optimal combination.
+
+    Outputs
+    -------
+    list
+        a list of `QCResult`, in the order of `jobs`
+    """
+    from functools import partial
+
+    if not jobs:
+        return []
+    with ProcessPoolExecutor(max_workers=n_procs) as pool:
+        return list(pool.map(partial(qc_job, samplerate=samplerate,
+                                     echo_times=echo_times), jobs))
+
+
+def write_summary(results, out_file):
+    """
+    Writes the outcome of `preflight` as JSON: counts of runs per
+    status, then every run with its checks.
+    """
+    summary = dict(('n_' + status, sum(r.status == status for r in results))
+                   for status in STATUSES)
+    summary['runs'] = [dict(r._asdict(),
+                            checks=[c._asdict() for c in r.checks])
+                       for r in results]
+    os.makedirs(os.path.dirname(out_file), exist_ok=True)
+    with open(out_file, 'w') as f:
+        json.dump(summary, f, indent=2)
+    return out_file
+
+
+def merge_summaries(report_dir, prefix='metco2_qc', count=None):
+    """
+    Merges the QC summaries of all shards of a job array (of `count`
+    shards, defaulting to that of the most recent summary) into a
+    single summary. Returns the merged file, or None if no shard
+    wrote one.
+    """
+    from .shard import shard_files
+
+    results = []
+    for fname in shard_files(report_dir, prefix, count)[0]:
+        with open(fname) as f:
+            results.extend(
+                QCResult(r['subject'], r['run'], r['status'],
+                         [Check(**c) for c in r['checks']])
+                for r in json.load(f)['runs'])
+    if not results:
+        return None
+    return write_summary(results, os.path.join(report_dir, prefix + '.json'))
+
+
+def _guard(check, item, *args):
+    """
+    Runs `check`, turning any error (e.g. an unreadable `item`) into
+    a failed check rather than aborting the whole pass.
+    """
+    try:
+        return check(*args)
+    except Exception as e:
+        return [Check(check.__name__, 'fail', item,
+                      '{}: {}'.format(type(e).__name__, e))]
+
+
+def _longest_run(mask):
+    """
+    Length of the longest stretch of consecutive True in `mask`.
+    """
+    import numpy as np
+
+    edges = np.diff(np.concatenate([[0], mask.astype(int), [0]]))
+    starts, stops = np.nonzero(edges == 1)[0], np.nonzero(edges == -1)[0]
+    return int((stops - starts).max()) if len(starts) else 0
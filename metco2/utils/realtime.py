@@ -0,0 +1,375 @@
+"""
+Online correction of volumes as they arrive during a scan.
+
+Physio samples and BOLD volumes are pushed as they are acquired.
+Beats and breaths are detected incrementally, binned to volumes and
+convolved with causal response functions, and the regression is
+solved by recursive least squares, so each volume is corrected using
+only data acquired up to its end.
+"""
+import time
+from collections import namedtuple
+import numpy as np
+from .glm import (POLORT, design_matrix)
+from .physio import (SAMPLERATE, PPG_THRESH, RESP_THRESH, MIN_BEAT,
+                     MIN_BREATH, RESPONSE_FUNCS, _running_max)
+from .registry import (ATTA, STIM_MODEL)
+
+# result of `replay`: the corrected 4D data, the seconds spent on each
+# volume and the corrector, holding the final coefficients
+Replay = namedtuple('Replay', ['corrected', 'latencies', 'corrector'])
+
+
+class OnlinePeaks(object):
+    """
+    Incremental version of `physio.find_extrema` for a single trace:
+    a sample is decided once the `distance` samples after it have
+    arrived. The height threshold is relative to the range of the
+    samples seen so far, unless a fixed range is given; with the
+    range of the whole trace, the peaks match the batch version.
+
+    Parameters
+    ----------
+    distance: int
+        minimum number of samples between peaks
+    thresh: float
+        minimum peak height, as a fraction of the range
+    bounds: tuple
+        (Optional) fixed (min, max) of the trace, e.g. from a
+        calibration recording.
+    """
+    def __init__(self, distance, thresh, bounds=None):
+        self.distance = distance
+        self.thresh = thresh
+        self.bounds = bounds
+        self._buf = np.empty(0)
+        self._offset = 0  # index of the first buffered sample
+        self._next = 0  # first undecided sample
+        self._lo, self._hi = bounds or (np.inf, -np.inf)
+        self._prev_peak = False  # whether the previous sample peaked
+
+    def push(self, samples):
+        """
+        Adds samples to the trace.
+
+        Outputs
+        -------
+        indices, values: array-like
+            index within the trace and value of the newly decided
+            peaks
+        """
+        samples = np.asarray(samples, dtype=float).ravel()
+        finite = samples[np.isfinite(samples)]
+        if finite.size and self.bounds is None:
+            self._lo = min(self._lo, finite.min())
+            self._hi = max(self._hi, finite.max())
+        buf = np.concatenate([self._buf, samples])
+        d = self.distance
+        stop = self._offset + len(buf) - d
+        if stop <= self._next:
+            self._buf = buf
+            return np.empty(0, dtype=int), np.empty(0)
+
+        # the windows of samples [next, stop), -inf before the trace
+        first = self._next - d
+        seg = buf[max(first - self._offset, 0):]
+        seg = np.concatenate([np.full(max(self._offset - first, 0), -np.inf),
+                              np.where(np.isnan(seg), -np.inf, seg)])
+        n = stop - self._next
+        values = seg[d:d + n]
+        is_peak = ((values == _running_max(seg[np.newaxis],
+                                           2 * d + 1)[0, :n]) &
+                   np.isfinite(values) &
+                   (values >= self._lo + self.thresh * (self._hi - self._lo)))
+        # keep only the first sample of a flat peak
+        prev_peak = np.concatenate([[self._prev_peak], is_peak[:-1]])
+        self._prev_peak = bool(is_peak[-1])
+        is_peak &= ~(prev_peak & (values == seg[d - 1:d - 1 + n]))
+
+        # keep the samples the next windows reach back to
+        keep = max(stop - d, self._offset)
+        self._buf = buf[keep - self._offset:]
+        self._offset, self._next = keep, stop
+        peaks = np.nonzero(is_peak)[0]
+        return peaks + (stop - n), values[peaks]
+
+
+class OnlineSeries(object):
+    """
+    Incremental iHR or RVT of a run, binned to its volumes.
+
+    Events (beats or breaths) are detected as samples arrive. Events
+    decided after their volume was emitted count towards the next
+    one, and volumes without events repeat the previous value, so
+    the value of a volume only depends on samples acquired before
+    it is requested.
+
+    Parameters
+    ----------
+    kind: str
+        'ECG' (iHR from a PPG trace) or 'Resp' (RVT from a belt trace)
+    acq: Acquisition
+        (Optional) acquisition of the run. Defaults to ATTA's.
+    samplerate: int
+        (Optional) sampling frequency of the trace. Defaults to 40Hz.
+    """
+    def __init__(self, kind, acq=None, samplerate=SAMPLERATE):
+        if kind not in RESPONSE_FUNCS:
+            raise ValueError('Physio format not understood: {}'.format(kind))
+        self.kind = kind
+        self.acq = acq or ATTA
+        self.samplerate = float(samplerate)
+        if kind == 'ECG':
+            self._peaks = OnlinePeaks(max(int(MIN_BEAT * samplerate), 1),
+                                      PPG_THRESH)
+        else:
+            distance = max(int(MIN_BREATH * samplerate), 1)
+            self._peaks = OnlinePeaks(distance, RESP_THRESH)
+            self._troughs = OnlinePeaks(distance, RESP_THRESH)
+            self._trough = None  # (index, value) of the last trough
+        self._last_peak = None  # index of the last peak
+        self._sums = np.zeros(self.acq.n_vols)
+        self._counts = np.zeros(self.acq.n_vols, dtype=int)
+        self._emitted = -1  # last volume whose value was requested
+        self._value = None  # value of the last event or volume
+
+    def push(self, samples):
+        """
+        Adds samples to the trace.
+        """
+        samples = np.asarray(samples, dtype=float).ravel()
+        idx, values = self._peaks.push(samples)
+        times, periods = self._intervals(idx)
+        if self.kind == 'ECG':
+            self._add(times, 60. / periods)
+            return
+
+        t_idx, t_values = self._troughs.push(-samples)
+        t_values = -t_values
+        if self._trough is not None:
+            t_idx = np.concatenate([[self._trough[0]], t_idx])
+            t_values = np.concatenate([[self._trough[1]], t_values])
+        if not len(t_idx):
+            return
+        self._trough = (t_idx[-1], t_values[-1])
+        # troughs and peaks are decided up to the same sample, so the
+        # last trough before each new peak is known
+        n_new = len(times)
+        prev = np.searchsorted(t_idx, idx[len(idx) - n_new:]) - 1
+        keep = prev >= 0
+        depth = values[len(idx) - n_new:] - t_values[np.maximum(prev, 0)]
+        self._add(times[keep], depth[keep] / periods[keep])
+
+    def value(self, n):
+        """
+        Returns the value of volume `n`, marking it as emitted.
+        """
+        if self._counts[n]:
+            self._value = self._sums[n] / self._counts[n]
+        self._emitted = max(self._emitted, n)
+        return 0. if self._value is None else self._value
+
+    def _intervals(self, idx):
+        """
+        Times of the events ending each interval between consecutive
+        peaks, and the interval lengths, in seconds.
+        """
+        if self._last_peak is not None:
+            idx = np.concatenate([[self._last_peak], idx])
+        if len(idx):
+            self._last_peak = idx[-1]
+        times = idx / self.samplerate
+        return times[1:], np.diff(times)
+
+    def _add(self, times, values):
+        """
+        Adds events to their volume, or to the next volume not yet
+        emitted.
+        """
+        bins = np.floor((times - self.acq.start) / self.acq.tr).astype(int)
+        before = bins < 0
+        if before.any():  # before the scan: only carried into it
+            self._value = values[before][-1]
+        bins = np.maximum(bins[~before], self._emitted + 1)
+        valid = bins < self.acq.n_vols
+        np.add.at(self._sums, bins[valid], values[~before][valid])
+        np.add.at(self._counts, bins[valid], 1)
+
+
+class OnlineCorrector(object):
+    """
+    Corrects the volumes of a run one at a time, as they arrive.
+
+    The design matrix is that of `glm.design_matrix`, except that
+    the confounds are built causally: the binned iHR/RVT are
+    convolved with the response functions from their past values
+    only, starting from the first value. The coefficients of every
+    voxel are updated by recursive least squares; all voxels share
+    their regressors, hence a single gain, so each update costs
+    O(n_voxels * n_regressors).
+
+    Parameters
+    ----------
+    acq: Acquisition
+        acquisition of the run; its number of volumes sets the
+        polynomial baseline and task regressors
+    events: list
+        (Optional) onsets (in seconds) or AFNI timing files, one per
+        condition
+    kinds: tuple
+        (Optional) the physio recordings pushed, 'ECG' and/or 'Resp',
+        in the order of the confounds. Defaults to both.
+    stim_model: str
+        (Optional) AFNI response model of the task regressors.
+    polort: int
+        (Optional) order of the polynomial baseline. Defaults to 1.
+    samplerate: int
+        (Optional) sampling frequency of the traces. Defaults to 40Hz.
+    forgetting: float
+        (Optional) RLS forgetting factor; 1 weighs all volumes
+        equally, as the batch fit does. Defaults to 1.
+    delta: float
+        (Optional) initial variance of the coefficients.
+    """
+    def __init__(self, acq, events=None, kinds=('ECG', 'Resp'),
+                 stim_model=STIM_MODEL, polort=POLORT,
+                 samplerate=SAMPLERATE, forgetting=1., delta=1e6):
+        from ..workflows.model import _gen_stim_list
+
+        self.acq = acq
+        self.kinds = list(kinds)
+        self.forgetting = float(forgetting)
+        self.X, self.is_confound = design_matrix(
+            _gen_stim_list(events or [], stim_model),
+            np.zeros((acq.n_vols, len(self.kinds))), acq.n_vols, acq.tr,
+            polort=polort)
+        self.series = [OnlineSeries(kind, acq, samplerate)
+                       for kind in self.kinds]
+        self._kernels = [np.asarray(RESPONSE_FUNCS[kind](acq.tr))
+                         for kind in self.kinds]
+        self._history = np.zeros((len(self.kinds), acq.n_vols))
+        self._P = delta * np.eye(self.X.shape[1])
+        self.betas = None
+        self.n = 0
+
+    def push_physio(self, kind, samples):
+        """
+        Adds samples of the `kind` recording ('ECG' or 'Resp').
+        """
+        self.series[self.kinds.index(kind)].push(samples)
+
+    def push_volume(self, volume):
+        """
+        Corrects the next volume of the run, updating the fit. The
+        physio samples up to the end of the volume should have been
+        pushed first.
+
+        Inputs
+        ------
+        volume: array-like
+            the volume, of any shape (e.g. echoes stacked first)
+
+        Outputs
+        -------
+        array-like
+            the corrected volume, with the shape of `volume`
+        """
+        n = self.n
+        if n >= self.acq.n_vols:
+            raise ValueError('All {} volumes were already '
+                             'corrected.'.format(self.acq.n_vols))
+        x = self.X[n]
+        x[self.is_confound] = self._confounds(n)
+        y = np.asarray(volume, dtype=float).reshape(-1)
+        if self.betas is None:
+            self.betas = np.zeros((y.size, x.size))
+
+        # recursive least squares, with one gain for all voxels
+        Px = self._P @ x
+        gain = Px / (self.forgetting + x @ Px)
+        self._P = (self._P - np.outer(gain, Px)) / self.forgetting
+        self.betas += np.outer(y - self.betas @ x, gain)
+
+        conf = self.is_confound
+        corrected = y - self.betas[:, conf] @ x[conf]
+        self.n += 1
+        return corrected.reshape(np.shape(volume)).astype(np.float32)
+
+    def _confounds(self, n):
+        """
+        Causally convolved confounds of volume `n`.
+        """
+        confounds = []
+        for i, (series, kernel) in enumerate(zip(self.series,
+                                                 self._kernels)):
+            self._history[i, n] = series.value(n)
+            past = self._history[i, n::-1][:len(kernel)]
+            # before the scan, the series holds its first value
+            confounds.append(kernel[:len(past)] @ past +
+                             kernel[len(past):].sum() * self._history[i, 0])
+        return confounds
+
+
+def replay(image, physio_files, events=None, start=ATTA.start,
+           samplerate=SAMPLERATE, realtime=False, **kwargs):
+    """
+    Replays a recorded run through an `OnlineCorrector`, pushing the
+    physio samples acquired during each volume before the volume.
+    The recording is loaded up front, so latencies only cover the
+    correction.
+
+    Inputs
+    ------
+    image: file
+        4D NIfTI image of the run
+    physio_files: list
+        the run's physio recordings (see `physio.physio_kind`)
+    events: list
+        (Optional) onsets (in seconds) or AFNI timing files, one per
+        condition
+    start: float
+        (Optional) time of the first volume within the recordings.
+    samplerate: int
+        (Optional) sampling frequency of the recordings.
+    realtime: bool
+        (Optional) wait for the acquisition time of each volume, as
+        during a scan. Defaults to False.
+    **kwargs
+        passed to `OnlineCorrector`
+
+    Outputs
+    -------
+    Replay
+        the corrected data, the seconds spent on each volume and
+        the corrector
+    """
+    import nibabel as nib
+    from .physio import (load_physio, physio_kind)
+    from .registry import acquisition
+
+    img = nib.load(image)
+    acq = acquisition(img, start)
+    # volumes come from the scanner in memory: keep reading out of the
+    # timed loop (seeking into a .nii.gz decompresses from its start)
+    data = np.asanyarray(img.dataobj)
+    traces = dict((physio_kind(f), load_physio(f)) for f in physio_files)
+    corrector = OnlineCorrector(acq, events, kinds=sorted(traces),
+                                samplerate=samplerate, **kwargs)
+    sent = dict.fromkeys(traces, 0)
+    corrected = np.empty(img.shape, dtype=np.float32)
+    latencies = np.empty(acq.n_vols)
+    clock = time.perf_counter()
+
+    for n in range(acq.n_vols):
+        # samples up to the end of volume n
+        until = int(round((acq.start + (n + 1) * acq.tr) * samplerate))
+        if realtime:
+            time.sleep(max(clock + (n + 1) * acq.tr - time.perf_counter(),
+                           0))
+        begin = time.perf_counter()
+        for kind, trace in traces.items():
+            corrector.push_physio(kind, trace[sent[kind]:until])
+            sent[kind] = max(sent[kind], until)
+        corrected[..., n] = corrector.push_volume(data[..., n])
+        latencies[n] = time.perf_counter() - begin
+    return Replay(corrected, latencies, corrector)
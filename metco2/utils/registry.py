@@ -0,0 +1,45 @@
+from collections import namedtuple
+
+# the acquisition of a run, which determines its design components:
+# repetition time (s), number of volumes, and the time (s) of the
+# first volume within the physio recordings
+Acquisition = namedtuple('Acquisition', ['tr', 'n_vols', 'start'])
+
+# NOTE: the ATTA scan sequence, used when no image is at hand
+ATTA = Acquisition(tr=2.0, n_vols=215, start=8.0)
+
+# default AFNI response model of the task regressors
+STIM_MODEL = 'BLOCK(10,1)'
+
+
+def acquisition(image, start=ATTA.start):
+    """
+    Reads the acquisition of a run from the header of its 4D image.
+
+    Inputs
+    ------
+    image: file or Nifti1Image
+        4D image of the run
+    start: float
+        (Optional) time of the first volume within the physio
+        recordings, in seconds, which headers don't record.
+        Defaults to 8.0 seconds.
+
+    Outputs
+    -------
+    Acquisition
+    """
+    import nibabel as nib
+    from .glm import get_tr
+
+    img = nib.load(image) if isinstance(image, str) else image
+    return Acquisition(get_tr(img), int(img.shape[-1]), float(start))
+
+
+def window(acq):
+    """
+    Returns the (start, end) of the physio recordings spanned by
+    the volumes of `acq`, in seconds.
+    """
+    return acq.start, acq.start + acq.n_vols * acq.tr
+
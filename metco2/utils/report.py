@@ -0,0 +1,173 @@
+import os
+import csv
+import json
+import math
+import time
+import marshal
+import cProfile
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# thread_s: seconds spent by background threads, summed across them,
+# for work overlapping other stages (e.g. writing outputs)
+FIELDS = ['subject', 'run', 'stage', 'wall_s', 'cpu_s', 'peak_rss_mb',
+          'read_mb', 'write_mb', 'out_mb', 'thread_s']
+
+
+def peak_rss_mb():
+    """
+    Returns the peak resident set size of this process, in MB, since
+    it started or since the last `reset_peak_rss`.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.  # in kB
+    except (IOError, OSError, ValueError):
+        pass
+    if resource is None:
+        return float('nan')
+    # kilobytes on Linux, never reset
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def reset_peak_rss():
+    """
+    Resets the peak resident set size of this process to its current
+    size, so that a long-lived (e.g. pool worker) process reports
+    the peak of each stage rather than of its whole lifetime.
+    Returns whether it could, which needs Linux 4.0 or later.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def io_bytes():
+    """
+    Returns the bytes read and written by this process so far,
+    or (0, 0) where /proc is not available.
+    """
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(':') for line in f)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (IOError, OSError, KeyError, ValueError):
+        return 0, 0
+
+
+class RunReport(object):
+    """
+    Records wall time, CPU time, peak RSS and bytes read and
+    written for each stage of a `metco2` run.
+
+    Parameters
+    ----------
+    profile: bool
+        (Optional) also profile every stage with cProfile, keeping
+        the profile of the slowest one. Defaults to False.
+    """
+    def __init__(self, profile=False):
+        self.profile = profile
+        self.records = []
+        self.slowest = (0., None, None)  # (wall_s, stage, profile stats)
+
+    @contextmanager
+    def stage(self, name, subject='', run=''):
+        """
+        Context manager timing the enclosed block as stage `name`.
+        Stages should not nest, since each resets the peak RSS.
+        """
+        prof = cProfile.Profile() if self.profile else None
+        # otherwise the peak is that of the process, not of the stage
+        peak_reset = reset_peak_rss()
+        read0, write0 = io_bytes()
+        cpu0, wall0 = time.process_time(), time.perf_counter()
+        if prof is not None:
+            prof.enable()
+        try:
+            yield
+        finally:
+            if prof is not None:
+                prof.disable()
+            wall = time.perf_counter() - wall0
+            read1, write1 = io_bytes()
+            self.add(subject, run, name, wall,
+                     cpu_s=time.process_time() - cpu0,
+                     peak_rss_mb=(peak_rss_mb() if peak_reset
+                                  else float('nan')),
+                     read_mb=(read1 - read0) / 1024. ** 2,
+                     write_mb=(write1 - write0) / 1024. ** 2)
+            if prof is not None and wall > self.slowest[0]:
+                prof.create_stats()
+                self.slowest = (wall, '{} {} {}'.format(subject, run, name),
+                                prof.stats)
+
+    def add(self, subject, run, stage, wall_s, **stats):
+        """
+        Adds a record measured elsewhere, e.g. by nipype. Only the
+        given `stats` are recorded: other columns are left empty.
+        """
+        record = dict(subject=subject, run=run, stage=stage, wall_s=wall_s)
+        record.update(stats)
+        self.records.append(record)
+
+    def merge(self, other):
+        """
+        Folds the records of another report (e.g. from a worker
+        process) into this one.
+        """
+        self.records.extend(other.records)
+        if other.slowest[0] > self.slowest[0]:
+            self.slowest = other.slowest
+
+    def write(self, out_dir, prefix='metco2_report'):
+        """
+        Writes the records as JSON and CSV, plus the cProfile
+        dump of the slowest stage if profiling was enabled.
+
+        Outputs
+        -------
+        list
+            the written files
+        """
+        os.makedirs(out_dir, exist_ok=True)
+        out_files = [os.path.join(out_dir, prefix + '.json'),
+                     os.path.join(out_dir, prefix + '.csv')]
+        # unmeasured values (NaN) are null in JSON and empty in CSV
+        records = [dict((k, None if _missing(v) else v)
+                        for k, v in record.items())
+                   for record in self.records]
+        with open(out_files[0], 'w') as f:
+            json.dump(records, f, indent=2, allow_nan=False)
+        with open(out_files[1], 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS,
+                                    extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(records)
+
+        if self.slowest[2] is not None:
+            out_files.append(os.path.join(out_dir, prefix + '_slowest.prof'))
+            with open(out_files[-1], 'wb') as f:
+                marshal.dump(self.slowest[2], f)
+            print('Slowest stage ({}, {:.1f} s) profiled to {}; inspect with '
+                  '`python -m pstats`.'.format(self.slowest[1].strip(),
+                                               self.slowest[0],
+                                               out_files[-1]))
+        return out_files
+
+
+def _missing(value):
+    """
+    Whether `value` is a float that JSON cannot represent (NaN or
+    infinite), i.e. a value that was not measured.
+    """
+    return isinstance(value, float) and not math.isfinite(value)
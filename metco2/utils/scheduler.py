@@ -0,0 +1,475 @@
+import os
+from collections import namedtuple
+from concurrent.futures import (ProcessPoolExecutor, wait, FIRST_COMPLETED)
+from .misc import (find_inputs, gather_events)
+from .report import RunReport
+from .manifest import (fingerprint, record_step, step_complete)
+from .pipeline import Prefetcher
+from .registry import (ATTA, STIM_MODEL, acquisition)
+
+# a single (subject, run) unit of work, with its estimated memory footprint,
+# its acquisition (see `registry.Acquisition`), and the number of sessions
+# in its subject's datamat against its subject's number of runs (`events`
+# is None unless they match, see `misc.gather_events`)
+Job = namedtuple('Job', ['subject', 'run', 'images', 'physio', 'events',
+                         'confounds', 'mem_gb', 'acquisition', 'n_sessions',
+                         'n_runs'])
+
+# fixed cost of a worker process (interpreter, numpy, nipype), in GB
+WORKER_OVERHEAD_GB = 0.25
+
+
+def estimate_mem_gb(images, chunk_mem_gb=None):
+    """
+    Estimates the peak memory needed to correct a single run.
+
+    Inputs
+    ------
+    images: list
+        4D NIfTI images, one per echo
+    chunk_mem_gb: float
+        (Optional) memory budget of out-of-core correction, which
+        then bounds the estimate.
+
+    Outputs
+    -------
+    float
+        estimated peak memory, in GB
+    """
+    import numpy as np
+    import nibabel as nib
+
+    if chunk_mem_gb is not None:
+        return WORKER_OVERHEAD_GB + chunk_mem_gb
+    n_bytes = sum(np.prod(nib.load(image).shape, dtype=np.int64) * 4
+                  for image in images)
+    # the input data, the corrected copy and its float64 working chunk
+    return WORKER_OVERHEAD_GB + 3. * n_bytes / 1024 ** 3
+
+
+def collect_jobs(data_dir, subjects, chunk_mem_gb=None, report=None,
+                 index=None, physio_start=ATTA.start):
+    """
+    Gathers every (subject, run) job in the dataset up front.
+
+    Inputs
+    ------
+    data_dir: str
+        the root folder of the dataset
+    subjects: list
+        participant identifiers
+    chunk_mem_gb: float
+        (Optional) memory budget of out-of-core correction.
+    report: RunReport
+        (Optional) report recording the time spent per subject.
+    index: DatasetIndex
+        (Optional) index of the dataset, to avoid scanning it again.
+    physio_start: float
+        (Optional) time of the first volume within the physio
+        recordings, in seconds. Defaults to 8.0 seconds.
+
+    Outputs
+    -------
+    list
+        a list of `Job`, one per run
+    """
+    report = report or RunReport()
+    jobs = []
+    for subj in subjects:
+        with report.stage('gather_inputs', subj):
+            images, physio = find_inputs(data_dir, subj, index)
+            acqs = [acquisition(echoes[0], physio_start) for echoes in images]
+            # datamat onsets are in volumes, of each run's TR
+            events, n_sessions = gather_events(data_dir, subj,
+                                               [acq.tr for acq in acqs],
+                                               index)
+        for i, echoes in enumerate(images):
+            # non-BIDS ugliness
+            run = os.path.basename(echoes[0]).split('.')[0].split('_')[1]
+            confounds = os.path.join(data_dir, subj,
+                                     '{}_confounds_{}.txt'.format(subj, run))
+            jobs.append(Job(subj, run, echoes, physio[i], events[i],
+                            confounds, estimate_mem_gb(echoes, chunk_mem_gb),
+                            acqs[i], n_sessions, len(images)))
+    return jobs
+
+
+def job_params(echo_times=None, output_format='nii.gz', save_fit=False,
+               stim_model=STIM_MODEL, mask=None):
+    """
+    Parameters that determine the outputs of a job's workflow.
+    """
+    from ..info import __version__
+    params = dict(version=__version__, echo_times=echo_times,
+                  output_format=output_format, save_fit=save_fit,
+                  stim_model=stim_model)
+    if mask is not None:  # so unmasked runs keep their manifests valid
+        params['mask'] = (mask if mask == 'auto' else
+                          [os.path.abspath(mask), fingerprint([mask])])
+    return params
+
+
+def workflow_outputs(job, output_dir, echo_times=None, output_format='nii.gz',
+                     save_fit=False):
+    """
+    Files the DataSink of a job's workflow writes.
+    """
+    from ..workflows.model import (output_names, fit_names)
+    outputs = [os.path.join(output_dir, job.subject, 'phys_corr', name)
+               for name in output_names(job.images, echo_times,
+                                        output_format)]
+    if save_fit:
+        outputs += [os.path.join(output_dir, job.subject, 'phys_fit', name)
+                    for name in fit_names(job.images, output_format)]
+    return outputs
+
+
+def pending_jobs(jobs, output_dir, echo_times=None, output_format='nii.gz',
+                 save_fit=False, stim_model=STIM_MODEL, mask=None,
+                 physio_method='peakdet'):
+    """
+    Drops the jobs whose manifest records completed confounds and
+    workflow steps with the same inputs and parameters, and existing
+    outputs. The confounds step covers the physio recordings and
+    their derivation (method and scan window), which the workflow
+    only sees through the confounds file.
+    """
+    from .physio import physio_params
+
+    pending = []
+    for job in jobs:
+        try:
+            confound_inputs = fingerprint(job.physio)
+            confound_params = [physio_params(p, job.acquisition,
+                                             physio_method)
+                               for p in job.physio]
+            inputs = fingerprint(job.images + [job.confounds], job.events)
+        except (OSError, ValueError):  # e.g. confounds not written yet
+            pending.append(job)
+            continue
+        if not (step_complete(output_dir, job, 'confounds', confound_inputs,
+                              confound_params) and
+                step_complete(output_dir, job, 'workflow', inputs,
+                              job_params(echo_times, output_format,
+                                         save_fit, stim_model, mask))):
+            pending.append(job)
+    return pending
+
+
+def confound_job(job, cache=None, output_dir=None, physio_method='peakdet',
+                 shared_dir=None, stim_model=STIM_MODEL):
+    """
+    Derives and writes the physio confounds of a single run, e.g.
+    as the `prepare` step of `run_jobs`, so each run's workflow
+    starts as soon as its own confounds are ready.
+
+    Inputs
+    ------
+    job: Job
+        the (subject, run) to process
+    cache: RegressorCache
+        (Optional) cache of previously derived confounds.
+    output_dir: str
+        (Optional) output directory, to record the step in the
+        run's manifest.
+    physio_method: str
+        (Optional) 'peakdet' or 'numpy'. Defaults to 'peakdet'.
+    shared_dir: str
+        (Optional) root of a `shm.SharedStore`, to also share the
+        run's design matrix with the worker running its workflow.
+    stim_model: str
+        (Optional) AFNI response model of the task regressors.
+
+    Outputs
+    -------
+    RunReport
+        time and resources spent deriving and writing the confounds
+    """
+    from .physio import convolve_batch
+
+    if job.events is None:  # see `qc.check_sessions`
+        raise ValueError('No event timings: {} datamat sessions for {} '
+                         'runs.'.format(job.n_sessions, job.n_runs))
+    report = RunReport()
+    with report.stage('convolve_ts', job.subject, job.run):
+        # this already runs on a worker: derive in-process
+        confounds = convolve_batch(job.physio, n_jobs=1, backend='thread',
+                                   cache=cache,
+                                   acquisitions=[job.acquisition] *
+                                   len(job.physio),
+                                   method=physio_method)
+    with report.stage('write_confounds', job.subject, job.run):
+        confounds = _save_confounds(job, confounds, output_dir,
+                                    physio_method)
+    if shared_dir is not None:
+        from .glm import design_matrix
+        from .shm import share_design
+        from ..workflows.model import _gen_stim_list
+
+        with report.stage('share_design', job.subject, job.run):
+            share_design(_design_prefix(job, shared_dir),
+                         *design_matrix(_gen_stim_list(job.events,
+                                                       stim_model),
+                                        confounds, job.acquisition.n_vols,
+                                        job.acquisition.tr))
+    return report
+
+
+def _save_confounds(job, confounds, output_dir=None,
+                    physio_method='peakdet'):
+    """
+    Writes the confounds file of `job`, recording the step in its
+    manifest when `output_dir` is given. Returns the confounds as
+    written, i.e. as the workflow reads them back.
+    """
+    import io
+    import numpy as np
+    from .physio import physio_params
+
+    text = io.StringIO()
+    np.savetxt(text, np.transpose(confounds), fmt='%10.5f')
+    _write_if_changed(job.confounds, text.getvalue())
+    if output_dir is not None:
+        record_step(output_dir, job, 'confounds', fingerprint(job.physio),
+                    [physio_params(p, job.acquisition, physio_method)
+                     for p in job.physio],
+                    [job.confounds])
+    return np.loadtxt(io.StringIO(text.getvalue()), ndmin=2)
+
+
+def run_job(job, output_dir, chunk_mem_gb=None, echo_times=None,
+            profile=False, output_format='nii.gz', save_fit=False,
+            stim_model=STIM_MODEL, shared_dir=None, mask=None,
+            cache_dir=None):
+    """
+    Builds and runs the correction workflow for a single run,
+    recording it in the run's manifest once it completes.
+
+    Inputs
+    ------
+    job: Job
+        the (subject, run) to process
+    output_dir: str
+        the output directory
+    chunk_mem_gb: float
+        (Optional) memory budget of out-of-core correction.
+    echo_times: list
+        (Optional) echo times, to also write an optimal combination.
+    profile: bool
+        (Optional) profile the job with cProfile.
+    output_format: str
+        (Optional) format of the written images.
+    save_fit: bool
+        (Optional) also write coefficients and fit statistics.
+    stim_model: str
+        (Optional) AFNI response model of the task regressors.
+    shared_dir: str
+        (Optional) root of the `shm.SharedStore` holding the run's
+        design matrix, see `confound_job`.
+    mask: str
+        (Optional) 'auto' or a 3D mask image, restricting the
+        correction to the voxels within it.
+    cache_dir: str
+        (Optional) directory of uncompressed copies of the images,
+        see `prefetch_images`; the copies are removed once the
+        workflow ends.
+
+    Outputs
+    -------
+    RunReport
+        time and resources spent on the workflow and each of its nodes
+    """
+    from ..workflows import init_metco2_wf
+    from .nifti import (disk_usage, remove_copies)
+
+    report = RunReport(profile=profile)
+
+    workflow = init_metco2_wf(job.images, job.events, job.confounds,
+                              job.subject, output_dir,
+                              name=_workflow_name(job),
+                              mem_gb=chunk_mem_gb, echo_times=echo_times,
+                              output_format=output_format, save_fit=save_fit,
+                              stim_model=stim_model,
+                              design=(None if shared_dir is None else
+                                      _design_prefix(job, shared_dir)),
+                              mask=mask, cache_dir=cache_dir)
+    # for debugging:
+    # workflow.config['execution'] = {'remove_unnecessary_outputs': False,
+    #                                 'keep_inputs': True,
+    #                                 'try_hard_link_datasink': False}
+    workflow.write_graph(graph2use='flat')
+    try:
+        with report.stage('workflow', job.subject, job.run):
+            execgraph = workflow.run('Linear')
+    finally:
+        if cache_dir is not None:
+            remove_copies(job.images, cache_dir)
+
+    outputs = workflow_outputs(job, output_dir, echo_times, output_format,
+                               save_fit)
+    record_step(output_dir, job, 'workflow',
+                fingerprint(job.images + [job.confounds], job.events),
+                job_params(echo_times, output_format, save_fit, stim_model,
+                           mask),
+                outputs)
+
+    for node in execgraph.nodes():
+        runtime = node.result.runtime
+        # nodes run within the 'workflow' stage, which measures their
+        # CPU, memory and I/O together; nipype only times each one,
+        # and measures its memory if resource monitoring is enabled
+        stats = {}
+        if getattr(runtime, 'mem_peak_gb', None) is not None:
+            stats['peak_rss_mb'] = runtime.mem_peak_gb * 1024.
+        report.add(job.subject, job.run, 'node:' + node.name,
+                   getattr(runtime, 'duration', float('nan')), **stats)
+        if node.name == 'glm':
+            # writes overlap the fit, on several threads: their summed
+            # time is no wall time
+            report.add(job.subject, job.run, 'write', float('nan'),
+                       thread_s=node.result.outputs.write_s,
+                       out_mb=sum(disk_usage(f)
+                                  for f in outputs) / 1024. ** 2)
+    return report
+
+
+def prefetch_images(job, cache_dir):
+    """
+    Decompresses the images of `job` into `cache_dir`, where its
+    correction picks them up instead of decompressing them itself.
+    """
+    from .nifti import uncompressed_copy
+
+    for image in job.images:
+        uncompressed_copy(image, cache_dir)
+
+
+def run_jobs(jobs, func, n_procs=None, mem_gb=None, callback=None,
+             prefetch=None, prefetch_depth=1, prepare=None):
+    """
+    Runs jobs concurrently on a process pool, starting the next
+    queued job whenever both a worker and enough memory are free.
+
+    Inputs
+    ------
+    jobs: list
+        a list of `Job`
+    func: callable
+        picklable callable taking a single `Job`
+    n_procs: int
+        (Optional) maximum number of concurrent tasks.
+        Defaults to the number of CPUs.
+    mem_gb: float
+        (Optional) memory budget shared by all running jobs, in GB.
+        Defaults to no limit.
+    callback: callable
+        (Optional) called in this process as `callback(job, result)`
+        for every job, and every preparation, that succeeds.
+    prefetch: callable
+        (Optional) called on a background thread of this process
+        with each queued job before it starts, e.g. `prefetch_images`.
+    prefetch_depth: int
+        (Optional) maximum number of prefetched jobs waiting to start.
+    prepare: callable
+        (Optional) picklable callable run on the same pool before
+        `func`, e.g. `confound_job`. Jobs are queued for `func` as
+        soon as their own preparation completes; workers left free
+        by the queued jobs prepare the next ones.
+
+    Outputs
+    -------
+    list
+        a list of (`Job`, exception) tuples for the failed jobs
+    """
+    n_procs = n_procs or os.cpu_count() or 1
+    # largest jobs first, so the biggest runs don't straggle at the end
+    order = sorted(jobs, key=lambda j: j.mem_gb, reverse=True)
+    # jobs hold lists, so they are looked up by identity
+    position = dict((id(job), i) for i, job in enumerate(order))
+    unprepared, pending = (([], list(order)) if prepare is None
+                           else (list(order), []))
+    preparing, running, failed = {}, {}, []
+    mem_free = float('inf') if mem_gb is None else float(mem_gb)
+    prefetcher = None
+
+    try:
+        with ProcessPoolExecutor(max_workers=n_procs) as pool:
+            while unprepared or preparing or pending or running:
+                for job in list(pending):
+                    if len(running) + len(preparing) >= n_procs:
+                        break
+                    # an oversized job still runs, but only on its own
+                    if job.mem_gb <= mem_free or not running:
+                        pending.remove(job)
+                        running[pool.submit(func, job)] = job
+                        mem_free -= job.mem_gb
+                        if prefetcher is not None:
+                            prefetcher.take(job)
+                while (unprepared and
+                       len(running) + len(preparing) < n_procs):
+                    job = unprepared.pop(0)
+                    preparing[pool.submit(prepare, job)] = job
+                # start once the first jobs are running, so it only
+                # works on jobs that are still queued or being prepared
+                if prefetch is not None and prefetcher is None:
+                    prefetcher = Prefetcher(
+                        [j for j in order if j not in running.values()],
+                        prefetch, prefetch_depth)
+
+                done, _ = wait(list(running) + list(preparing),
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    prepared = future in preparing
+                    if prepared:
+                        job = preparing.pop(future)
+                    else:
+                        job = running.pop(future)
+                        mem_free += job.mem_gb
+                    if future.exception() is not None:
+                        print('ERROR: {} {} failed: {}'.format(
+                            job.subject, job.run, future.exception()))
+                        failed.append((job, future.exception()))
+                        if prepared and prefetcher is not None:
+                            # it will never start: free its prefetch slot
+                            prefetcher.take(job)
+                        continue
+                    if callback is not None:
+                        callback(job, future.result())
+                    if prepared:
+                        # keep the queue in the largest-first order
+                        pending.append(job)
+                        pending.sort(key=lambda j: position[id(j)])
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+    return failed
+
+
+def _write_if_changed(fname, text):
+    """
+    Writes `text` to `fname` unless it already holds exactly `text`,
+    so unchanged outputs keep their timestamps.
+    """
+    try:
+        with open(fname, 'r') as f:
+            if f.read() == text:
+                return
+    except (IOError, OSError):
+        pass
+    with open(fname, 'w') as f:
+        f.write(text)
+
+
+def _design_prefix(job, shared_dir):
+    """
+    Prefix of the design matrix of `job` within a shared store.
+    """
+    return os.path.join(shared_dir, _workflow_name(job))
+
+
+def _workflow_name(job):
+    """
+    Builds a nipype-safe workflow name unique to `job`.
+    """
+    name = 'metco2_{}_{}'.format(job.subject, job.run)
+    return ''.join(c if c.isalnum() else '_' for c in name)
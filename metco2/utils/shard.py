@@ -0,0 +1,201 @@
+import os
+import re
+import sys
+import json
+import subprocess
+
+# environment variables of a Slurm job array
+ARRAY_ENV = {'index': 'SLURM_ARRAY_TASK_ID',
+             'count': 'SLURM_ARRAY_TASK_COUNT',
+             'min': 'SLURM_ARRAY_TASK_MIN'}
+
+
+def parse_shard(shard, environ=None):
+    """
+    Parses a shard specification.
+
+    Inputs
+    ------
+    shard: str
+        'i/N' for shard i (counting from 0) of N, or 'env' to read
+        them from the Slurm job-array environment variables
+    environ: dict
+        (Optional) environment to read, defaults to `os.environ`
+
+    Outputs
+    -------
+    tuple
+        (index, count)
+    """
+    environ = os.environ if environ is None else environ
+    if shard == 'env':
+        try:
+            count = int(environ[ARRAY_ENV['count']])
+            index = (int(environ[ARRAY_ENV['index']]) -
+                     int(environ.get(ARRAY_ENV['min'], 0)))
+        except (KeyError, ValueError):
+            raise ValueError('--shard env requires the {index} and {count} '
+                             'environment variables.'.format(**ARRAY_ENV))
+    else:
+        try:
+            index, count = [int(s) for s in shard.split('/')]
+        except ValueError:
+            raise ValueError('Shard must be "i/N" or "env", got '
+                             '{!r}.'.format(shard))
+    if not 0 <= index < count:
+        raise ValueError('Shard index {} out of range for {} '
+                         'shards.'.format(index, count))
+    return index, count
+
+
+def job_cost(job):
+    """
+    Estimates the cost of a job as the number of voxel samples
+    (voxels x volumes x echoes) of its images, read from headers.
+    """
+    import numpy as np
+    import nibabel as nib
+    return sum(int(np.prod(nib.load(f).shape, dtype=np.int64))
+               for f in job.images)
+
+
+def shard_jobs(jobs, index, count, cost=job_cost):
+    """
+    Deterministically splits jobs into `count` shards balanced by
+    cost, assigning the costliest remaining job to the currently
+    lightest shard, and returns shard `index`.
+
+    Inputs
+    ------
+    jobs: list
+        a list of `Job`
+    index: int
+        the shard to return, counting from 0
+    count: int
+        the number of shards
+    cost: callable
+        (Optional) estimated cost of a job
+
+    Outputs
+    -------
+    list
+        the jobs of shard `index`
+    """
+    costs = [cost(job) for job in jobs]
+    ranked = sorted(zip(costs, jobs),
+                    key=lambda cj: (-cj[0], cj[1].subject, cj[1].run))
+    loads = [(0, i) for i in range(count)]
+    shards = [[] for _ in range(count)]
+    for c, job in ranked:
+        load, i = min(loads)
+        shards[i].append(job)
+        loads[i] = (load + c, i)
+    return shards[index]
+
+
+def shard_prefix(index, count, prefix='metco2_report'):
+    """
+    Name of the run report written by a single shard.
+    """
+    return '{}_shard-{}of{}'.format(prefix, index, count)
+
+
+def shard_files(report_dir, prefix, count=None):
+    """
+    Lists the per-shard files of a single job array, ignoring those
+    left by earlier arrays with a different number of shards.
+
+    Inputs
+    ------
+    report_dir: str
+        folder holding the per-shard files
+    prefix: str
+        prefix of the files
+    count: int
+        (Optional) the number of shards of the array, defaults to
+        that of the most recently written file
+
+    Outputs
+    -------
+    tuple
+        (files, missing): the files of the array, sorted by shard,
+        and the indices of the shards without one
+    """
+    pattern = re.compile(re.escape(prefix) + r'_shard-(\d+)of(\d+)\.json$')
+    try:
+        names = os.listdir(report_dir)
+    except OSError:
+        names = []
+    found = {}
+    for fname in names:
+        match = pattern.match(fname)
+        if match:
+            found[int(match.group(1)), int(match.group(2))] = os.path.join(
+                report_dir, fname)
+    if count is None:
+        if not found:
+            return [], []
+        count = max(found, key=lambda k: os.path.getmtime(found[k]))[1]
+    files = [found[i, count] for i in range(count) if (i, count) in found]
+    missing = [i for i in range(count) if (i, count) not in found]
+    return files, missing
+
+
+def merge_reports(report_dir, prefix='metco2_report', count=None):
+    """
+    Merges the run reports of all shards of a job array into a
+    single report.
+
+    Inputs
+    ------
+    report_dir: str
+        folder holding the per-shard reports
+    prefix: str
+        (Optional) prefix of the report files
+    count: int
+        (Optional) the number of shards, defaults to that of the
+        most recently written report
+
+    Outputs
+    -------
+    tuple
+        (files, missing): the written files of the merged report,
+        and the indices of the shards without a report
+    """
+    from .report import RunReport
+
+    report = RunReport()
+    files, missing = shard_files(report_dir, prefix, count)
+    for fname in files:
+        with open(fname) as f:
+            report.records.extend(json.load(f))
+    return report.write(report_dir, prefix), missing
+
+
+def launch_local_array(argv, count):
+    """
+    Fakes a scheduler job array on this machine: runs `count`
+    `metco2` subprocesses with the Slurm array variables set,
+    and waits for all of them.
+
+    Inputs
+    ------
+    argv: list
+        command-line arguments for every shard, which should
+        include '--shard env'
+    count: int
+        the number of shards
+
+    Outputs
+    -------
+    list
+        the return code of each shard
+    """
+    cmd = [sys.executable, '-c', 'from metco2.cli.run import main; main()']
+    procs = []
+    for i in range(count):
+        env = dict(os.environ)
+        env.update({ARRAY_ENV['index']: str(i), ARRAY_ENV['count']: str(count),
+                    ARRAY_ENV['min']: '0'})
+        procs.append(subprocess.Popen(cmd + list(argv), env=env))
+    return [p.wait() for p in procs]
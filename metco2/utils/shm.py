@@ -0,0 +1,92 @@
+import os
+import shutil
+import hashlib
+import tempfile
+
+# tmpfs, so shared arrays stay in memory; elsewhere they fall back to
+# the temporary directory and the page cache
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+class SharedStore(object):
+    """
+    Directory of arrays shared between the processes of a `metco2`
+    run, e.g. the design matrix of every run. Arrays are written
+    once as `.npy` files and memory-mapped read-only by every
+    process attaching them, so all workers share a single copy
+    instead of each rebuilding or parsing its own. The directory
+    is removed on exit.
+
+    Parameters
+    ----------
+    key: str
+        identifies the run owning the store (e.g. its output
+        directory and shard), so that concurrent runs on a node
+        don't share a directory, while reruns of the same one get
+        the same paths
+    """
+    def __init__(self, key):
+        name = hashlib.sha1(key.encode()).hexdigest()[:16]
+        self.root = os.path.join(SHM_DIR or tempfile.gettempdir(),
+                                 'metco2-' + name)
+
+    def __enter__(self):
+        os.makedirs(self.root, exist_ok=True)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        shutil.rmtree(self.root, ignore_errors=True)
+        return False
+
+
+def share(fname, array):
+    """
+    Writes `array` to `fname` for other processes to `attach`.
+    The file appears atomically, so readers never see it partially
+    written.
+    """
+    import numpy as np
+
+    tmp = '{}.{}.tmp'.format(fname, os.getpid())
+    with open(tmp, 'wb') as f:
+        np.save(f, np.asarray(array))
+    os.replace(tmp, fname)
+    return fname
+
+
+def attach(fname):
+    """
+    Memory-maps a shared array read-only, without copying it.
+    Returns None if it was never shared.
+    """
+    import numpy as np
+
+    try:
+        return np.load(fname, mmap_mode='r')
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def share_design(prefix, X, is_confound):
+    """
+    Shares a design matrix and its confound mask, as built by
+    `glm.design_matrix`, under `prefix`.
+    """
+    share(prefix + '_X.npy', X)
+    share(prefix + '_confound.npy', is_confound)
+
+
+def attach_design(prefix):
+    """
+    Attaches a design matrix shared with `share_design`.
+
+    Outputs
+    -------
+    tuple
+        (X, is_confound), or None if it was never shared
+    """
+    X = attach(prefix + '_X.npy')
+    is_confound = attach(prefix + '_confound.npy')
+    if X is None or is_confound is None:
+        return None
+    return X, is_confound
@@ -1,11 +1,13 @@
 import os
-from nipype.interfaces import afni
-import nipype.interfaces.io as nio
-from nipype.pipeline import engine as pe
-from nipype.interfaces import utility as niu
+import re
+from ..utils.registry import STIM_MODEL
 
 
-def init_metco2_wf(images, events, confounds, subject_id, out_dir):
+def init_metco2_wf(images, events, confounds, subject_id, out_dir,
+                   name='metco2_wf', mem_gb=None, echo_times=None,
+                   output_format='nii.gz', save_fit=False,
+                   stim_model=STIM_MODEL, design=None, mask=None,
+                   cache_dir=None):
     """
     This workflow ... .
 
@@ -21,11 +23,44 @@ def init_metco2_wf(images, events, confounds, subject_id, out_dir):
     Confounds
         Filname
     Events
-        List of filenames
+        List of onsets (in seconds), or of AFNI timing files, per
+        condition
     Images
-        4D NIfTI image
+        4D NIfTI image, or list of images (one per echo) of a run
+    Name
+        Workflow name, unique per run when several run concurrently
+    Mem_gb
+        Memory budget for out-of-core correction; None loads the
+        whole image
+    Echo_times
+        Echo times of `images`; if given, an optimally combined
+        image is also written
+    Output_format
+        Format of the written images, one of `metco2.utils.nifti.FORMATS`
+    Save_fit
+        Also write the regression coefficients and fit statistics
+        of each echo
+    Stim_model
+        AFNI response model of the task regressors, e.g. 'BLOCK(10,1)'
+    Design
+        Prefix of the run's design matrix in shared memory (see
+        `metco2.utils.shm`); None builds it in the workflow
+    Mask
+        'auto' or a 3D mask image: only voxels within it are
+        corrected; None corrects every voxel
+    Cache_dir
+        Directory of prefetched uncompressed copies of `images`
+        (see `metco2.utils.nifti.uncompressed_copy`); None
+        decompresses them in the workflow
     """
-    metco2_wf = pe.Workflow(name='metco2_wf')
+    import nipype.interfaces.io as nio
+    from nipype.pipeline import engine as pe
+    from nipype.interfaces import utility as niu
+
+    if isinstance(images, str):
+        images = [images]
+
+    metco2_wf = pe.Workflow(name=name)
     metco2_wf.base_dir = os.path.join(out_dir, 'working')
 
     # input node for gathering relevant files
@@ -37,22 +72,33 @@ def init_metco2_wf(images, events, confounds, subject_id, out_dir):
     inputnode.inputs.images = images
     inputnode.inputs.events = events
 
-    gen_stims = pe.Node(niu.Function(input_names=['event_list'],
+    gen_stims = pe.Node(niu.Function(input_names=['event_list', 'model'],
                                      output_names=['stim_tuples'],
                                      function=_gen_stim_list),
                         name='gen_stims')
-
-    # run a GLM in AFNI using 3dDeconvolve
-    deconvolve = pe.Node(afni.Deconvolve(), name='deconvolve')
-    deconvolve.inputs.args = '-ortvec {} confounds'.format(confounds)
-    deconvolve.inputs.x1D = 'mat'
-    deconvolve.inputs.cbucket = 'cbucket.nii'
-
-    # use 3dSynthesize to remove the variance associated with
-    # our physiological confounds
-    syn = pe.Node(afni.Synthesize(), name='syn')
-    syn.inputs.select = ['baseline', 'polort', 'allfunc']
-    syn.inputs.out_file = 'phys_corr_' + os.path.basename(images)
+    gen_stims.inputs.model = stim_model
+
+    # fit the GLM in-process and remove the variance
+    # associated with our physiological confounds
+    glm = pe.Node(niu.Function(input_names=['in_files', 'stim_tuples',
+                                            'confounds', 'echo_times',
+                                            'mem_gb', 'cache_dir',
+                                            'output_format', 'save_fit',
+                                            'design', 'mask'],
+                               output_names=['out_files', 'fit_files',
+                                             'write_s'],
+                               function=_correct_confounds),
+                  name='glm')
+    glm.inputs.confounds = confounds
+    glm.inputs.echo_times = echo_times
+    glm.inputs.mem_gb = mem_gb
+    glm.inputs.cache_dir = cache_dir
+    glm.inputs.output_format = output_format
+    glm.inputs.save_fit = save_fit
+    glm.inputs.design = design
+    glm.inputs.mask = mask
+    # write_s feeds the run report, not another node: keep it
+    glm.config = {'execution': {'remove_unnecessary_outputs': False}}
 
     # save out the corrected data to a datasink
     datasink = pe.Node(nio.DataSink(), name='datasink')
@@ -60,39 +106,150 @@ def init_metco2_wf(images, events, confounds, subject_id, out_dir):
 
     metco2_wf.connect([
         (inputnode, gen_stims, [('events', 'event_list')]),
-        (gen_stims, deconvolve, [('stim_tuples', 'stim_times')]),
-        (inputnode, deconvolve, [('images', 'in_files')]),
-        (deconvolve, syn, [('x1D', 'matrix'),
-                           ('cbucket', 'cbucket')]),
+        (gen_stims, glm, [('stim_tuples', 'stim_tuples')]),
+        (inputnode, glm, [('images', 'in_files')]),
         (inputnode, datasink, [('subject_id', 'container')]),
-        (syn, datasink, [('out_file', 'phys_corr')])
+        (glm, datasink, [('out_files', 'phys_corr')])
     ])
+    if save_fit:
+        metco2_wf.connect(glm, 'fit_files', datasink, 'phys_fit')
 
     return metco2_wf
 
 
-def _gen_stim_list(event_list):
+def _gen_stim_list(event_list, model=None):
     """
-    Given a list of event files, generate a list
-    of tuples with the form (number, filename, HRF)
+    Given a list of events, generate a list
+    of tuples with the form (number, events, HRF)
     for use in deconvolving the MRI timeseries.
 
     Inputs
     ------
     events: list
-        A list of file names
+        A list of onset lists (in seconds) or of file names,
+        one per condition
+    model: str
+        (Optional) AFNI response model of every condition.
+        Defaults to `registry.STIM_MODEL`.
 
     Outputs
     -------
     list
-        a list of tuples of form (number, filename, HRF)
+        a list of tuples of form (number, events, HRF)
     """
+    # nipype runs this from its source: import here, not at module level
+    from metco2.utils.registry import STIM_MODEL
+
+    model = model or STIM_MODEL
     stim_tuples = []
 
     for i in range(len(event_list)):
-        stim_tuples.append(((i + 1), event_list[i], 'BLOCK(10,1)'))
+        stim_tuples.append(((i + 1), event_list[i], model))
     return stim_tuples
 
 
+def _correct_confounds(in_files, stim_tuples, confounds, echo_times=None,
+                       mem_gb=None, cache_dir=None, output_format='nii.gz',
+                       save_fit=False, design=None, mask=None):
+    """
+    Regresses the task, polort baseline and physiological
+    confounds from every echo of a run, removing only the
+    confound fit.
+
+    Inputs
+    ------
+    in_files: list
+        4D NIfTI images, one per echo
+    stim_tuples: list
+        a list of tuples of form (number, onsets, HRF)
+    confounds: file
+        A plain-text file of physiological confounds
+    echo_times: list
+        (Optional) echo times; if given, the optimally combined
+        image is also written
+    mem_gb: float
+        (Optional) memory budget for out-of-core correction, in GB
+    cache_dir: str
+        (Optional) directory for uncompressed copies of `in_files`
+    output_format: str
+        (Optional) format of the written images
+    save_fit: bool
+        (Optional) also write coefficients and fit statistics
+    design: str
+        (Optional) prefix of the design matrix shared by the main
+        process; built from `stim_tuples` and `confounds` if None
+        or not shared
+    mask: str
+        (Optional) 'auto' or a 3D mask image; outputs are zero
+        outside the mask
+
+    Outputs
+    -------
+    out_files: list
+        the corrected 4D images
+    fit_files: list
+        the coefficients and fit statistics, with their sidecars
+    write_s: float
+        seconds spent writing outputs
+    """
+    import os
+    from metco2.utils.glm import correct_echoes
+    from metco2.utils.shm import attach_design
+    from metco2.workflows.model import (output_names, fit_names)
+
+    out_files = [os.path.abspath(f)
+                 for f in output_names(in_files, output_format=output_format)]
+    optcom_file = None
+    if echo_times is not None:
+        optcom_file = os.path.abspath(
+            output_names(in_files, echo_times, output_format)[-1])
+    fit_files, cbucket_files, stats_files = [], None, None
+    if save_fit:
+        fit_files = [os.path.abspath(f)
+                     for f in fit_names(in_files, output_format)]
+        cbucket_files, stats_files = fit_files[0::4], fit_files[2::4]
+    timings = {}
+    out_files = correct_echoes(in_files, stim_tuples, confounds, out_files,
+                               echo_times=echo_times, optcom_file=optcom_file,
+                               mem_gb=mem_gb, cache_dir=cache_dir,
+                               output_format=output_format,
+                               cbucket_files=cbucket_files,
+                               stats_files=stats_files, timings=timings,
+                               design=design and attach_design(design),
+                               mask=mask)
+    return out_files, fit_files, timings['write_s']
+
+
+def output_names(images, echo_times=None, output_format='nii.gz'):
+    """
+    Names of the corrected images written for a run: one per echo,
+    plus the optimal combination if `echo_times` are given.
+    """
+    from ..utils.nifti import output_name
+
+    names = ['phys_corr_' + os.path.basename(f) for f in images]
+    if echo_times is not None:
+        names.append('phys_corr_optcom_' +
+                     re.sub(r'_(?:echo-?|e)\d+(?=[_.])', '',
+                            os.path.basename(images[0])))
+    return [output_name(n, output_format) for n in names]
+
+
+def fit_names(images, output_format='nii.gz'):
+    """
+    Names of the coefficients and fit statistics written for a run,
+    each followed by its JSON sidecar: (cbucket, its sidecar, stats,
+    its sidecar) per echo.
+    """
+    from ..utils.nifti import (output_name, sidecar)
+
+    names = []
+    for f in images:
+        for prefix in ('phys_cbucket_', 'phys_stats_'):
+            name = output_name(prefix + os.path.basename(f), output_format)
+            names += [name, sidecar(name)]
+    return names
+
+
 def _length(x):
     return len(x)
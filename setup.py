@@ -42,7 +42,7 @@ def main():
         tests_require=ldict['TESTS_REQUIRES'],
         extras_require=ldict['EXTRA_REQUIRES'],
         entry_points={'console_scripts': ['metco2=metco2.cli.run:main']},
-        packages=find_packages(exclude=("tests",)),
+        packages=find_packages(exclude=("tests", "benchmarks", "benchmarks.*")),
         zip_safe=False
     )
 